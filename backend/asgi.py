@@ -0,0 +1,782 @@
+'''
+async serving mode: the same routes and JSON as the Flask app, on an ASGI server
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+the routes of the quiz traffic (categories, question lists, quizzes) and the long polling of /changes are answered
+by coroutines which query the database through a pool of async connections (asyncpg for postgres, aiosqlite for
+sqlite files), so a worker keeps serving other requests while it waits for the database or for a change.
+every other route (search, add, delete, bulk, export, sessions, metrics) is handed to the Flask app
+of create_app on the thread pool, so both modes always answer the same way.
+'''
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+from functools import partial
+
+from sqlalchemy.engine.url import make_url
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.http import parse_cookie, parse_etags, quote_etag
+from werkzeug.urls import url_decode
+
+from flaskr import create_app
+from changes import CHANGE_FIELDS, CHANGES_PAGE_SIZE, change_query, reload_if_trimmed, trim_suspected
+from http_cache import compress_body, list_etag, list_cache_headers
+from embedded import sqlite_pragmas
+from limits import MemoryBucketStore, client_address, guard_route
+from pagination import page_window, page_number, cut_page, QUESTIONS_PER_PAGE
+from page_cache import page_head, page_body, page_bounds
+from quiz import quiz_options, round_options
+from quiz_sessions import MemorySessionStore
+from serialization import QuestionRow, QUESTION_FIELDS, format_row, format_rows, dumps
+from tenants import UnknownTenant, current_tenant, request_tenant, tenant_of, unscoped_session_id
+
+ERROR_MESSAGES = {
+  400: 'bad request',
+  404: 'resource not found',
+  422: 'unprocessable entity',
+  429: 'too many requests',
+  500: 'internal server error',
+  503: 'service unavailable',
+}
+
+# same headers as the CORS extension and the after_request of the Flask app
+CORS_HEADERS = [
+  ('Access-Control-Allow-Origin', '*'),
+  ('Access-Control-Allow-Headers', 'Content-Type,Authorization,true'),
+  ('Access-Control-Allow-Methods', 'GET,POST,PATCH,DELETE,OPTIONS'),
+]
+
+QUESTION_COLUMNS = ', '.join(QUESTION_FIELDS)
+# same rows as change_rows() of changes.py
+CHANGES_SQL = (
+  f"SELECT {', '.join('question_changes.' + field for field in CHANGE_FIELDS)}, "
+  f"{', '.join('questions.' + field for field in QUESTION_FIELDS)} "
+  'FROM question_changes LEFT JOIN questions ON questions.id = question_changes.question_id '
+  'WHERE question_changes.seq > ? ORDER BY question_changes.seq LIMIT ?'
+)
+
+logger = logging.getLogger(__name__)
+
+# [statements, seconds, rows] of the SQL of the request handled by the current task, for the instrumentation
+request_sql = contextvars.ContextVar('request_sql', default=None)
+# AsyncDatabase of the replica picked for the request handled by the current task, None for the primary
+request_database = contextvars.ContextVar('request_database', default=None)
+
+
+class ResponseAborted(Exception):
+  """the response of the Flask app can't be sent anymore, the client went away"""
+
+
+class DatabaseUnavailable(Exception):
+  """the database of an AsyncDatabase can't be reached"""
+
+
+'''
+SqlitePool
+    aiosqlite connections opened on demand up to max_size, every connection runs in its own thread
+'''
+class SqlitePool:
+
+  def __init__(self, path, max_size, pragmas=()):
+    self.path = path
+    self.max_size = max_size
+    # the ones of the SQLite connections of the Flask app
+    self.pragmas = pragmas
+    self.size = 0
+    self.idle = asyncio.Queue()
+
+  async def fetch(self, sql, args):
+    import aiosqlite
+    if self.idle.empty() and self.size < self.max_size:
+      self.size += 1
+      try:
+        connection = await aiosqlite.connect(self.path)
+        for pragma in self.pragmas:
+          await connection.execute(pragma)
+      except Exception:
+        self.size -= 1
+        raise
+    else:
+      connection = await self.idle.get()
+    try:
+      async with connection.execute(sql, args) as cursor:
+        return await cursor.fetchall()
+    finally:
+      self.idle.put_nowait(connection)
+
+  async def close(self):
+    while not self.idle.empty():
+      await self.idle.get_nowait().close()
+
+
+'''
+AsyncDatabase
+    pool of async connections to the database of the Flask app, created on the first query of the event loop
+    the queries are written with ? placeholders, they are numbered ($1, $2...) for asyncpg
+    statement_cache_size is the number of prepared statements cached by every asyncpg connection, 0 behind PgBouncer
+    command_timeout is in seconds, None for no limit
+    sqlite_pragmas are run on every new connection to a sqlite file, see embedded.py
+    the queries raise DatabaseUnavailable when the database can't be reached
+'''
+class AsyncDatabase:
+
+  def __init__(self, database_path, min_size=1, max_size=10, statement_cache_size=100, command_timeout=None,
+               sqlite_pragmas=()):
+    self.url = make_url(database_path)
+    self.sqlite_pragmas = sqlite_pragmas
+    self.min_size = min_size
+    self.max_size = max_size
+    self.statement_cache_size = statement_cache_size
+    self.command_timeout = command_timeout
+    self.pool = None
+    self.loop = None
+    # errors of the driver when the database can't be reached
+    self.connection_errors = (OSError, asyncio.TimeoutError)
+
+  async def connect(self):
+    loop = asyncio.get_running_loop()
+    # a pool only works on the event loop that created it
+    if self.pool is not None and self.loop is loop:
+      return
+    self.loop = loop
+    if self.url.get_backend_name() == 'postgresql':
+      # optional dependency, only needed by the async mode
+      import asyncpg
+      self.connection_errors = (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError)
+      self.pool = await asyncpg.create_pool(
+        host=self.url.host, port=self.url.port, user=self.url.username, password=self.url.password,
+        database=self.url.database, min_size=self.min_size, max_size=self.max_size,
+        statement_cache_size=self.statement_cache_size, command_timeout=self.command_timeout)
+    elif self.url.get_backend_name() == 'sqlite' and self.url.database:
+      self.connection_errors = (OSError, asyncio.TimeoutError, sqlite3.OperationalError)
+      self.pool = SqlitePool(self.url.database, self.max_size, self.sqlite_pragmas)
+    else:
+      raise RuntimeError(f'the async mode supports postgresql and sqlite files, not {self.url}')
+
+  async def fetch(self, sql, *args):
+    """the rows of a query as tuples"""
+    started_at = time.perf_counter()
+    try:
+      await self.connect()
+      if isinstance(self.pool, SqlitePool):
+        rows = await self.pool.fetch(sql, args)
+      else:
+        numbered = iter(range(1, len(args) + 1))
+        sql = re.sub(r'\?', lambda match: f'${next(numbered)}', sql)
+        async with self.pool.acquire() as connection:
+          rows = [tuple(record) for record in await connection.fetch(sql, *args)]
+    except self.connection_errors as error:
+      raise DatabaseUnavailable(f'{self.url.get_backend_name()} database {self.url.database}') from error
+
+    stats = request_sql.get()
+    if stats is not None:
+      stats[0] += 1
+      stats[1] += time.perf_counter() - started_at
+      stats[2] += len(rows)
+    return rows
+
+  async def fetchval(self, sql, *args):
+    """the first column of the first row of a query, None without rows"""
+    rows = await self.fetch(sql, *args)
+    return rows[0][0] if rows else None
+
+  async def close(self):
+    if self.pool is not None:
+      await self.pool.close()
+      self.pool = None
+
+
+'''
+AsyncRequest
+    what the coroutines need from an ASGI request, with the same helpers as the Flask request
+'''
+class AsyncRequest:
+
+  def __init__(self, scope, body):
+    self.method = scope['method']
+    self.path = scope['path']
+    self.args = url_decode(scope.get('query_string', b''))
+    self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+    self.body = body
+    self.remote_addr = (scope.get('client') or ('127.0.0.1', 0))[0]
+    # admitted by the load shedder, released once the response is built
+    self.admitted = False
+
+  def get_json(self):
+    # like Flask: None unless the body is JSON, 400 if it can't be parsed
+    if self.headers.get('Content-Type', '').split(';')[0].strip() != 'application/json':
+      return None
+    try:
+      return json.loads(self.body)
+    except ValueError:
+      abort(400)
+
+
+'''
+BodyStream
+    wsgi.input of the routes handed to Flask: the worker thread reads the body as the client sends it
+'''
+class BodyStream(io.RawIOBase):
+
+  def __init__(self, receive, loop):
+    self.receive = receive
+    self.loop = loop
+    self.buffer = b''
+    self.more_body = True
+
+  def readable(self):
+    return True
+
+  def readinto(self, target):
+    while not self.buffer and self.more_body:
+      message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+      self.buffer = message.get('body', b'')
+      self.more_body = message['type'] == 'http.request' and message.get('more_body', False)
+    size = min(len(target), len(self.buffer))
+    target[:size] = self.buffer[:size]
+    self.buffer = self.buffer[size:]
+    return size
+
+
+def wsgi_environ(scope, body_stream):
+  server = scope.get('server') or ('localhost', 80)
+  client = scope.get('client') or ('127.0.0.1', 0)
+  environ = {
+    'REQUEST_METHOD': scope['method'],
+    'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+    'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+    'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+    'SERVER_NAME': str(server[0]),
+    'SERVER_PORT': str(server[1]),
+    'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+    'REMOTE_ADDR': str(client[0]),
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': scope.get('scheme', 'http'),
+    'wsgi.input': io.BufferedReader(body_stream),
+    # the body ends with the last ASGI message, with or without a Content-Length
+    'wsgi.input_terminated': True,
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': True,
+    'wsgi.multiprocess': True,
+    'wsgi.run_once': False,
+  }
+  for name, value in scope['headers']:
+    name = name.decode('latin-1').upper().replace('-', '_')
+    value = value.decode('latin-1')
+    key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name
+    environ[key] = environ[key] + ',' + value if key in environ else value
+  return environ
+
+
+'''
+AsyncTrivia
+    the ASGI application: a few routes answered by coroutines, the other ones by the Flask app
+'''
+class AsyncTrivia:
+
+  def __init__(self, flask_app):
+    self.flask_app = flask_app
+    self.primary = self.async_database(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+    # same replicas and same health as the read_replica views of the Flask app
+    self.router = flask_app.extensions['replica_router']
+    self.replicas = {key: self.async_database(flask_app.config['SQLALCHEMY_BINDS'][key]) for key in self.router.keys}
+    # the pools of the tenants are only opened by their first request
+    self.tenant_databases = {tenant: self.async_database(uri)
+                             for tenant, uri in flask_app.config['TENANT_DATABASE_URIS'].items()}
+    self.quiz_index = flask_app.extensions['quiz_index']
+    self.quiz_sessions = flask_app.extensions['quiz_sessions']
+    self.category_cache = flask_app.extensions['category_cache']
+    self.page_cache = flask_app.extensions['page_cache']
+    self.change_feed = flask_app.extensions['change_feed']
+    self.rate_limiter = flask_app.extensions['rate_limiter']
+    self.load_shedder = flask_app.extensions['load_shedder']
+    self.instrumentation = flask_app.extensions['instrumentation']
+    # (method, path, Flask rule, coroutine, read only), the groups of the path are the arguments of the coroutine
+    # the rule is the endpoint label of the metrics, the same as when Flask answers the route
+    # the read only routes query the replicas, like the views decorated with read_replica
+    self.routes = [
+      ('GET', re.compile(r'/categories'), '/categories', self.get_categories, True),
+      ('GET', re.compile(r'/questions'), '/questions', self.get_all_questions, True),
+      ('GET', re.compile(r'/categories/(?P<category_id>\d+)/questions'), '/categories/<int:category_id>/questions',
+       self.get_questions_by_category, True),
+      ('POST', re.compile(r'/quizzes'), '/quizzes', self.play_the_game, True),
+      ('POST', re.compile(r'/quizzes/round'), '/quizzes/round', self.play_a_round, True),
+      # not retried on another database, the question id is already popped from the session
+      ('POST', re.compile(r'/quizzes/sessions/(?P<session_id>[^/]+)/next'), '/quizzes/sessions/<session_id>/next',
+       self.next_quiz_session_question, False),
+      # on the primary, a reader woken up by a commit must find it in the log
+      ('GET', re.compile(r'/changes'), '/changes', self.get_changes, False),
+    ]
+
+  def async_database(self, database_path):
+    config = self.flask_app.config
+    return AsyncDatabase(
+      database_path, config['ASYNC_POOL_MIN_SIZE'], config['ASYNC_POOL_MAX_SIZE'],
+      # PgBouncer in transaction mode can't keep the prepared statements of a connection
+      statement_cache_size=0 if config['DB_PGBOUNCER'] else config['DB_STATEMENT_CACHE_SIZE'],
+      command_timeout=config['DB_STATEMENT_TIMEOUT'] / 1000 or None, sqlite_pragmas=sqlite_pragmas(config))
+
+  @property
+  def database(self):
+    """the database of the current request: the one of its tenant, a replica picked by answer() or the primary"""
+    tenant = current_tenant()
+    if tenant is not None:
+      return self.tenant_databases[tenant]
+    return request_database.get() or self.primary
+
+  def tenant_of(self, request):
+    """the tenant of a request, same as the before_request of the Flask app"""
+    try:
+      return tenant_of(request.headers, request.headers.get('Host'), self.flask_app.config)
+    except UnknownTenant:
+      abort(404)
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      return await self.lifespan(receive, send)
+
+    for method, path, rule, coroutine, read_only in self.routes:
+      match = path.fullmatch(scope['path'])
+      if match is not None and scope['method'] == method:
+        break
+    else:
+      return await self.call_flask(scope, receive, send)
+
+    started_at = time.perf_counter()
+    sql = [0, 0, 0]
+    request_sql.set(sql)
+    body = b''
+    while True:
+      message = await receive()
+      body += message.get('body', b'')
+      if message['type'] != 'http.request' or not message.get('more_body', False):
+        break
+
+    request = AsyncRequest(scope, body)
+    headers = []
+    try:
+      request_tenant.set(self.tenant_of(request))
+      status, payload, headers = await self.answer(coroutine, read_only, request, match.groupdict())
+    except HTTPException as error:
+      status = error.code
+      payload = {'success': False, 'error': error.code, 'message': ERROR_MESSAGES.get(error.code, error.name.lower())}
+      # the 429 and 503 of guard()
+      if getattr(error, 'retry_after', None):
+        headers = [('Retry-After', str(error.retry_after))]
+    except Exception:
+      logger.exception('error in %s %s', scope['method'], scope['path'])
+      status = 500
+      payload = {'success': False, 'error': 500, 'message': ERROR_MESSAGES[500]}
+    finally:
+      if request.admitted:
+        self.load_shedder.release(sql[1])
+
+    # the lists of questions are already JSON, from the page cache
+    body = b'' if payload is None else payload if isinstance(payload, bytes) else dumps(payload)
+    headers = headers + CORS_HEADERS
+    if self.tenant_databases:
+      headers.append(('Vary', self.flask_app.config['TENANT_HEADER']))
+    if payload is not None:
+      headers.append(('Content-Type', 'application/json'))
+    # same compression as the after_request of the Flask app
+    if status == 200 and payload is not None:
+      body, encoding_headers = compress_body(body, 'application/json', request.headers.get('Accept-Encoding'),
+                                             self.flask_app.config)
+      headers += encoding_headers
+    headers.append(('Content-Length', str(len(body))))
+    await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+    self.instrumentation.record(rule, scope['method'], status, time.perf_counter() - started_at, *sql)
+
+  async def answer(self, coroutine, read_only, request, arguments):
+    """runs a route on a replica, on the next one when it can't be reached and on the primary last"""
+    replica = None
+    # the replicas are the ones of the default database, the tenants only have their primary
+    if read_only and self.router.keys and current_tenant() is None and \
+        not self.router.is_sticky(parse_cookie(request.headers.get('Cookie', ''))):
+      replica = self.router.pick()
+    while True:
+      request_database.set(self.replicas.get(replica))
+      try:
+        return await coroutine(request, **arguments)
+      except DatabaseUnavailable:
+        if replica is None:
+          raise
+        self.router.mark_down(replica)
+        replica = self.router.pick()
+
+  async def lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await self.primary.connect()
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        for database in [self.primary, *self.replicas.values(), *self.tenant_databases.values()]:
+          await database.close()
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+  async def call_flask(self, scope, receive, send):
+    """runs the Flask app on the thread pool, the response is streamed back chunk by chunk"""
+    loop = asyncio.get_running_loop()
+    environ = wsgi_environ(scope, BodyStream(receive, loop))
+    # a few chunks ahead at most, the thread waits when the client reads slower than the app writes
+    chunks = asyncio.Queue(maxsize=8)
+    started = {}
+    # set when the response can't be sent anymore, the thread stops iterating it
+    aborted = threading.Event()
+
+    def start_response(status, headers, exc_info=None):
+      started['status'] = int(status.split(' ', 1)[0])
+      started['headers'] = headers
+
+    def put(chunk):
+      if aborted.is_set():
+        raise ResponseAborted()
+      asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+    def run():
+      # the whole response is iterated on the same thread, stream_with_context needs it
+      iterable = self.flask_app(environ, start_response)
+      try:
+        try:
+          for chunk in iterable:
+            if chunk:
+              put(chunk)
+        finally:
+          if hasattr(iterable, 'close'):
+            iterable.close()
+          put(None)
+      except ResponseAborted:
+        pass
+
+    worker = loop.run_in_executor(None, run)
+    try:
+      chunk = await chunks.get()
+      await send({
+        'type': 'http.response.start',
+        'status': started['status'],
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in started['headers']],
+      })
+      while chunk is not None:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        chunk = await chunks.get()
+      await send({'type': 'http.response.body', 'body': b''})
+    except BaseException:
+      # the client went away or the task was cancelled: nothing reads the queue anymore, the chunk the thread
+      # may be blocked on is let in and the next put() stops the iteration of the response
+      aborted.set()
+      while not chunks.empty():
+        chunks.get_nowait()
+      raise
+    await worker
+
+  async def guard(self, route, request):
+    """429 when the client used up its budget of the route, 503 while the worker sheds the load, like the Flask app"""
+    # a coroutine retried on another replica was already admitted
+    if request.admitted:
+      return
+    client = client_address(request.headers, request.remote_addr, self.flask_app.config)
+    # the buckets kept in process are taken right away, the ones in redis on the thread pool
+    if isinstance(self.rate_limiter.store, MemoryBucketStore):
+      guard_route(self.rate_limiter, self.load_shedder, route, client)
+    else:
+      await self.sync(guard_route, self.rate_limiter, self.load_shedder, route, client)
+    request.admitted = True
+
+  async def sync(self, function, *args):
+    """calls a blocking function of the Flask app (in memory indexes which may load) on the thread pool"""
+    # with the context variables of the task, the tenant of the request among them
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+      None, partial(context.run, self.in_app_context, function, *args))
+
+  def in_app_context(self, function, *args):
+    with self.flask_app.app_context():
+      return function(*args)
+
+  async def cached(self, cache, function, *args):
+    """calls a function of an in memory cache right away, or on the thread pool when the cache has to load first"""
+    if cache.needs_load():
+      return await self.sync(function, *args)
+    return function(*args)
+
+  async def fetch_window(self, args, category=None):
+    """the rows of the page of questions asked by ?page= or ?after= and the next row, same as fetch_window()"""
+    window = page_window(args)
+    if window is None:
+      return []
+    after_id, offset = window
+
+    conditions, params = [], []
+    if category is not None:
+      conditions.append('category = ?')
+      params.append(category)
+    if after_id is not None:
+      conditions.append('id > ?')
+      params.append(after_id)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    rows = await self.database.fetch(
+      f'SELECT {QUESTION_COLUMNS} FROM questions{where} ORDER BY id LIMIT ? OFFSET ?',
+      *params, QUESTIONS_PER_PAGE + 1, offset)
+    return [QuestionRow(*row) for row in rows]
+
+  async def list_body(self, request, category, version, categories_etag, payload, count_sql, *count_args):
+    """the JSON of a page of questions, from the page cache for the ?page=<n> pages it has, same as the Flask app"""
+    page = page_number(request.args)
+    head = None if page is None else self.page_cache.get(category, page, version, categories_etag)
+    if head is None:
+      rows = await self.fetch_window(request.args, category)
+      questions, next_cursor = cut_page(rows)
+
+      # in case no questions exist in the database, in the requested page or in the category
+      if len(questions) == 0:
+        abort(404)
+      head = page_head(await payload(format_rows(questions), next_cursor))
+      if page is not None:
+        self.page_cache.put(category, page, version, categories_etag, head, page_bounds(rows))
+
+    total = self.page_cache.get_total(category, version)
+    if total is None:
+      total = await self.database.fetchval(count_sql, *count_args) or 0
+      self.page_cache.put_total(category, version, total)
+    return page_body(head, total)
+
+  async def get_question_row(self, question_id, database=None):
+    """the row of a question on the database of the request, or on the given one"""
+    database = database or self.database
+    rows = await database.fetch(f'SELECT {QUESTION_COLUMNS} FROM questions WHERE id = ?', question_id)
+    return QuestionRow(*rows[0]) if rows else None
+
+  async def get_question_rows(self, question_ids, database=None):
+    """{id: QuestionRow} of the questions of question_ids in one query, same as get_question_rows()"""
+    if not question_ids:
+      return {}
+    database = database or self.database
+    rows = await database.fetch(
+      f"SELECT {QUESTION_COLUMNS} FROM questions WHERE id IN ({', '.join('?' * len(question_ids))})", *question_ids)
+    return {row[0]: QuestionRow(*row) for row in rows}
+
+  async def get_categories(self, request):
+    categories, etag = await self.cached(self.category_cache,
+                                         lambda: (self.category_cache.get_all(), self.category_cache.get_etag()))
+
+    # in case no categories exist in the database
+    if len(categories) == 0:
+      abort(404)
+
+    headers = [('ETag', quote_etag(etag, weak=True)),
+               ('Cache-Control', f"public, max-age={self.flask_app.config['CATEGORIES_MAX_AGE']}")]
+    # the client already has these categories, nothing to send back
+    if parse_etags(request.headers.get('If-None-Match')).contains_weak(etag):
+      return 304, None, headers
+    return 200, {'success': True, 'categories': categories}, headers
+
+  async def list_versions(self):
+    """(version of the questions, etag of the categories) behind the ETag and the page cache, same as the Flask app"""
+    version = await self.database.fetchval('SELECT version FROM table_versions WHERE name = ?', 'questions')
+    return version or 0, await self.cached(self.category_cache, self.category_cache.get_etag)
+
+  async def get_all_questions(self, request):
+    # the client already has this page, the questions and the categories didn't change since
+    version, categories_etag = await self.list_versions()
+    etag = list_etag(version, categories_etag, current_tenant())
+    if parse_etags(request.headers.get('If-None-Match')).contains_weak(etag):
+      return 304, None, list_cache_headers(etag, self.flask_app.config)
+
+    async def payload(questions, next_cursor):
+      return {
+        'success': True,
+        'questions': questions,
+        'categories': await self.cached(self.category_cache, self.category_cache.get_all),
+        'current_category': '1',
+        'next_cursor': next_cursor
+      }
+    body = await self.list_body(request, None, version, categories_etag, payload,
+                                'SELECT coalesce(sum(count), 0) FROM question_counts')
+    return 200, body, list_cache_headers(etag, self.flask_app.config)
+
+  async def get_questions_by_category(self, request, category_id):
+    category_id = int(category_id)
+    category_type = (await self.cached(self.category_cache, self.category_cache.get_all)).get(category_id)
+
+    #in case the user enters a category id that doesn't exist
+    if category_type is None:
+      abort(422)
+
+    # the client already has this page, the questions and the categories didn't change since
+    version, categories_etag = await self.list_versions()
+    etag = list_etag(version, categories_etag, current_tenant())
+    if parse_etags(request.headers.get('If-None-Match')).contains_weak(etag):
+      return 304, None, list_cache_headers(etag, self.flask_app.config)
+
+    async def payload(questions, next_cursor):
+      return {
+        'success': True,
+        'questions': questions,
+        'category': category_type,
+        'next_cursor': next_cursor
+      }
+    body = await self.list_body(request, category_id, version, categories_etag, payload,
+                                'SELECT count FROM question_counts WHERE category = ?', category_id)
+    return 200, body, list_cache_headers(etag, self.flask_app.config)
+
+  async def play_the_game(self, request):
+    await self.guard('quizzes', request)
+    request_body = request.get_json()
+    # if the user doesnt give a request
+    if request_body is None:
+      abort(400)
+
+    quiz_category = request_body.get('quiz_category', None)
+    previous_questions = request_body.get('previous_questions', None)
+
+    # in case the user doesn't give a quiz_category or a previous questions list
+    if quiz_category is None or previous_questions is None:
+      abort(400)
+
+    # the category is an object like {"id": 1, "type": "Science"}
+    if not isinstance(quiz_category, dict):
+      abort(400)
+
+    # the ids of the previous questions are used for a binary search so they have to be numbers
+    if not isinstance(previous_questions, list) or \
+        not all(isinstance(question_id, int) for question_id in previous_questions):
+      abort(400)
+
+    # the optional difficulty band and strategy of an adaptive quiz
+    try:
+      difficulty, strategy = quiz_options(request_body)
+    except ValueError:
+      abort(400)
+
+    category_id = quiz_category.get('id', 0)
+    # in case no questions are in the category or no question exist altogether in the database
+    if await self.cached(self.quiz_index, self.quiz_index.size, category_id, difficulty) == 0:
+      abort(404)
+
+    while True:
+      question_id, remaining = await self.cached(self.quiz_index, self.quiz_index.sample, category_id,
+                                                 previous_questions, difficulty, strategy)
+
+      # in case all the questions of the category were already asked
+      if remaining == 0:
+        return 200, {'success': True, 'state': 'end_of_game'}, []
+
+      question = await self.get_question_row(question_id)
+      if question is None and request_database.get() is not None:
+        # the index follows the primary, a question added there may not have reached the replica yet
+        question = await self.get_question_row(question_id, self.primary)
+      # the question may have been deleted by another worker since the index was loaded
+      if question is not None:
+        break
+      self.quiz_index.discard(question_id)
+
+    return 200, {'success': True, 'question': format_row(question)}, []
+
+  async def play_a_round(self, request):
+    await self.guard('quizzes', request)
+    request_body = request.get_json()
+    # if the user doesnt give a request
+    if request_body is None:
+      abort(400)
+
+    # the category is an object like {"id": 1, "type": "Science"}
+    quiz_category = request_body.get('quiz_category', None)
+    if not isinstance(quiz_category, dict):
+      abort(400)
+
+    try:
+      difficulty, strategy = quiz_options(request_body)
+      count, previous_questions, seed = round_options(request_body)
+    except ValueError:
+      abort(400)
+
+    category_id = quiz_category.get('id', 0)
+    # in case no questions are in the category or no question exist altogether in the database
+    if await self.cached(self.quiz_index, self.quiz_index.size, category_id, difficulty) == 0:
+      abort(404)
+
+    while True:
+      question_ids, remaining = await self.cached(self.quiz_index, self.quiz_index.sample_round, category_id, count,
+                                                  previous_questions, difficulty, strategy, seed)
+
+      # in case all the questions of the category were already asked
+      if remaining == 0:
+        return 200, {'success': True, 'state': 'end_of_game'}, []
+
+      questions = await self.get_question_rows(question_ids)
+      missing = [question_id for question_id in question_ids if question_id not in questions]
+      if missing and request_database.get() is not None:
+        # the index follows the primary, a question added there may not have reached the replica yet
+        questions.update(await self.get_question_rows(missing, self.primary))
+      # the questions may have been deleted by another worker since the index was loaded, the round is drawn again
+      deleted = [question_id for question_id in question_ids if question_id not in questions]
+      if not deleted:
+        break
+      for question_id in deleted:
+        self.quiz_index.discard(question_id)
+
+    return 200, {
+      'success': True,
+      'questions': [format_row(questions[question_id]) for question_id in question_ids],
+      'remaining_questions': remaining - len(question_ids)
+    }, []
+
+  async def next_quiz_session_question(self, request, session_id):
+    while True:
+      try:
+        store_id = unscoped_session_id(session_id)
+        # the sessions kept in process are popped right away, the ones in redis on the thread pool
+        if isinstance(self.quiz_sessions, MemorySessionStore):
+          question_id = self.quiz_sessions.pop(store_id)
+        else:
+          question_id = await self.sync(self.quiz_sessions.pop, store_id)
+      except KeyError:
+        # in case the session doesn't exist or has expired
+        abort(404)
+
+      if question_id is None:
+        await self.sync(self.quiz_sessions.delete, store_id)
+        return 200, {'success': True, 'state': 'end_of_game'}, []
+
+      question = await self.get_question_row(question_id)
+      # the question may have been deleted since the session started
+      if question is not None:
+        break
+
+    return 200, {'success': True, 'question': format_row(question)}, []
+
+  async def get_changes(self, request):
+    # in case since or wait aren't numbers
+    try:
+      since, wait = change_query(request.args, self.flask_app.config['CHANGES_MAX_WAIT_SECONDS'])
+    except ValueError:
+      abort(400)
+
+    async def fetch(since):
+      rows = await self.database.fetch(CHANGES_SQL, since, CHANGES_PAGE_SIZE)
+      if trim_suspected(rows, since):
+        rows = reload_if_trimmed(rows, since, await self.database.fetchval('SELECT min(seq) FROM question_changes'))
+      return rows
+    # the task waits on the event loop, neither a thread nor a connection is held meanwhile
+    changes = await self.change_feed.wait_async(fetch, since, wait)
+    return 200, {'success': True, 'changes': changes, 'last_seq': changes[-1]['seq'] if changes else since}, \
+      [('Cache-Control', 'no-store')]
+
+
+def create_asgi_app(test_config=None):
+  return AsyncTrivia(create_app(test_config))
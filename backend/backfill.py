@@ -0,0 +1,57 @@
+import os
+import time
+
+from sqlalchemy import text
+
+# questions updated per transaction by the backfill
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', 5000))
+
+# the questions whose category_id can still be filled, the step 2 of the migration refuses to run while there are some
+# the category is compared as a string, so a category which isn't a number can't fail the cast
+PENDING_SQL = (
+  "SELECT count(*) FROM questions "
+  "WHERE category_id IS NULL AND category IN (SELECT CAST(id AS VARCHAR) FROM categories)"
+)
+# the questions of a category which doesn't exist, their category becomes NULL
+ORPHANS_SQL = (
+  "SELECT count(*) FROM questions "
+  "WHERE category_id IS NULL AND category IS NOT NULL "
+  "AND category NOT IN (SELECT CAST(id AS VARCHAR) FROM categories)"
+)
+BACKFILL_SQL = {
+  'postgresql': (
+    "UPDATE questions AS q SET category_id = c.id FROM categories AS c "
+    "WHERE c.id::text = q.category AND q.category_id IS NULL AND q.id > :low AND q.id <= :high"
+  ),
+  'sqlite': (
+    "UPDATE questions SET category_id = (SELECT id FROM categories WHERE CAST(id AS TEXT) = questions.category) "
+    "WHERE category_id IS NULL AND category IN (SELECT CAST(id AS TEXT) FROM categories) AND id > :low AND id <= :high"
+  ),
+}
+
+
+'''
+backfill_categories(engine)
+    fills questions.category_id between the two steps of the typed category migration (migrations/versions)
+    the questions are updated by ranges of batch_size ids, every range in its own short transaction, so the table
+    stays writable and a backfill that was stopped starts again where it was. pause is the number of seconds
+    to wait between two ranges, to leave room to the traffic. progress(last id, max id, updated) is called
+    after every range. Returns (updated questions, questions of a category which doesn't exist)
+'''
+def backfill_categories(engine, batch_size=BACKFILL_BATCH_SIZE, pause=0, progress=None):
+  sql = text(BACKFILL_SQL[engine.dialect.name])
+  with engine.connect() as connection:
+    low, high = connection.execute(text('SELECT min(id) - 1, max(id) FROM questions')).first()
+
+  updated = 0
+  while low is not None and low < high:
+    with engine.begin() as connection:
+      updated += connection.execute(sql, {'low': low, 'high': low + batch_size}).rowcount
+    low += batch_size
+    if progress is not None:
+      progress(min(low, high), high, updated)
+    if pause:
+      time.sleep(pause)
+
+  with engine.connect() as connection:
+    return updated, connection.execute(text(ORPHANS_SQL)).scalar()
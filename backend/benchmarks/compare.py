@@ -0,0 +1,59 @@
+'''
+compares two result files of benchmarks.load, from the backend folder:
+    python -m benchmarks.compare before.json after.json --threshold 10
+
+prints the change of every metric and exits with the status 1 when a latency or the peak RSS grew,
+or the throughput dropped, by more than the threshold (in percent)
+'''
+import argparse
+import json
+import sys
+
+# metric -> True when a bigger value is better
+METRICS = {
+  'p50_ms': False,
+  'p95_ms': False,
+  'p99_ms': False,
+  'throughput_rps': True,
+  'peak_rss_kb': False,
+}
+
+
+def compare(before, after, threshold):
+  """[(transport, scenario, metric, before value, after value, change in percent, regression)]"""
+  changes = []
+  for transport, scenarios in after['results'].items():
+    for scenario, metrics in scenarios.items():
+      previous = before['results'].get(transport, {}).get(scenario)
+      if previous is None:
+        continue
+      for metric, bigger_is_better in METRICS.items():
+        if not previous.get(metric) or metrics.get(metric) is None:
+          continue
+        change = (metrics[metric] - previous[metric]) / previous[metric] * 100
+        regression = -change > threshold if bigger_is_better else change > threshold
+        changes.append((transport, scenario, metric, previous[metric], metrics[metric], change, regression))
+  return changes
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('before', help='results of the reference run')
+  parser.add_argument('after', help='results of the new run')
+  parser.add_argument('--threshold', type=float, default=10, help='change in percent counted as a regression')
+  args = parser.parse_args()
+
+  with open(args.before) as before_file, open(args.after) as after_file:
+    before, after = json.load(before_file), json.load(after_file)
+  if before['config'].get('questions') != after['config'].get('questions'):
+    print('warning: the two runs were not made with the same number of questions')
+
+  changes = compare(before, after, args.threshold)
+  for transport, scenario, metric, old, new, change, regression in changes:
+    flag = '  REGRESSION' if regression else ''
+    print(f'{transport:>12} {scenario:<28} {metric:<15} {old:12.2f} -> {new:12.2f} {change:+7.1f}%{flag}')
+  sys.exit(1 if any(change[-1] for change in changes) else 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,189 @@
+import csv
+import io
+import json
+import logging
+
+from models import db, integer_value, notify_question_listeners, Question, QuestionChange, QuestionCount, TableVersion
+
+# the import report lists at most this many rejected rows
+BULK_MAX_ERRORS = 100
+
+logger = logging.getLogger(__name__)
+
+IMPORT_FIELDS = ('question', 'answer', 'category', 'difficulty')
+EXPORT_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+FORMATS = {
+  'ndjson': 'application/x-ndjson',
+  'csv': 'text/csv',
+}
+
+
+def format_of_mimetype(mimetype):
+  """'ndjson' or 'csv' for the content type of an import, None when it isn't supported"""
+  if mimetype in ('application/x-ndjson', 'application/ndjson', 'application/jsonl'):
+    return 'ndjson'
+  if mimetype == 'text/csv':
+    return 'csv'
+  return None
+
+
+'''
+read_rows(lines, format)
+    yields (line_number, row) for every row of an NDJSON or CSV text stream, one line at a time
+    so the whole file is never in memory. A line that can't be parsed gives (line_number, None)
+'''
+def read_rows(lines, format):
+  if format == 'csv':
+    reader = csv.DictReader(lines)
+    for row in reader:
+      yield reader.line_num, row
+    return
+
+  for line_number, line in enumerate(lines, start=1):
+    if not line.strip():
+      continue
+    try:
+      row = json.loads(line)
+    except ValueError:
+      row = None
+    yield line_number, row if isinstance(row, dict) else None
+
+
+def validate(row, categories):
+  """the values to insert for a row, raises ValueError with the reason when the row is rejected"""
+  if row is None:
+    raise ValueError('the line is not a question object')
+  missing = [field for field in IMPORT_FIELDS if row.get(field) in (None, '')]
+  if missing:
+    raise ValueError('missing ' + ', '.join(missing))
+  # the same integers as POST /questions, so true, 2.9, "1e3" or a value out of the column range is rejected here
+  # rather than failing the whole chunk in the database
+  try:
+    difficulty = integer_value(row['difficulty'])
+  except ValueError:
+    raise ValueError('difficulty is not an integer')
+  try:
+    category = integer_value(row['category'])
+  except ValueError:
+    raise ValueError('category is not a category id')
+  if category not in categories:
+    raise ValueError(f'category {category} does not exist')
+  return {
+    'question': str(row['question']),
+    'answer': str(row['answer']),
+    'category': category,
+    'difficulty': difficulty
+  }
+
+
+def insert_batch(rows):
+  """inserts the rows and their counts in one transaction, with COPY on postgres and executemany elsewhere"""
+  try:
+    # first, so the writers queue on the version before they lock the counts (see TableVersion)
+    TableVersion.bump('questions')
+    if db.session.get_bind().dialect.name == 'postgresql':
+      buffer = io.StringIO()
+      writer = csv.writer(buffer)
+      for row in rows:
+        writer.writerow([row[field] for field in IMPORT_FIELDS])
+      buffer.seek(0)
+      # the raw psycopg2 connection of the session, so the COPY belongs to the same transaction as the counts
+      cursor = db.session.connection().connection.cursor()
+      cursor.copy_expert(f"COPY questions ({', '.join(IMPORT_FIELDS)}) FROM STDIN WITH CSV", buffer)
+    else:
+      db.session.execute(Question.__table__.insert(), rows)
+
+    counts = {}
+    for row in rows:
+      counts[row['category']] = counts.get(row['category'], 0) + 1
+    # in the order of the categories, like any other transaction changing several counts
+    for category, count in sorted(counts.items()):
+      QuestionCount.add(category, count)
+    # the ids of the copied rows aren't known, one change tells the readers to fetch the questions again
+    QuestionChange.record('reload')
+    db.session.commit()
+  except Exception:
+    # the session stays usable for the request, and the version bumped by the chunk was never committed
+    db.session.rollback()
+    TableVersion.forget_bumps()
+    raise
+
+
+'''
+import_questions(lines, format, categories)
+    the import pipeline shared by POST /questions/bulk and flask import-questions:
+    the rows are validated and inserted by chunks of batch_size, each chunk in its own transaction
+    a chunk that fails is rolled back, its rows are rejected with one error for its first line and the import goes on
+    with the next chunk, the chunks committed before it are kept
+    returns (number of inserted questions, number of rejected rows, [{"line": ..., "message": ...}] of the first rejected rows)
+'''
+def import_questions(lines, format, categories, batch_size):
+  inserted = 0
+  rejected = 0
+  errors = []
+  batch = []
+  # line numbers of the first and the last row of the batch
+  first_line = last_line = None
+
+  def insert():
+    nonlocal inserted, rejected
+    try:
+      insert_batch(batch)
+      inserted += len(batch)
+    except Exception:
+      # the error of the database stays in the logs of the server, the client only learns which lines were lost
+      logger.exception('the chunk of lines %s to %s of the import failed', first_line, last_line)
+      rejected += len(batch)
+      if len(errors) < BULK_MAX_ERRORS:
+        errors.append({'line': first_line, 'message': f'lines {first_line} to {last_line} were not inserted, '
+                                                      'the database refused their chunk'})
+
+  for line_number, row in read_rows(lines, format):
+    try:
+      batch.append(validate(row, categories))
+    except ValueError as error:
+      rejected += 1
+      if len(errors) < BULK_MAX_ERRORS:
+        errors.append({'line': line_number, 'message': str(error)})
+      continue
+    if first_line is None:
+      first_line = line_number
+    last_line = line_number
+    if len(batch) >= batch_size:
+      insert()
+      batch = []
+      first_line = None
+  if batch:
+    insert()
+
+  # the new ids are not known one by one, the in memory indexes reload the questions instead
+  if inserted:
+    notify_question_listeners('reload', None)
+  return inserted, rejected, errors
+
+
+'''
+export_questions(format)
+    yields the questions ordered by id as NDJSON or CSV text, batch_size rows at a time
+    the rows are read through a server side cursor, so the memory used doesn't grow with the bank
+'''
+def export_questions(format, batch_size):
+  query = db.session.query(*[getattr(Question, field) for field in EXPORT_FIELDS]) \
+    .order_by(Question.id).execution_options(stream_results=True).yield_per(batch_size)
+
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  if format == 'csv':
+    writer.writerow(EXPORT_FIELDS)
+
+  for number, row in enumerate(query, start=1):
+    if format == 'csv':
+      writer.writerow(row)
+    else:
+      buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n')
+    if number % batch_size == 0:
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+  yield buffer.getvalue()
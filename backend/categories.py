@@ -0,0 +1,68 @@
+import hashlib
+import json
+import threading
+import time
+
+from replicas import on_primary
+from models import Category
+
+'''
+CategoryCache
+    the {id: type} map of the categories, loaded once and shared by every endpoint that needs it
+    - version goes up every time the content of the map changes
+    - etag is a hash of the content, so every worker process gives the same etag for the same categories
+    the map is replaced as a whole on reload, never modified in place, so a reader can keep using the one it got
+    after ttl seconds the map is reloaded from the database, so categories written by other worker processes show up too
+'''
+class CategoryCache:
+
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.categories = None
+    self.etag = None
+    self.version = 0
+    self.loaded_at = 0
+    self.lock = threading.RLock()
+
+  def load(self):
+    # loaded from the primary, a lagging replica would be kept in memory until the next reload
+    with on_primary():
+      rows = Category.query.order_by(Category.id).all()
+    categories = {category.id: category.type for category in rows}
+    etag = hashlib.sha1(json.dumps(sorted(categories.items())).encode('utf-8')).hexdigest()
+    with self.lock:
+      if etag != self.etag:
+        self.version += 1
+      self.categories = categories
+      self.etag = etag
+      self.loaded_at = time.monotonic()
+
+  def invalidate(self):
+    with self.lock:
+      self.categories = None
+
+  def needs_load(self):
+    return self.categories is None or time.monotonic() - self.loaded_at > self.ttl
+
+  def ensure_loaded(self):
+    if self.needs_load():
+      self.load()
+
+  def get_all(self):
+    """the {id: type} map of all the categories ordered by id"""
+    with self.lock:
+      self.ensure_loaded()
+      return self.categories
+
+  def get_etag(self):
+    with self.lock:
+      self.ensure_loaded()
+      return self.etag
+
+  def get_type(self, category_id):
+    """the type of a category, None if it doesn't exist"""
+    return self.get_all().get(category_id)
+
+  def on_category_change(self, action, category):
+    # categories change too rarely to patch the map, it is reloaded on the next read
+    self.invalidate()
@@ -0,0 +1,141 @@
+import asyncio
+import math
+import threading
+import time
+
+from sqlalchemy import func
+
+from models import db, Question, QuestionChange
+from serialization import QUESTION_FIELDS, format_row
+
+# changes sent by one response of GET /changes at most, the client asks again from the last_seq it got
+CHANGES_PAGE_SIZE = 100
+
+CHANGE_FIELDS = ('seq', 'action', 'question_id', 'category', 'previous_category')
+
+
+def change_query(args, max_wait):
+  """(since, wait) of the query string of GET /changes, raises ValueError when they aren't numbers"""
+  since = int(args.get('since', 0))
+  wait = float(args.get('wait', max_wait))
+  if since < 0 or math.isnan(wait):
+    raise ValueError('since and wait are positive numbers')
+  return since, min(max(wait, 0), max_wait)
+
+
+'''
+change_rows(since, limit)
+    the changes of the log after since, in the order of their seq, each one followed by the columns of its question
+    as it is now (NULLs once the question is deleted), so a reader doesn't fetch the questions one by one
+'''
+def change_rows(since, limit=CHANGES_PAGE_SIZE):
+  columns = [getattr(QuestionChange, field) for field in CHANGE_FIELDS] + \
+    [getattr(Question, field) for field in QUESTION_FIELDS]
+  rows = db.session.query(*columns).outerjoin(Question, Question.id == QuestionChange.question_id) \
+    .filter(QuestionChange.seq > since).order_by(QuestionChange.seq).limit(limit).all()
+  if trim_suspected(rows, since):
+    rows = reload_if_trimmed(rows, since, db.session.query(func.min(QuestionChange.seq)).scalar())
+  return rows
+
+
+def trim_suspected(rows, since):
+  """True when the first change after since isn't the next seq, the log may have been trimmed past since"""
+  return bool(rows) and rows[0][0] > since + 1
+
+
+'''
+reload_if_trimmed(rows, since, oldest)
+    the rows of change_rows() for a reader whose since is older than the oldest change left in the log (see
+    QuestionChange): the changes it missed were deleted, so a 'reload' change comes first and the reader fetches the
+    questions again before it applies the next ones. A gap of the seqs (a rolled back write) right after the trimmed
+    ones sends a reload that wasn't needed, never a missed change
+'''
+def reload_if_trimmed(rows, since, oldest):
+  if oldest is None or since >= oldest - 1:
+    return rows
+  reload = (oldest - 1, 'reload') + (None,) * (len(CHANGE_FIELDS) - 2 + len(QUESTION_FIELDS))
+  return [reload] + list(rows[:-1] if len(rows) >= CHANGES_PAGE_SIZE else rows)
+
+
+def format_change(row):
+  """the dict of a row of change_rows(), question is None for a deleted question and for a reload"""
+  change = dict(zip(CHANGE_FIELDS, row))
+  question = row[len(CHANGE_FIELDS):]
+  change['question'] = None if question[0] is None else format_row(question)
+  return change
+
+
+'''
+ChangeFeed(poll_seconds, max_waiters)
+    long polling of GET /changes: a request without changes after its seq waits for the next commit
+    - the commits of this process wake the requests up right away (on_question_change is a question listener)
+    - the ones of the other processes are seen by reading the log again every poll_seconds
+    - no connection is held while a request waits
+    - a waiting request of the Flask app holds its thread, beyond max_waiters of them (0 is no limit) the next ones
+      are answered without waiting, the clients ask again. The async mode doesn't hold threads and isn't limited
+'''
+class ChangeFeed:
+
+  def __init__(self, poll_seconds, max_waiters=0):
+    self.poll_seconds = poll_seconds
+    self.max_waiters = max_waiters
+    # requests waiting in wait()
+    self.waiting = 0
+    self.condition = threading.Condition()
+    # changes committed by this process, a waiter is woken up when it moves
+    self.committed = 0
+    # (loop, asyncio.Event) of the requests waiting in the async mode (asgi.py)
+    self.async_waiters = set()
+
+  def on_question_change(self, action, question):
+    with self.condition:
+      self.committed += 1
+      self.condition.notify_all()
+      waiters = list(self.async_waiters)
+    for loop, event in waiters:
+      loop.call_soon_threadsafe(event.set)
+
+  def wait(self, since, timeout):
+    """the changes after since, waiting up to timeout seconds for the first one when there is none yet"""
+    with self.condition:
+      waits = timeout > 0 and (not self.max_waiters or self.waiting < self.max_waiters)
+      if waits:
+        self.waiting += 1
+    deadline = time.monotonic() + (timeout if waits else 0)
+    try:
+      while True:
+        committed = self.committed
+        rows = change_rows(since)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+          return [format_change(row) for row in rows]
+        # the connection goes back to the pool while the request waits
+        db.session.close()
+        with self.condition:
+          self.condition.wait_for(lambda: self.committed != committed, min(remaining, self.poll_seconds))
+    finally:
+      if waits:
+        with self.condition:
+          self.waiting -= 1
+
+  async def wait_async(self, fetch, since, timeout):
+    """same as wait() for the async mode, fetch(since) is a coroutine returning the rows of change_rows()"""
+    deadline = time.monotonic() + timeout
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with self.condition:
+      self.async_waiters.add(waiter)
+    try:
+      while True:
+        # cleared before reading, a commit between the read and the wait still wakes it up
+        waiter[1].clear()
+        rows = await fetch(since)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+          return [format_change(row) for row in rows]
+        try:
+          await asyncio.wait_for(waiter[1].wait(), min(remaining, self.poll_seconds))
+        except asyncio.TimeoutError:
+          pass
+    finally:
+      with self.condition:
+        self.async_waiters.discard(waiter)
@@ -0,0 +1,146 @@
+import os
+import tempfile
+
+from models import DB_PATH
+
+
+def env_flag(name, default):
+  return os.getenv(name, default).lower() in ('1', 'true', 'yes')
+
+
+def env_mapping(name):
+  """{key: value} of a comma separated list of key=value in the environment"""
+  pairs = [pair.split('=', 1) for pair in os.getenv(name, '').split(',') if '=' in pair]
+  return {key.strip(): value.strip() for key, value in pairs if key.strip()}
+
+
+'''
+Config
+    default settings of the app, read from the environment. create_app loads them first, then the python file
+    named by TRIVIA_SETTINGS (DB_POOL_SIZE = 20, ...) and last the test_config given to create_app
+'''
+class Config:
+  SQLALCHEMY_DATABASE_URI = DB_PATH
+  SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+  # connections kept open by every worker process, plus the ones opened when they are all busy
+  # a gunicorn deployment opens up to workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections
+  DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+  DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+  # seconds a request waits for a free connection before failing
+  DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+  # connections older than this many seconds are replaced, before the server or a proxy drops them
+  DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+  # checks a connection with a SELECT 1 before using it, so a restarted database doesn't fail the first requests
+  DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', 'true')
+  # milliseconds a statement may run before postgres cancels it, 0 for no limit
+  DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+  # prepared statements cached by every asyncpg connection of the async mode
+  DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 100))
+  # behind PgBouncer in transaction mode: PgBouncer pools the connections, no prepared statement
+  # and no startup parameter are used (set statement_timeout on the database role instead)
+  DB_PGBOUNCER = env_flag('DB_PGBOUNCER', 'false')
+  # creates the missing tables when the app starts, turn it off once the schema exists (flask init-db creates it)
+  DB_CREATE_ALL = env_flag('DB_CREATE_ALL', 'true')
+
+  # the SQLite databases (embedded.py): journal mode and synchronous ('' keeps the ones of the file, for a read only
+  # file not in WAL yet), bytes mapped in memory, KiB of page cache of every connection, milliseconds a writer waits
+  # for the lock and ON DELETE of the foreign keys
+  SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'wal')
+  SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'normal')
+  SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+  SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+  SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+  SQLITE_FOREIGN_KEYS = env_flag('SQLITE_FOREIGN_KEYS', 'true')
+  # pg_dump (trivia.psql) whose categories and questions are loaded into the database at startup when it is empty,
+  # for the edge nodes and the tests on SQLite
+  EMBEDDED_SEED = os.getenv('EMBEDDED_SEED', '')
+
+  # read replicas of the database, comma separated in the environment. The read-only endpoints query them in turn,
+  # a replica which can't be reached is skipped for DB_REPLICA_RETRY_SECONDS, and a client who wrote reads from
+  # the primary for DB_REPLICA_STICKY_SECONDS so it sees its own writes
+  DB_REPLICA_URIS = [uri.strip() for uri in os.getenv('DB_REPLICA_URIS', '').split(',') if uri.strip()]
+  DB_REPLICA_STICKY_SECONDS = int(os.getenv('DB_REPLICA_STICKY_SECONDS', 5))
+  DB_REPLICA_RETRY_SECONDS = int(os.getenv('DB_REPLICA_RETRY_SECONDS', 30))
+
+  # write-behind of POST /questions: the new questions are committed by a writer thread, in one transaction for
+  # all the ones that arrive within DB_WRITE_BATCH_DELAY_MS (up to DB_WRITE_BATCH_SIZE), see write_batch.py
+  DB_WRITE_BATCHING = env_flag('DB_WRITE_BATCHING', 'false')
+  DB_WRITE_BATCH_DELAY_MS = int(os.getenv('DB_WRITE_BATCH_DELAY_MS', 20))
+  DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', 100))
+  # questions waiting for the writer, the next ones are committed by their request right away
+  DB_WRITE_QUEUE_SIZE = int(os.getenv('DB_WRITE_QUEUE_SIZE', 1000))
+
+  # rows of the bulk import and export read, inserted and committed together (see bulk.py), an import that fails
+  # keeps the chunks committed before it
+  BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', 1000))
+
+  # question banks of the tenants served by the same processes, tenant=database uri comma separated in the environment
+  # a request names its tenant with a subdomain of TENANT_DOMAIN or the TENANT_HEADER header, the requests which
+  # don't name one use SQLALCHEMY_DATABASE_URI. Every tenant has its own pool of DB_POOL_SIZE connections
+  TENANT_DATABASE_URIS = env_mapping('TENANT_DATABASE_URIS')
+  TENANT_HEADER = os.getenv('TENANT_HEADER', 'X-Tenant')
+  TENANT_DOMAIN = os.getenv('TENANT_DOMAIN', '')
+  # seconds after which a worker reloads the categories from the database, for the ones written by the other workers
+  CATEGORY_CACHE_TTL = int(os.getenv('CATEGORY_CACHE_TTL', 300))
+  # tenants whose in memory caches (categories, quiz index, search index) a worker keeps, the least recently used go first
+  TENANT_CACHE_MAX_TENANTS = int(os.getenv('TENANT_CACHE_MAX_TENANTS', 32))
+  # bytes of JSON the page snapshots of every tenant may take in a worker, the least recently used pages of the
+  # tenant are dropped beyond it, 0 disables the page cache (see page_cache.py)
+  PAGE_CACHE_MAX_BYTES = int(os.getenv('PAGE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+
+  # the bodies smaller than COMPRESS_MIN_SIZE bytes are sent as they are, compressing them saves less than it costs
+  COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+  # 1 (fastest) to 9 (smallest)
+  COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+  # 0 (fastest) to 11 (smallest), the highest ones are made for static files
+  COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+  # how long the clients may reuse /categories and a list of questions before asking again with If-None-Match
+  CATEGORIES_MAX_AGE = int(os.getenv('CATEGORIES_MAX_AGE', 60))
+  QUESTIONS_MAX_AGE = int(os.getenv('QUESTIONS_MAX_AGE', 0))
+
+  # quiz sessions of /quizzes/sessions, kept by every worker ("memory") or shared by the workers in a redis url like
+  # redis://localhost:6379/0. A session expires after QUIZ_SESSION_TTL seconds without a question, and a worker keeps
+  # QUIZ_SESSION_MAX_SESSIONS of them at most, the least recently used go first
+  QUIZ_SESSION_STORE = os.getenv('QUIZ_SESSION_STORE', 'memory')
+  QUIZ_SESSION_TTL = int(os.getenv('QUIZ_SESSION_TTL', 3600))
+  QUIZ_SESSION_MAX_SESSIONS = int(os.getenv('QUIZ_SESSION_MAX_SESSIONS', 10000))
+
+  # GET /changes waits up to CHANGES_MAX_WAIT_SECONDS for a write when there is no change after ?since=, and reads
+  # the log again every CHANGES_POLL_SECONDS for the writes of the other processes (the ones of its own process
+  # wake it up right away)
+  CHANGES_MAX_WAIT_SECONDS = float(os.getenv('CHANGES_MAX_WAIT_SECONDS', 25))
+  CHANGES_POLL_SECONDS = float(os.getenv('CHANGES_POLL_SECONDS', 1))
+  # requests of GET /changes waiting at once in a process of the Flask app, each one holds a thread: the next ones
+  # are answered right away (0 lets them all wait). The async mode waits on coroutines and has no limit
+  CHANGES_MAX_WAITERS = int(os.getenv('CHANGES_MAX_WAITERS', 8))
+  # changes kept in the log, the older ones are deleted as the writes go (0 keeps them all)
+  CHANGES_MAX_ROWS = int(os.getenv('CHANGES_MAX_ROWS', 100000))
+
+  # token buckets of every client on the expensive routes, POST /quizzes and the searches of POST /questions: a client
+  # may send BURST requests at once then PER_SECOND requests a second, the next ones get a 429, a rate of 0 is no
+  # limit. The buckets are kept by every worker, or shared by the workers in the redis of RATE_LIMIT_STORE
+  RATE_LIMIT_QUIZZES_PER_SECOND = float(os.getenv('RATE_LIMIT_QUIZZES_PER_SECOND', 5))
+  RATE_LIMIT_QUIZZES_BURST = int(os.getenv('RATE_LIMIT_QUIZZES_BURST', 20))
+  RATE_LIMIT_SEARCH_PER_SECOND = float(os.getenv('RATE_LIMIT_SEARCH_PER_SECOND', 2))
+  RATE_LIMIT_SEARCH_BURST = int(os.getenv('RATE_LIMIT_SEARCH_BURST', 10))
+  # "memory" or a redis url like redis://localhost:6379/0
+  RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', 'memory')
+  # behind a proxy, the header it adds the address of the client to (X-Forwarded-For), the connection is the proxy
+  RATE_LIMIT_CLIENT_HEADER = os.getenv('RATE_LIMIT_CLIENT_HEADER', '')
+  # load shedding of the same routes: a worker answers 503 while more than LOAD_SHED_MAX_IN_FLIGHT of them are running,
+  # or while their average SQL time goes over LOAD_SHED_MAX_DB_MS, 0 turns a threshold off (see limits.py)
+  LOAD_SHED_MAX_IN_FLIGHT = int(os.getenv('LOAD_SHED_MAX_IN_FLIGHT', 0))
+  LOAD_SHED_MAX_DB_MS = int(os.getenv('LOAD_SHED_MAX_DB_MS', 0))
+  # Retry-After of the 503 of the load shedding, in seconds
+  LOAD_SHED_RETRY_AFTER = int(os.getenv('LOAD_SHED_RETRY_AFTER', 1))
+
+  # profiling is off unless the server allows it, then a request asks for it with the X-Profile header ("cprofile"
+  # or "pyinstrument"), PROFILING_SAMPLE_RATE of these requests are profiled and their profiles written to PROFILE_DIR
+  PROFILING_ENABLED = env_flag('PROFILING_ENABLED', 'false')
+  PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 1))
+  PROFILE_DIR = os.getenv('PROFILE_DIR', tempfile.gettempdir())
+
+  # connections of the async pool of every worker process of the async mode (asgi.py)
+  ASYNC_POOL_MIN_SIZE = int(os.getenv('ASYNC_POOL_MIN_SIZE', 1))
+  ASYNC_POOL_MAX_SIZE = int(os.getenv('ASYNC_POOL_MAX_SIZE', 10))
@@ -0,0 +1,159 @@
+'''
+embedded SQLite backend: the whole question bank in a local file (or in memory) next to the app, for the edge
+nodes which serve the quizzes without a database server and for the tests
+    SQLALCHEMY_DATABASE_URI=sqlite:////var/lib/trivia/trivia.db EMBEDDED_SEED=trivia.psql
+
+every SQLite connection of the app is tuned by the SQLITE_* settings (see sqlite_pragmas), and a new database is
+filled from the data of a pg_dump like trivia.psql (see load_psql), so the same dump feeds postgres and the edges
+'''
+import re
+
+from sqlalchemy import Integer, event, exc, inspect, text
+
+from models import db, Category, Question, QuestionChange, QuestionCount, TableVersion
+
+# the tables of a dump loaded by load_psql, in the order of their foreign keys, the other COPY blocks are skipped
+PSQL_TABLES = {
+  'categories': Category.__table__,
+  'questions': Question.__table__,
+}
+# rows inserted by one executemany
+PSQL_BATCH_SIZE = 1000
+
+COPY_LINE = re.compile(r'COPY (?:\w+\.)?(\w+) \(([^)]*)\) FROM stdin;')
+# the backslash escapes of the text format of COPY: \NNN in octal and \xHH in hexadecimal are bytes of the encoding
+# of the dump, the letters are control characters and any other escaped character is itself
+COPY_ESCAPE = re.compile(rb'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))', re.DOTALL)
+COPY_ESCAPES = {b'b': b'\b', b'f': b'\f', b'n': b'\n', b'r': b'\r', b't': b'\t', b'v': b'\v'}
+
+
+'''
+sqlite_pragmas(config)
+    the PRAGMA statements run on every new SQLite connection of the app, the async ones of asgi.py included
+    - journal_mode=WAL: the readers don't wait for the writer nor the writer for the readers, set once in the file
+    - synchronous=NORMAL: no fsync on every commit in WAL mode, a power loss can lose the last commits but never
+      corrupts the file
+    - mmap_size: the file is read through the page cache of the OS instead of copies in the heap
+    - cache_size, temp_store: pages and temporary tables (sorts) in memory
+    - busy_timeout: a writer waits for the lock instead of failing with "database is locked"
+    - foreign_keys: the ON DELETE of the categories, like on postgres
+'''
+def sqlite_pragmas(config):
+  pragmas = []
+  if config['SQLITE_JOURNAL_MODE']:
+    pragmas.append(f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}")
+  if config['SQLITE_SYNCHRONOUS']:
+    pragmas.append(f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}")
+  pragmas += [
+    f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+    # negative: KiB instead of pages
+    f"PRAGMA cache_size={-int(config['SQLITE_CACHE_SIZE_KB'])}",
+    'PRAGMA temp_store=MEMORY',
+    f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}",
+    f"PRAGMA foreign_keys={'ON' if config['SQLITE_FOREIGN_KEYS'] else 'OFF'}",
+  ]
+  return pragmas
+
+
+def tune_sqlite(engine, config):
+  """runs the pragmas of the config on every connection the engine opens"""
+  pragmas = sqlite_pragmas(config)
+
+  @event.listens_for(engine, 'connect')
+  def set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+      for pragma in pragmas:
+        cursor.execute(pragma)
+    finally:
+      cursor.close()
+
+
+def copy_value(value, column):
+  """a value of a COPY row, typed for its column, None for \\N"""
+  if value == r'\N':
+    return None
+  if '\\' in value:
+    # unescaped as bytes, so the octal or hexadecimal bytes of a UTF-8 character give the character back
+    value = COPY_ESCAPE.sub(copy_escape, value.encode('utf-8')).decode('utf-8')
+  return int(value) if isinstance(column.type, Integer) else value
+
+
+def copy_escape(match):
+  """the bytes of a match of COPY_ESCAPE"""
+  octal, hexadecimal, character = match.groups()
+  if octal is not None:
+    # like postgres, \400 to \777 keep their low byte
+    return bytes([int(octal, 8) & 0xFF])
+  if hexadecimal is not None:
+    return bytes([int(hexadecimal, 16)])
+  return COPY_ESCAPES.get(character, character)
+
+
+def read_copy_blocks(lines):
+  """yields (table, columns, rows) for every COPY ... FROM stdin block of a dump, rows are lists of strings"""
+  lines = iter(lines)
+  for line in lines:
+    match = COPY_LINE.match(line)
+    if match is None:
+      continue
+    columns = [column.strip().strip('"') for column in match.group(2).split(',')]
+    rows = []
+    for row in lines:
+      row = row.rstrip('\n')
+      if row == '\\.':
+        break
+      rows.append(row.split('\t'))
+    yield match.group(1), columns, rows
+
+
+'''
+load_psql(lines)
+    loads the rows of the COPY blocks of a plain pg_dump (trivia.psql) into the database of the current tenant, in
+    one transaction with executemany, and returns {table: rows}. Only the categories and the questions are loaded,
+    the rest of the dump (schema, owners, sequences) is postgres only: the tables come from create_schema()
+    the counts, the version of the questions table and the change log follow, as after a bulk import, the caller
+    notifies the listeners with a 'reload'
+'''
+def load_psql(lines):
+  loaded = {}
+  try:
+    # first, so the writers queue on the version before they lock the counts (see TableVersion)
+    TableVersion.bump('questions')
+    for name, columns, rows in read_copy_blocks(lines):
+      table = PSQL_TABLES.get(name)
+      if table is None:
+        continue
+      values = [{column: copy_value(value, table.c[column]) for column, value in zip(columns, row)} for row in rows]
+      for start in range(0, len(values), PSQL_BATCH_SIZE):
+        db.session.execute(table.insert(), values[start:start + PSQL_BATCH_SIZE])
+      loaded[name] = len(values)
+      # the ids come from the dump, the next ones the database hands out follow them
+      if values and db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), max(id)) FROM {name}"))
+
+    QuestionCount.query.delete()
+    for category, count in QuestionCount.actual_counts().items():
+      db.session.add(QuestionCount(category=category, count=count))
+    QuestionChange.record('reload')
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    TableVersion.forget_bumps()
+    raise
+  return loaded
+
+
+def seed_database(path):
+  """loads the dump of path when the tables of the current tenant are empty, at startup
+  the tables come from DB_CREATE_ALL or from flask init-db, a database without them is left alone"""
+  if Question.__tablename__ not in inspect(db.session.get_bind()).get_table_names():
+    return None
+  if Question.query.first() is not None or Category.query.first() is not None:
+    return None
+  try:
+    with open(path, encoding='utf-8') as lines:
+      return load_psql(lines)
+  except exc.IntegrityError:
+    # loaded by another worker which started at the same time
+    return None
@@ -1,33 +1,47 @@
 import os
-from flask import Flask, request, abort, jsonify
+import io
+from flask import Flask, Response, g, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.orm.exc import StaleDataError
 import random
-
-from models import setup_db, Question, Category
-
-QUESTIONS_PER_PAGE = 10
+import click
+
+from config import Config
+from models import db, setup_db, create_schema, add_question_listener, add_category_listener, \
+  notify_question_listeners, notify_category_listeners, integer_value, Question, QuestionCount, Category, TableVersion
+from pagination import fetch_window, cut_page, page_number, QUESTIONS_PER_PAGE
+from quiz import QuizIndex, quiz_options, round_options
+from quiz_sessions import create_session_store, QUIZ_SESSION_MAX_QUESTIONS
+from search import QuestionSearch
+from categories import CategoryCache
+from serialization import question_rows, get_question_row, get_question_rows, format_row, format_rows, json_response
+from instrumentation import Instrumentation
+from replicas import on_primary, on_replica, read_replica, remember_write
+from bulk import import_questions, export_questions, format_of_mimetype, FORMATS
+from backfill import backfill_categories, BACKFILL_BATCH_SIZE
+from http_cache import compress_response, list_etag, list_cache_headers
+from write_batch import WriteBatcher
+from page_cache import PageCache, page_head, page_body, page_bounds
+from changes import ChangeFeed, change_query
+from embedded import load_psql
+from limits import RateLimiter, LoadShedder, create_bucket_store, client_address, guard_route
+from tenants import TenantCaches, UnknownTenant, current_tenant, request_tenant, tenant_of, tenant_option, use_tenant, \
+  scoped_session_id, unscoped_session_id
 
 # VERY IMPORTANT:
 ## 1) PLEASE MAKE SURE TO ADJUST THE DATABASE URI BECAUSE I HAD TO CHANGE IT TO MAKE IT WORK ON MY PC
 
-def paginate(request, questions_list):
-  """to structure the questions in multiple pages"""
-  page = request.args.get('page', 1, type=int)
-  start = (page - 1) * QUESTIONS_PER_PAGE
-  end = start + QUESTIONS_PER_PAGE
-  # current_index = page - 1
-
-  # questions = \
-  #   Question.query.order_by(Question.id).limit(QUESTIONS_PER_PAGE).offset(current_index * QUESTIONS_PER_PAGE).all()
-  formatted_questions = [question.format() for question in questions_list]
-
-  return formatted_questions[start: end]
-
-
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
+  # defaults from the environment, then the settings file named by TRIVIA_SETTINGS, then test_config
+  app.config.from_object(Config)
+  app.config.from_envvar('TRIVIA_SETTINGS', silent=True)
+  if isinstance(test_config, dict):
+    app.config.from_mapping(test_config)
+  elif test_config is not None:
+    app.config.from_object(test_config)
   setup_db(app)
   
   '''
@@ -35,34 +49,201 @@ def create_app(test_config=None):
   '''
   cors = CORS(app, resources={r'/*': {'origins': '*'}})
 
+  # the in memory caches below are kept for every tenant apart, for the TENANT_CACHE_MAX_TENANTS last tenants
+  max_tenants = app.config['TENANT_CACHE_MAX_TENANTS']
+  # in memory ids of the questions by category, kept up to date by the writes on the questions
+  quiz_index = TenantCaches(QuizIndex, max_tenants)
+  add_question_listener(app, quiz_index.listener('on_question_change'))
+  # pre shuffled question ids of the quizzes played with /quizzes/sessions
+  quiz_sessions = create_session_store(app.config)
+  # full text search of the questions and the answers
+  question_search = TenantCaches(QuestionSearch, max_tenants)
+  add_question_listener(app, question_search.listener('on_question_change'))
+  # {id: type} map of the categories shared by all the endpoints, reloaded after a write on a category
+  category_cache = TenantCaches(lambda: CategoryCache(app.config['CATEGORY_CACHE_TTL']), max_tenants)
+  add_category_listener(app, category_cache.listener('on_category_change'))
+  # serialized pages of the lists of questions, PAGE_CACHE_MAX_BYTES for every tenant
+  page_cache = PageCache(app.config['PAGE_CACHE_MAX_BYTES'])
+  add_question_listener(app, page_cache.on_question_change)
+  # long polling of the log of the writes on the questions, woken up by the writes of this process
+  change_feed = ChangeFeed(app.config['CHANGES_POLL_SECONDS'], app.config['CHANGES_MAX_WAITERS'])
+  add_question_listener(app, change_feed.on_question_change)
+  # writer thread of the new questions when DB_WRITE_BATCHING is on
+  write_batcher = None
+  if app.config['DB_WRITE_BATCHING']:
+    write_batcher = WriteBatcher(app, app.config['DB_WRITE_BATCH_DELAY_MS'] / 1000, app.config['DB_WRITE_BATCH_SIZE'],
+                                 app.config['DB_WRITE_QUEUE_SIZE'])
+  # budgets of the clients and load shedding of the expensive routes, the quizzes and the searches
+  rate_limiter = RateLimiter({
+    'quizzes': (app.config['RATE_LIMIT_QUIZZES_PER_SECOND'], app.config['RATE_LIMIT_QUIZZES_BURST']),
+    'search': (app.config['RATE_LIMIT_SEARCH_PER_SECOND'], app.config['RATE_LIMIT_SEARCH_BURST']),
+  }, create_bucket_store(app.config['RATE_LIMIT_STORE']))
+  load_shedder = LoadShedder(app.config['LOAD_SHED_MAX_IN_FLIGHT'], app.config['LOAD_SHED_MAX_DB_MS'] / 1000,
+                             app.config['LOAD_SHED_RETRY_AFTER'])
+  # latency, responses and SQL statements of every endpoint, exposed at /metrics
+  instrumentation = Instrumentation(app.config['PROFILING_ENABLED'], app.config['PROFILING_SAMPLE_RATE'],
+                                    app.config['PROFILE_DIR'])
+  instrumentation.watch_cache('pages', page_cache)
+  # shared with the async serving mode (asgi.py), which answers some of the routes itself
+  app.extensions.update({
+    'quiz_index': quiz_index,
+    'quiz_sessions': quiz_sessions,
+    'question_search': question_search,
+    'category_cache': category_cache,
+    'page_cache': page_cache,
+    'change_feed': change_feed,
+    'rate_limiter': rate_limiter,
+    'load_shedder': load_shedder,
+    'instrumentation': instrumentation,
+    'write_batcher': write_batcher,
+  })
+
+  @app.cli.command('init-db')
+  @tenant_option
+  def init_db():
+    """creates the missing tables, for the deployments started with DB_CREATE_ALL=false"""
+    create_schema()
+    click.echo('the database schema is up to date')
+
+  @app.cli.command('backfill-question-categories')
+  @click.option('--batch-size', default=BACKFILL_BATCH_SIZE, show_default=True, help='questions updated per transaction')
+  @click.option('--pause', default=0.0, help='seconds to wait between two batches')
+  @tenant_option
+  def backfill_question_categories(batch_size, pause):
+    """fills questions.category_id between the two steps of the typed category migration"""
+    def progress(last_id, max_id, updated):
+      click.echo(f'{updated} questions updated, up to id {last_id} of {max_id}')
+    updated, orphans = backfill_categories(db.session.get_bind(), batch_size, pause, progress)
+    click.echo(f'{updated} questions backfilled')
+    if orphans:
+      click.echo(f'{orphans} questions have a category which does not exist, they will have no category')
+
+  @app.cli.command('create-search-index')
+  @tenant_option
+  def create_search_index():
+    """creates the full text search index of the questions"""
+    question_search.create_index()
+
+  @app.cli.command('check-question-counts')
+  @click.option('--rebuild', is_flag=True, help='recompute the counts from the questions table')
+  @tenant_option
+  def check_question_counts(rebuild):
+    """compares the maintained question counts with the questions table"""
+    wrong_counts = QuestionCount.check()
+    for category, (stored, actual) in sorted(wrong_counts.items()):
+      click.echo(f'category {category}: {stored} counted, {actual} in the questions table')
+    if not wrong_counts:
+      click.echo('the question counts are consistent')
+    elif rebuild:
+      QuestionCount.rebuild()
+      click.echo('the question counts were rebuilt')
+
+  @app.cli.command('import-questions')
+  @click.argument('file', type=click.File('r', encoding='utf-8'))
+  @click.option('--format', 'file_format', type=click.Choice(sorted(FORMATS)),
+                help='format of the file, guessed from its extension by default')
+  @tenant_option
+  def import_questions_command(file, file_format):
+    """imports the questions of a NDJSON or CSV file, - for the standard input"""
+    if file_format is None:
+      file_format = 'csv' if file.name.endswith('.csv') else 'ndjson'
+    inserted, rejected, errors = import_questions(file, file_format, category_keys(), app.config['BULK_BATCH_SIZE'])
+    for error in errors:
+      click.echo(f"line {error['line']}: {error['message']}")
+    click.echo(f'{inserted} questions imported, {rejected} rejected')
+
+  @app.cli.command('load-psql')
+  @click.argument('file', type=click.File('r', encoding='utf-8'))
+  @tenant_option
+  def load_psql_command(file):
+    """loads the categories and the questions of a pg_dump (trivia.psql) into an empty database, SQLite included"""
+    create_schema()
+    if Question.query.first() is not None or Category.query.first() is not None:
+      raise click.ClickException('the database already has questions, the dump is loaded into an empty database')
+    loaded = load_psql(file)
+    notify_category_listeners('reload', None)
+    notify_question_listeners('reload', None)
+    click.echo(f"{loaded.get('categories', 0)} categories and {loaded.get('questions', 0)} questions loaded")
+
+  def category_keys():
+    return set(category_cache.get_all())
+
   '''
   @DONE: Use the after_request decorator to set Access-Control-Allow
   '''
+  @app.before_request
+  def before_request():
+    # the engine of the database is created by the first request, not when the worker boots
+    if instrumentation.pool is None:
+      instrumentation.watch_pool(db.get_engine(app).pool)
+    instrumentation.start_request()
+    # the question bank of the request, the tenants which aren't configured don't exist
+    g.tenant_token = request_tenant.set(None)
+    try:
+      request_tenant.set(tenant_of(request.headers, request.host, app.config))
+    except UnknownTenant:
+      abort(404)
+
+  @app.teardown_request
+  def teardown_request(error):
+    if g.pop('load_shed_admitted', False):
+      load_shedder.release(g.get('sql_seconds', 0))
+    if 'tenant_token' in g:
+      request_tenant.reset(g.pop('tenant_token'))
+
   @app.after_request
   def after_request(response):
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,POST,DELETE,OPTIONS')
-    return response
+    response.headers.add('Access-Control-Allow-Methods', 'GET,POST,PATCH,DELETE,OPTIONS')
+    remember_write(response)
+    # the same URL gives the question bank of another tenant with another header
+    if app.config['TENANT_DATABASE_URIS']:
+      response.vary.add(app.config['TENANT_HEADER'])
+    # the CORS headers above are kept, the body is compressed when the client accepts it
+    compress_response(response, request.headers.get('Accept-Encoding'), app.config)
+    return instrumentation.finish_request(response)
+
+  def guard(route):
+    """429 when the client used up its budget of the route, 503 while the worker sheds the load"""
+    # a view retried on another replica was already admitted
+    if g.get('load_shed_admitted', False):
+      return
+    guard_route(rate_limiter, load_shedder, route, client_address(request.headers, request.remote_addr, app.config))
+    # released by teardown_request, with the SQL time of the request
+    g.load_shed_admitted = True
+
+  @app.route('/metrics', methods=['GET'])
+  def metrics():
+    return Response(instrumentation.render(), mimetype='text/plain; version=0.0.4')
   '''
   @DONE: 
   Create an endpoint to handle GET requests 
   for all available categories.
   '''
   @app.route('/categories', methods=["GET"])
+  @read_replica
   def get_categories():
 
-    categories_list = Category.query.order_by(Category.id).all()
+    categories = category_cache.get_all()
+    etag = category_cache.get_etag()
 
     # in case no categories exist in the database
-    if len(categories_list) == 0:
+    if len(categories) == 0:
       abort(404)
-    # format the categories in 2 steps to obtain a dictionary with {id: type} format
-    list_formatted_categories = [category.format() for category in categories_list]
-    dict_formatted_categories = {category['id']: category['type']for category in list_formatted_categories}
-    return jsonify({
-      "success": True,
-      "categories": dict_formatted_categories
-    })
+
+    # the client already has these categories, nothing to send back
+    if request.if_none_match.contains_weak(etag):
+      response = app.response_class(status=304)
+    else:
+      response = jsonify({
+        "success": True,
+        "categories": categories
+      })
+    # weak, the body may be compressed
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['CATEGORIES_MAX_AGE']
+    return response
 
 
 
@@ -82,30 +263,59 @@ def create_app(test_config=None):
   '''
 
   @app.route("/questions", methods=['GET'])
+  @read_replica
   def get_all_questions():
+    # the client already has this page, the questions and the categories didn't change since
+    version, categories_etag = list_versions()
+    etag = list_etag(version, categories_etag, current_tenant())
+    if request.if_none_match.contains_weak(etag):
+      return not_modified(etag)
+
+    def payload(questions_to_show, next_cursor):
+      return {
+        "success": True,
+        "questions": questions_to_show,
+        "categories": category_cache.get_all(),
+        "current_category": "1",
+        "next_cursor": next_cursor
+      }
+    body = list_body(None, version, categories_etag, question_rows(), payload, QuestionCount.total)
+    response = app.response_class(body, mimetype='application/json')
+    response.headers.extend(list_cache_headers(etag, app.config))
+    return response
 
-    # get all the questions ordered from the database and paginate them
-    db_questions = Question.query.order_by(Question.id).all()
-
-    questions_to_show = paginate(request, db_questions)
-
-    # in case no questions exist in the database or in the requested page
-    if len(questions_to_show) == 0:
-      abort(404)
-
-
-    # get all the categories ordered from the database and format them in { id: type } format
-    categories = Category.query.order_by(Category.id).all()
-    formatted_categories = [category.format() for category in categories]
-    dict_formatted_categories = {category['id']: category['type']for category in formatted_categories}
-
-    return jsonify({
-      "success": True,
-      "questions": questions_to_show,
-      "total_questions": len(db_questions),
-      "categories": dict_formatted_categories,
-      "current_category": "1"
-    })
+  def list_versions():
+    """(version of the questions, etag of the categories) behind the ETag and the page cache, one query"""
+    # the etag is read before the categories, a page built with newer categories than its etag is only missed
+    return TableVersion.of('questions'), category_cache.get_etag()
+
+  def list_body(category, version, categories_etag, query, payload, count):
+    '''
+    the JSON of a page of questions, from the page cache for the ?page=<n> pages it has
+    payload(questions, next_cursor) gives the keys of the response but total_questions, count() gives the total
+    '''
+    page = page_number(request.args)
+    head = None if page is None else page_cache.get(category, page, version, categories_etag)
+    if head is None:
+      # get only the requested page of questions from the database, ordered by id
+      rows = fetch_window(request, query, Question.id)
+      db_questions, next_cursor = cut_page(rows)
+
+      # in case no questions exist in the database, in the requested page or in the category
+      if len(db_questions) == 0:
+        abort(404)
+      head = page_head(payload(format_rows(db_questions), next_cursor))
+      if page is not None:
+        page_cache.put(category, page, version, categories_etag, head, page_bounds(rows))
+
+    total = page_cache.get_total(category, version)
+    if total is None:
+      total = count()
+      page_cache.put_total(category, version, total)
+    return page_body(head, total)
+
+  def not_modified(etag):
+    return app.response_class(status=304, headers=list_cache_headers(etag, app.config))
 
 
 
@@ -126,12 +336,63 @@ def create_app(test_config=None):
     if question_to_delete is None:
       abort(422)
     question_to_delete.delete()
-    number_of_questions = len(Question.query.all())
+    number_of_questions = QuestionCount.total()
     return jsonify({
       'success': True,
       'number_of_questions': number_of_questions
     })
 
+  '''
+  Edit a question in place: the client sends the fields to change and the version of the question it read.
+  An editor who read an older version gets a 409 and reads the question again, nothing is locked meanwhile.
+  '''
+  @app.route('/questions/<int:question_id>', methods=['PATCH'])
+  def update_question(question_id):
+    request_body = request.get_json()
+    if not isinstance(request_body, dict):
+      abort(400)
+
+    version = request_body.get('version', None)
+    changes = {field: request_body[field] for field in ('question', 'answer', 'category', 'difficulty')
+               if field in request_body}
+    # in case the user doesn't give the version read or anything to change
+    if not isinstance(version, int) or isinstance(version, bool) or not changes:
+      abort(400)
+    if any(not isinstance(changes[field], str) or not changes[field].strip()
+           for field in ('question', 'answer') if field in changes):
+      abort(400)
+    # integers sent as numbers or as strings ("3"), not as booleans or with a fraction
+    try:
+      for field in ('category', 'difficulty'):
+        if field in changes:
+          changes[field] = integer_value(changes[field])
+    except ValueError:
+      abort(400)
+    # in case the category doesn't exist
+    if 'category' in changes and category_cache.get_type(changes['category']) is None:
+      abort(422)
+
+    question = Question.query.filter(Question.id == question_id).one_or_none()
+    # in case the id entered by the user doesn't belong to any question
+    if question is None:
+      abort(422)
+    # in case the question was changed since the client read it
+    if question.version != version:
+      abort(409)
+
+    for field, value in changes.items():
+      setattr(question, field, value)
+    try:
+      question.update()
+    except StaleDataError:
+      # another editor committed between the read above and the update
+      db.session.rollback()
+      abort(409)
+    return jsonify({
+      'success': True,
+      'question': question.format()
+    })
+
 
 
 
@@ -150,17 +411,23 @@ def create_app(test_config=None):
   # to simplify the function of the route /questions which will have both functionalities of search and add question
   # i will use 2 functions and then include them with if statements in the route function
   def search(search_term):
-    all_questions = Question.query.all()
-    questions_found = Question.query.filter(Question.question.ilike(f'%{search_term}%')).all()
-    questions_to_show = paginate(request, questions_found)
+    guard('search')
+    page = request.args.get('page', 1, type=int)
+    question_ids, total_results = question_search.search(search_term, page, QUESTIONS_PER_PAGE)
 
     # in case no question matches the search term or the page number desired is too big
-    if len(questions_found) == 0:
+    if len(question_ids) == 0:
       abort(404)
-    return jsonify({
+
+    # only the questions of the page are loaded, then put back in the order of the ranking
+    questions_found = {row.id: row for row in question_rows().filter(Question.id.in_(question_ids))}
+    questions_to_show = [format_row(questions_found[question_id]) for question_id in question_ids
+                         if question_id in questions_found]
+    return json_response({
       'success': True,
       'questions': questions_to_show,
-      'total_questions': len(all_questions),
+      'total_questions': QuestionCount.total(),
+      'total_results': total_results,
       'current_category': "1"
     })
 
@@ -170,12 +437,30 @@ def create_app(test_config=None):
     if question is None or answer is None or difficulty is None or category is None:
       abort(400)
 
-    new_question = Question(question, answer, category, difficulty)
-    new_question.insert()
-    number_of_questions = len(Question.query.all())
+    # the category is the id of a category and the difficulty a number, both sent as numbers or as strings ("3"),
+    # converted so the question kept by the listeners (the quiz index) has the types of the database
+    try:
+      category = integer_value(category)
+      difficulty = integer_value(difficulty)
+    except ValueError:
+      abort(400)
+    # in case the category doesn't exist
+    if category_cache.get_type(category) is None:
+      abort(422)
+
+    if write_batcher is not None:
+      question_id = write_batcher.insert(question, answer, category, difficulty)
+      # committed by the writer thread, the client still has to read its own write from the primary
+      g.db_wrote = True
+    else:
+      new_question = Question(question, answer, category, difficulty)
+      new_question.insert()
+      question_id = new_question.id
+    number_of_questions = QuestionCount.total()
 
     return jsonify({
       'success': True,
+      'question_id': question_id,
       'number_of_questions': number_of_questions
     })
 
@@ -192,8 +477,65 @@ def create_app(test_config=None):
 
     if search_term is None:
       return add(request_body, question, answer, difficulty, category)
-    else:
-      return search(search_term)
+    # in case the search term isn't a string (a number, a list...), the search can't match it
+    if not isinstance(search_term, str):
+      abort(400)
+    return search(search_term)
+
+
+
+  '''
+  Bulk import and export of the questions, as NDJSON (one question object per line) or CSV
+  '''
+  @app.route('/questions/bulk', methods=['POST'])
+  def bulk_import_questions():
+    file_format = format_of_mimetype(request.mimetype)
+    # in case the body is neither NDJSON nor CSV
+    if file_format is None:
+      abort(400)
+
+    # the body is read line by line, never loaded as a whole
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8')
+    inserted, rejected, errors = import_questions(lines, file_format, category_keys(), app.config['BULK_BATCH_SIZE'])
+    return jsonify({
+      'success': True,
+      'inserted': inserted,
+      'rejected': rejected,
+      'errors': errors,
+      'number_of_questions': QuestionCount.total()
+    })
+
+  @app.route('/questions/export', methods=['GET'])
+  def bulk_export_questions():
+    file_format = request.args.get('format', 'ndjson', type=str)
+    if file_format not in FORMATS:
+      abort(400)
+
+    rows = export_questions(file_format, app.config['BULK_BATCH_SIZE'])
+    response = Response(stream_with_context(rows), mimetype=FORMATS[file_format])
+    response.headers['Content-Disposition'] = f'attachment; filename=questions.{file_format}'
+    return response
+
+  '''
+  Feed of the writes on the questions, for the caches and the processes which follow them: the client asks for
+  the changes after the last seq it got and the request waits for the next write when there is none yet
+  '''
+  @app.route('/changes', methods=['GET'])
+  def get_changes():
+    # in case since or wait aren't numbers
+    try:
+      since, wait = change_query(request.args, app.config['CHANGES_MAX_WAIT_SECONDS'])
+    except ValueError:
+      abort(400)
+
+    changes = change_feed.wait(since, wait)
+    response = json_response({
+      'success': True,
+      'changes': changes,
+      'last_seq': changes[-1]['seq'] if changes else since
+    })
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 
 
@@ -220,25 +562,33 @@ def create_app(test_config=None):
   '''
 
   @app.route("/categories/<int:category_id>/questions", methods=['GET'])
+  @read_replica
   def get_questions_by_category(category_id):
-    category = Category.query.filter(Category.id == category_id).one_or_none()
+    category_type = category_cache.get_type(category_id)
 
     #in case the user enters a category id that doesn't exist
-    if category is None:
+    if category_type is None:
       abort(422)
 
-    category_type = category.format()['type']
-    db_questions = Question.query.order_by(Question.id).filter(Question.category == str(category_id)).all()
-    questions_to_show = paginate(request, db_questions)
+    # the client already has this page, the questions and the categories didn't change since
+    version, categories_etag = list_versions()
+    etag = list_etag(version, categories_etag, current_tenant())
+    if request.if_none_match.contains_weak(etag):
+      return not_modified(etag)
 
-    # in case no question matches the desired category
-    if len(questions_to_show) == 0:
-      abort(404)
-    return jsonify({
-      "success": True,
-      "questions": questions_to_show,
-      "category": category_type
-    })
+    def payload(questions_to_show, next_cursor):
+      return {
+        "success": True,
+        "questions": questions_to_show,
+        "category": category_type,
+        "next_cursor": next_cursor
+      }
+    category_questions = question_rows().filter(Question.category == category_id)
+    body = list_body(category_id, version, categories_etag, category_questions, payload,
+                     lambda: QuestionCount.of_category(category_id))
+    response = app.response_class(body, mimetype='application/json')
+    response.headers.extend(list_cache_headers(etag, app.config))
+    return response
 
 
   '''
@@ -253,7 +603,9 @@ def create_app(test_config=None):
   and shown whether they were correct or not. 
   '''
   @app.route('/quizzes', methods=['POST'])
+  @read_replica
   def play_the_game():
+    guard('quizzes')
     request_body = request.get_json()
     # if the user doesnt give a request
     if request_body is None:
@@ -266,31 +618,168 @@ def create_app(test_config=None):
     if quiz_category is None or previous_questions is None:
       abort(400)
 
-    if quiz_category['id'] != 0:
-      questions = Question.query.filter(Question.category == quiz_category['id']).all()
-    else:
-      questions = Question.query.all()
+    # the category is an object like {"id": 1, "type": "Science"}
+    if not isinstance(quiz_category, dict):
+      abort(400)
+
+    # the ids of the previous questions are used for a binary search so they have to be numbers
+    if not isinstance(previous_questions, list) or \
+        not all(isinstance(question_id, int) for question_id in previous_questions):
+      abort(400)
+
+    # the optional difficulty band and strategy of an adaptive quiz
+    try:
+      difficulty, strategy = quiz_options(request_body)
+    except ValueError:
+      abort(400)
 
+    category_id = quiz_category.get('id', 0)
     # in case no questions are in the category or no question exist altogether in the database
-    if len(questions) == 0:
+    if quiz_index.size(category_id, difficulty) == 0:
       abort(404)
 
-    # in case the questions of a category are less than 5
-    if len(questions) == len(previous_questions):
-      return jsonify({
-        "success": True,
-        "state": "end_of_game"
-      })
-    random_question = random.choice(questions).format()
-    while random_question['id'] in previous_questions:
-      random_question = random.choice(questions).format()
-
-    return jsonify({
+    while True:
+      question_id, remaining = quiz_index.sample(category_id, previous_questions, difficulty, strategy)
+
+      # in case all the questions of the category were already asked
+      if remaining == 0:
+        return jsonify({
+          "success": True,
+          "state": "end_of_game"
+        })
+
+      question = get_question_row(question_id)
+      if question is None and on_replica():
+        # the index follows the primary, a question added there may not have reached the replica yet
+        with on_primary():
+          question = get_question_row(question_id)
+      # the question may have been deleted by another worker since the index was loaded
+      if question is not None:
+        break
+      quiz_index.discard(question_id)
+    random_question = format_row(question)
+
+    return json_response({
       "success": True,
       "question": random_question
     })
 
 
+  '''
+  A whole round of a quiz in one request: count distinct questions of the category, drawn without
+  replacement from the quiz index and fetched with one query, in the order of the draw.
+  The same seed gives the same round, to replay it or to benchmark the endpoint.
+  '''
+  @app.route('/quizzes/round', methods=['POST'])
+  @read_replica
+  def play_a_round():
+    guard('quizzes')
+    request_body = request.get_json()
+    # if the user doesnt give a request
+    if request_body is None:
+      abort(400)
+
+    # the category is an object like {"id": 1, "type": "Science"}
+    quiz_category = request_body.get('quiz_category', None)
+    if not isinstance(quiz_category, dict):
+      abort(400)
+
+    try:
+      difficulty, strategy = quiz_options(request_body)
+      count, previous_questions, seed = round_options(request_body)
+    except ValueError:
+      abort(400)
+
+    category_id = quiz_category.get('id', 0)
+    # in case no questions are in the category or no question exist altogether in the database
+    if quiz_index.size(category_id, difficulty) == 0:
+      abort(404)
+
+    while True:
+      question_ids, remaining = quiz_index.sample_round(category_id, count, previous_questions, difficulty, strategy,
+                                                        seed)
+
+      # in case all the questions of the category were already asked
+      if remaining == 0:
+        return jsonify({
+          "success": True,
+          "state": "end_of_game"
+        })
+
+      questions = get_question_rows(question_ids)
+      missing = [question_id for question_id in question_ids if question_id not in questions]
+      if missing and on_replica():
+        # the index follows the primary, a question added there may not have reached the replica yet
+        with on_primary():
+          questions.update(get_question_rows(missing))
+      # the questions may have been deleted by another worker since the index was loaded, the round is drawn again
+      deleted = [question_id for question_id in question_ids if question_id not in questions]
+      if not deleted:
+        break
+      for question_id in deleted:
+        quiz_index.discard(question_id)
+
+    return json_response({
+      "success": True,
+      "questions": [format_row(questions[question_id]) for question_id in question_ids],
+      "remaining_questions": remaining - len(question_ids)
+    })
+
+
+
+
+  '''
+  Quiz sessions: the server keeps the questions left to ask so the client doesn't have
+  to send all the previous questions every time. /quizzes stays available as it is.
+  '''
+  @app.route('/quizzes/sessions', methods=['POST'])
+  def start_quiz_session():
+    request_body = request.get_json()
+    if request_body is None:
+      abort(400)
+
+    quiz_category = request_body.get('quiz_category', None)
+    # in case the user doesn't give a quiz_category, or not as an object
+    if not isinstance(quiz_category, dict):
+      abort(400)
+
+    question_ids = quiz_index.draw(quiz_category.get('id', 0), QUIZ_SESSION_MAX_QUESTIONS)
+    # in case no questions are in the category
+    if len(question_ids) == 0:
+      abort(404)
+
+    session_id = scoped_session_id(quiz_sessions.create(question_ids))
+    return jsonify({
+      "success": True,
+      "session_id": session_id,
+      "total_questions": len(question_ids)
+    })
+
+  @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+  def next_quiz_session_question(session_id):
+    while True:
+      try:
+        question_id = quiz_sessions.pop(unscoped_session_id(session_id))
+      except KeyError:
+        # in case the session doesn't exist or has expired
+        abort(404)
+
+      if question_id is None:
+        quiz_sessions.delete(unscoped_session_id(session_id))
+        return jsonify({
+          "success": True,
+          "state": "end_of_game"
+        })
+
+      question = get_question_row(question_id)
+      # the question may have been deleted since the session started
+      if question is not None:
+        break
+
+    return json_response({
+      "success": True,
+      "question": format_row(question)
+    })
 
 
   '''
@@ -315,6 +804,22 @@ def create_app(test_config=None):
       "message": "resource not found"
     }), 404
 
+  @app.errorhandler(409)
+  def conflict(error):
+    return jsonify({
+      "success": False,
+      "error": 409,
+      "message": "conflict"
+    }), 409
+
+  @app.errorhandler(429)
+  def too_many_requests(error):
+    return jsonify({
+      "success": False,
+      "error": 429,
+      "message": "too many requests"
+    }), 429, {'Retry-After': str(getattr(error, 'retry_after', 1))}
+
   @app.errorhandler(422)
   def unproccesable_entity(error):
     return jsonify({
@@ -331,6 +836,31 @@ def create_app(test_config=None):
       "message": "internal server error"
     }),500
 
+  @app.errorhandler(503)
+  def service_unavailable(error):
+    return jsonify({
+      "success": False,
+      "error": 503,
+      "message": "service unavailable"
+    }), 503, {'Retry-After': str(getattr(error, 'retry_after', 1))}
+
   return app
 
-    
\ No newline at end of file
+    
+
+
+'''
+warm_up(app)
+    loads the categories of every tenant once, before gunicorn forks the workers (see gunicorn.conf.py), so the
+    workers start with the categories and the configured SQLAlchemy mappers instead of their first requests
+    the connections opened are closed before returning, a worker can't share the connections of its parent
+'''
+def warm_up(app):
+  with app.app_context():
+    for tenant in [None, *app.config['TENANT_DATABASE_URIS']]:
+      with use_tenant(tenant):
+        app.extensions['category_cache'].current().ensure_loaded()
+    # gives the connection of the session back to its pool first, dispose() only closes the idle ones
+    db.session.remove()
+    for bind in [None, *app.config['SQLALCHEMY_BINDS']]:
+      db.get_engine(app, bind).dispose()
@@ -0,0 +1,22 @@
+'''
+gunicorn settings of a fast starting deployment, from the backend folder:
+    flask init-db
+    DB_CREATE_ALL=false gunicorn -c gunicorn.conf.py 'flaskr:create_app()'
+    DB_CREATE_ALL=false gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker 'asgi:create_asgi_app()'
+
+the app is created once by the master process and warmed up (warm_up in flaskr) before the workers are forked,
+the workers share its imports and its categories instead of loading them each, and answer their first
+request without building the app
+'''
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+preload_app = True
+
+
+def when_ready(server):
+  from flaskr import warm_up
+  app = server.app.wsgi()
+  # the Flask app behind the ASGI app of asgi.py
+  warm_up(getattr(app, 'flask_app', app))
@@ -0,0 +1,78 @@
+import gzip
+
+from werkzeug.http import parse_accept_header, quote_etag
+
+try:
+  # optional dependency, smaller bodies than gzip for the clients that accept br
+  import brotli
+except ImportError:
+  brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain'}
+
+# preferred first when the client accepts several of them with the same quality
+ENCODINGS = (['br'] if brotli is not None else []) + ['gzip']
+
+
+'''
+list_etag(questions_version, categories_etag, tenant)
+    the weak ETag of the lists of questions, they change with the questions (TableVersion of the questions table)
+    and with the categories they contain. It is the same for every page, the client keeps one per URL
+    the tenant is part of it, the versions of two question banks can be the same
+'''
+def list_etag(questions_version, categories_etag, tenant=None):
+  prefix = f'{tenant}-' if tenant is not None else ''
+  return f'{prefix}q{questions_version}-{categories_etag[:16]}'
+
+
+def list_cache_headers(etag, config):
+  """the validators of a list of questions, for the 200 and the 304, with the QUESTIONS_MAX_AGE of the config"""
+  return [('ETag', quote_etag(etag, weak=True)), ('Cache-Control', f"public, max-age={config['QUESTIONS_MAX_AGE']}")]
+
+
+def negotiate_encoding(accept_encoding):
+  """the encoding to send to a client with this Accept-Encoding header, None for no compression"""
+  if not accept_encoding:
+    return None
+  return parse_accept_header(accept_encoding).best_match(ENCODINGS)
+
+
+def compress(body, encoding, config):
+  if encoding == 'br':
+    return brotli.compress(body, quality=config['COMPRESS_BROTLI_QUALITY'])
+  return gzip.compress(body, config['COMPRESS_GZIP_LEVEL'])
+
+
+'''
+compress_body(body, mimetype, accept_encoding, config)
+    (body, headers) of a response body compressed with the best encoding the client accepts, at the levels of the config
+    the bodies below COMPRESS_MIN_SIZE and the ones that don't compress (images, already compressed) are returned as they are,
+    Vary is set as soon as the body could have been compressed so the caches keep the encodings apart
+'''
+def compress_body(body, mimetype, accept_encoding, config):
+  if mimetype not in COMPRESSIBLE_MIMETYPES or len(body) < config['COMPRESS_MIN_SIZE']:
+    return body, []
+  encoding = negotiate_encoding(accept_encoding)
+  if encoding is None:
+    return body, [('Vary', 'Accept-Encoding')]
+  return compress(body, encoding, config), [('Vary', 'Accept-Encoding'), ('Content-Encoding', encoding)]
+
+
+'''
+compress_response(response, accept_encoding, config)
+    compress_body for a Flask response, called by the after_request of the app
+    the streamed responses (export) are sent as they are, they would have to be read whole first
+'''
+def compress_response(response, accept_encoding, config):
+  if response.status_code != 200 or response.is_streamed or response.direct_passthrough or \
+      'Content-Encoding' in response.headers:
+    return response
+  body, headers = compress_body(response.get_data(), response.mimetype, accept_encoding, config)
+  for name, value in headers:
+    if name == 'Vary':
+      response.vary.add(value)
+    else:
+      response.headers[name] = value
+  if 'Content-Encoding' in response.headers:
+    response.set_data(body)
+  return response
@@ -0,0 +1,249 @@
+import os
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket (+Inf) is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# header of a request asking to be profiled, "cprofile" or "pyinstrument"
+PROFILE_HEADER = 'X-Profile'
+
+
+'''
+SQL statements of the current request
+    the listeners are set once on every SQLAlchemy engine and only count the statements that run
+    inside a request. The rows are the row count of the DB-API cursor: psycopg2 gives it for the
+    SELECT statements too, sqlite only for the INSERT, UPDATE and DELETE statements
+'''
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if has_request_context():
+    g.sql_started_at = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if not has_request_context() or 'sql_started_at' not in g:
+    return
+  g.sql_statements = g.get('sql_statements', 0) + 1
+  g.sql_seconds = g.get('sql_seconds', 0) + time.perf_counter() - g.pop('sql_started_at')
+  if cursor.rowcount is not None and cursor.rowcount > 0:
+    g.sql_rows = g.get('sql_rows', 0) + cursor.rowcount
+
+
+def listen_to_sql():
+  if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def escape_label(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+'''
+Instrumentation
+    per endpoint latency histograms, response statuses and SQL statements, time and rows of the worker process
+    start_request() and finish_request(response) are called by the before_request and after_request of the app,
+    record(...) is the same for the requests answered outside of Flask (see asgi.py)
+    render() gives everything in the Prometheus text format for /metrics
+    the requests with the X-Profile header are profiled when profiling is on, sample_rate of them, into profile_dir
+'''
+class Instrumentation:
+
+  def __init__(self, profiling=False, sample_rate=1, profile_dir=None, buckets=LATENCY_BUCKETS):
+    self.profiling = profiling
+    self.sample_rate = sample_rate
+    self.profile_dir = profile_dir
+    self.buckets = buckets
+    # (endpoint, method) -> [count of every bucket..., count of +Inf, sum of the seconds]
+    self.latencies = {}
+    # (endpoint, method, status) -> number of responses
+    self.responses = {}
+    # (endpoint, method) -> [statements, seconds, rows]
+    self.sql = {}
+    self.lock = threading.Lock()
+    # connection pool of the SQLAlchemy engine given to watch_pool(pool)
+    self.pool = None
+    self.pool_stats = {'checked_out': 0, 'checked_out_peak': 0, 'checkouts': 0, 'connections': 0}
+    # name -> in memory cache given to watch_cache(name, cache)
+    self.caches = {}
+    listen_to_sql()
+
+  def watch_pool(self, pool):
+    """counts the connections opened and the checkouts of the pool, to size DB_POOL_SIZE and DB_MAX_OVERFLOW"""
+    with self.lock:
+      # called by the first requests of the worker, which may run at the same time
+      if self.pool is pool:
+        return
+      self.pool = pool
+    event.listen(pool, 'connect', self.on_pool_connect)
+    event.listen(pool, 'checkout', self.on_pool_checkout)
+    event.listen(pool, 'checkin', self.on_pool_checkin)
+
+  def watch_cache(self, name, cache):
+    """exposes the hits, misses, evictions and size of a cache, cache.stats() gives them"""
+    self.caches[name] = cache
+
+  def on_pool_connect(self, dbapi_connection, connection_record):
+    with self.lock:
+      self.pool_stats['connections'] += 1
+
+  def on_pool_checkout(self, dbapi_connection, connection_record, connection_proxy):
+    with self.lock:
+      stats = self.pool_stats
+      stats['checkouts'] += 1
+      stats['checked_out'] += 1
+      stats['checked_out_peak'] = max(stats['checked_out_peak'], stats['checked_out'])
+
+  def on_pool_checkin(self, dbapi_connection, connection_record):
+    with self.lock:
+      self.pool_stats['checked_out'] = max(self.pool_stats['checked_out'] - 1, 0)
+
+  def start_request(self):
+    g.request_started_at = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0
+    g.sql_rows = 0
+    if self.profiling and PROFILE_HEADER in request.headers and random.random() < self.sample_rate:
+      start_profile(request.headers[PROFILE_HEADER])
+
+  def finish_request(self, response):
+    if 'request_started_at' not in g:
+      return response
+    seconds = time.perf_counter() - g.request_started_at
+    # the rule and not the path, so /questions/12 and /questions/13 are the same endpoint
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    self.record(endpoint, request.method, response.status_code, seconds, g.sql_statements, g.sql_seconds, g.sql_rows)
+
+    if 'profiler' in g:
+      stop_profile(response, endpoint, self.profile_dir)
+    return response
+
+  def record(self, endpoint, method, status, seconds, sql_statements=0, sql_seconds=0, sql_rows=0):
+    key = (endpoint, method)
+    with self.lock:
+      latency = self.latencies.setdefault(key, [0] * (len(self.buckets) + 2))
+      latency[bisect_left(self.buckets, seconds)] += 1
+      latency[-1] += seconds
+      status_key = (endpoint, method, status)
+      self.responses[status_key] = self.responses.get(status_key, 0) + 1
+      sql = self.sql.setdefault(key, [0, 0, 0])
+      sql[0] += sql_statements
+      sql[1] += sql_seconds
+      sql[2] += sql_rows
+
+  def render(self):
+    with self.lock:
+      latencies = {key: list(values) for key, values in self.latencies.items()}
+      responses = dict(self.responses)
+      sql = {key: list(values) for key, values in self.sql.items()}
+      pool_stats = dict(self.pool_stats)
+
+    lines = [
+      '# HELP trivia_request_duration_seconds Time spent answering the requests.',
+      '# TYPE trivia_request_duration_seconds histogram',
+    ]
+    for (endpoint, method), values in sorted(latencies.items()):
+      labels = f'endpoint="{escape_label(endpoint)}",method="{method}"'
+      cumulative = 0
+      for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+        cumulative += count
+        lines.append(f'trivia_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+      lines.append(f'trivia_request_duration_seconds_sum{{{labels}}} {values[-1]}')
+      lines.append(f'trivia_request_duration_seconds_count{{{labels}}} {cumulative}')
+
+    lines += [
+      '# HELP trivia_responses_total Responses sent, by status code.',
+      '# TYPE trivia_responses_total counter',
+    ]
+    for (endpoint, method, status), count in sorted(responses.items()):
+      lines.append(f'trivia_responses_total{{endpoint="{escape_label(endpoint)}",method="{method}",'
+                   f'status="{status}"}} {count}')
+
+    for index, (name, help_text) in enumerate((
+      ('trivia_sql_statements_total', 'SQL statements executed while answering the requests.'),
+      ('trivia_sql_duration_seconds_total', 'Time spent in the SQL statements.'),
+      ('trivia_sql_rows_total', 'Rows returned or written by the SQL statements, as reported by the driver '
+                                '(sqlite only reports the written rows).'),
+    )):
+      lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+      for (endpoint, method), values in sorted(sql.items()):
+        lines.append(f'{name}{{endpoint="{escape_label(endpoint)}",method="{method}"}} {values[index]}')
+
+    if self.pool is not None:
+      pool_metrics = [
+        ('trivia_db_pool_checked_out', 'gauge', 'Connections of the pool in use.', pool_stats['checked_out']),
+        ('trivia_db_pool_checked_out_peak', 'gauge', 'Most connections of the pool in use at the same time.',
+         pool_stats['checked_out_peak']),
+        ('trivia_db_pool_checkouts_total', 'counter', 'Connections taken from the pool.', pool_stats['checkouts']),
+        ('trivia_db_pool_connections_total', 'counter', 'Database connections opened by the pool.',
+         pool_stats['connections']),
+      ]
+      # only the QueuePool of postgres has a size and an overflow, not the pools of sqlite or PgBouncer mode
+      if hasattr(self.pool, 'size') and hasattr(self.pool, 'overflow'):
+        pool_metrics += [
+          ('trivia_db_pool_size', 'gauge', 'Connections kept open by the pool.', self.pool.size()),
+          ('trivia_db_pool_overflow', 'gauge', 'Connections opened beyond the size of the pool.',
+           max(self.pool.overflow(), 0)),
+        ]
+      for name, kind, help_text, value in pool_metrics:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+
+    cache_stats = {name: cache.stats() for name, cache in sorted(self.caches.items())}
+    for stat, kind, help_text in (
+      ('hits', 'counter', 'Reads answered by the cache.'),
+      ('misses', 'counter', 'Reads the cache could not answer.'),
+      ('evictions', 'counter', 'Entries dropped to stay under the memory cap.'),
+      ('entries', 'gauge', 'Entries in the cache.'),
+      ('bytes', 'gauge', 'Memory taken by the entries of the cache.'),
+    ):
+      name = f'trivia_cache_{stat}' + ('_total' if kind == 'counter' else '')
+      lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+      for cache, stats in cache_stats.items():
+        lines.append(f'{name}{{cache="{escape_label(cache)}"}} {stats[stat]}')
+    return '\n'.join(lines) + '\n'
+
+
+'''
+profiling of a single request, the result is written to profile_dir and only its file name sent back in the
+X-Profile-File header, the clients don't learn the folders of the server
+    - cprofile: a .prof file for pstats or snakeviz
+    - pyinstrument: a .html page, when pyinstrument is installed (cProfile is used otherwise)
+'''
+def start_profile(kind):
+  # the profilers are imported by the first profiled request, not by every worker that boots
+  if kind == 'pyinstrument':
+    try:
+      # optional dependency, a statistical profiler easier to read than cProfile
+      from pyinstrument import Profiler
+      g.profiler = Profiler()
+      g.profiler.start()
+      return
+    except ImportError:
+      pass
+  import cProfile
+  g.profiler = cProfile.Profile()
+  g.profiler.enable()
+
+
+def stop_profile(response, endpoint, profile_dir):
+  import cProfile
+  profiler = g.pop('profiler')
+  name = 'profile-{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), re.sub(r'\W+', '_', endpoint).strip('_'),
+                                   random.randrange(10 ** 6))
+  if isinstance(profiler, cProfile.Profile):
+    profiler.disable()
+    path = os.path.join(profile_dir, name + '.prof')
+    profiler.dump_stats(path)
+  else:
+    profiler.stop()
+    path = os.path.join(profile_dir, name + '.html')
+    with open(path, 'w') as profile_file:
+      profile_file.write(profiler.output_html())
+  response.headers['X-Profile-File'] = os.path.basename(path)
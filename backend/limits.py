@@ -0,0 +1,166 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+# the in process store never keeps more buckets than this, the least recently used ones go first (a dropped bucket
+# is full again, like the bucket of a client who waited)
+RATE_LIMIT_MAX_BUCKETS = 100000
+# seconds for the average SQL time of the load shedder to halve when no request finishes, so a worker which sheds
+# every request serves again once the database has recovered
+LOAD_SHED_HALF_LIFE = 1.0
+# share of the last request in the average SQL time
+LOAD_SHED_WEIGHT = 0.2
+
+
+def retry_later(error, seconds):
+  """the HTTPException of a 429 or a 503, with the seconds of its Retry-After"""
+  error.retry_after = max(1, math.ceil(seconds))
+  return error
+
+
+def client_address(headers, remote_addr, config):
+  """the address a client is limited by: the one added to RATE_LIMIT_CLIENT_HEADER by the proxy in front of the app
+  (the last one of the header, the client can write the others), the address of the connection without proxy"""
+  header = config['RATE_LIMIT_CLIENT_HEADER']
+  if header and headers.get(header):
+    return headers[header].split(',')[-1].strip()
+  return remote_addr or 'unknown'
+
+
+'''
+token buckets
+    a client may send burst requests of a route at once, then rate requests per second: every request takes a token
+    from the bucket of the client, which gets rate tokens back every second up to burst
+    take(key, rate, burst) takes a token and returns 0, or the seconds until the next token when the bucket is empty
+'''
+class MemoryBucketStore:
+  """buckets kept in the worker process, every worker limits the clients on its own"""
+
+  def __init__(self, max_buckets=RATE_LIMIT_MAX_BUCKETS):
+    self.max_buckets = max_buckets
+    # key -> (tokens, updated_at), ordered from the least to the most recently used
+    self.buckets = OrderedDict()
+    self.lock = threading.Lock()
+
+  def take(self, key, rate, burst, now=None):
+    now = time.monotonic() if now is None else now
+    with self.lock:
+      tokens, updated_at = self.buckets.pop(key, (burst, now))
+      tokens = min(burst, tokens + (now - updated_at) * rate)
+      wait = 0 if tokens >= 1 else (1 - tokens) / rate
+      self.buckets[key] = (tokens - 1 if tokens >= 1 else tokens, now)
+      while len(self.buckets) > self.max_buckets:
+        self.buckets.popitem(last=False)
+    return wait
+
+
+# same computation as MemoryBucketStore.take, atomic in redis, the seconds are sent back as a string since redis
+# truncates the numbers returned by a script
+TAKE_SCRIPT = '''
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+class RedisBucketStore:
+  """buckets kept in redis, shared by all the workers which use it (a redis of the host, or of the deployment)"""
+
+  def __init__(self, url):
+    # optional dependency, only needed when RATE_LIMIT_STORE is a redis url
+    import redis
+    self.take_script = redis.Redis.from_url(url).register_script(TAKE_SCRIPT)
+
+  def take(self, key, rate, burst, now=None):
+    # the wall clock, the same for every worker of the host
+    now = time.time() if now is None else now
+    return float(self.take_script(keys=[f'rate_limit:{key}'], args=[rate, burst, now]))
+
+
+def create_bucket_store(store):
+  if store.startswith('redis://') or store.startswith('rediss://') or store.startswith('unix://'):
+    return RedisBucketStore(store)
+  return MemoryBucketStore()
+
+
+'''
+RateLimiter(budgets, store)
+    token buckets of the clients for the expensive routes, budgets is {route: (rate, burst)}
+    a route without budget, or with a rate of 0, isn't limited
+'''
+class RateLimiter:
+
+  def __init__(self, budgets, store):
+    self.budgets = budgets
+    self.store = store
+
+  def take(self, route, client):
+    """0 when the client may send the request, the seconds it has to wait otherwise"""
+    rate, burst = self.budgets.get(route, (0, 0))
+    if rate <= 0:
+      return 0
+    return self.store.take(f'{route}:{client}', rate, max(burst, 1))
+
+
+'''
+LoadShedder(max_in_flight, max_db_seconds, retry_after)
+    refuses the expensive routes while the worker is overloaded, before they add their queries to the database:
+    - more than max_in_flight of them are running in the worker (requests queued on the pool and the database)
+    - the average SQL time of the last ones went over max_db_seconds, the database itself is slow
+    the average fades out while nothing finishes, so the worker takes requests again once the load is gone
+    a threshold of 0 is off, the refused requests are told to come back in retry_after seconds
+'''
+class LoadShedder:
+
+  def __init__(self, max_in_flight, max_db_seconds, retry_after):
+    self.max_in_flight = max_in_flight
+    self.max_db_seconds = max_db_seconds
+    self.retry_after = retry_after
+    self.in_flight = 0
+    self.db_seconds = 0.0
+    self.updated_at = time.monotonic()
+    self.lock = threading.Lock()
+
+  def average_db_seconds(self, now):
+    return self.db_seconds * 0.5 ** ((now - self.updated_at) / LOAD_SHED_HALF_LIFE)
+
+  def admit(self):
+    """0 when the request may run, the seconds of its Retry-After otherwise, release() follows an admitted request"""
+    with self.lock:
+      if (self.max_in_flight and self.in_flight >= self.max_in_flight) or \
+          (self.max_db_seconds and self.average_db_seconds(time.monotonic()) > self.max_db_seconds):
+        return max(self.retry_after, 1)
+      self.in_flight += 1
+      return 0
+
+  def release(self, sql_seconds):
+    now = time.monotonic()
+    with self.lock:
+      self.in_flight -= 1
+      self.db_seconds = self.average_db_seconds(now) * (1 - LOAD_SHED_WEIGHT) + sql_seconds * LOAD_SHED_WEIGHT
+      self.updated_at = now
+
+
+'''
+guard_route(rate_limiter, load_shedder, route, client)
+    the checks of an expensive route, by both serving modes: raises a 429 when the client used up its budget of the
+    route, then a 503 while the worker sheds the load. The request was admitted when it returns, the caller
+    calls load_shedder.release(sql_seconds) once it is answered
+'''
+def guard_route(rate_limiter, load_shedder, route, client):
+  retry_after = rate_limiter.take(route, client)
+  if retry_after:
+    raise retry_later(TooManyRequests(), retry_after)
+  retry_after = load_shedder.admit()
+  if retry_after:
+    raise retry_later(ServiceUnavailable(), retry_after)
@@ -0,0 +1,43 @@
+'''
+alembic environment of the trivia database, see alembic.ini
+    the migrations inspect the database before changing it, so they only run online (no --sql)
+'''
+import os
+import sys
+from logging.config import fileConfig
+
+from alembic import context
+from flask import Config as FlaskConfig
+from sqlalchemy import create_engine
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from config import Config
+from models import db
+
+
+def database_url():
+  """-x database=..., else sqlalchemy.url of alembic.ini, else the database of the app"""
+  url = context.get_x_argument(as_dictionary=True).get('database') or context.config.get_main_option('sqlalchemy.url')
+  if url:
+    return url
+  config = FlaskConfig(BACKEND_DIR)
+  config.from_object(Config)
+  config.from_envvar('TRIVIA_SETTINGS', silent=True)
+  return config['SQLALCHEMY_DATABASE_URI']
+
+
+if context.config.config_file_name is not None:
+  fileConfig(context.config.config_file_name, disable_existing_loggers=False)
+
+if context.is_offline_mode():
+  raise SystemExit('the migrations inspect the database before changing it, run them without --sql')
+
+engine = create_engine(database_url())
+with engine.connect() as connection:
+  # sqlite can't alter a column, the batch operations copy the table instead
+  context.configure(connection=connection, target_metadata=db.metadata,
+                    render_as_batch=connection.dialect.name == 'sqlite')
+  with context.begin_transaction():
+    context.run_migrations()
@@ -0,0 +1,90 @@
+'''
+typed category, step 1 of 2: expand
+
+questions.category was a string column holding the id of a category, without an index.
+This step adds the integer column category_id next to it, with a foreign key to categories, and a trigger
+which fills it on every insert and every update of category so the running app keeps working unchanged.
+The existing questions are filled afterwards by batches with flask backfill-question-categories,
+then step 2 replaces category with category_id.
+
+on postgres the foreign key is added NOT VALID: it is checked for the new rows right away,
+and for the existing rows by step 2 without locking the writes.
+nothing is done on a database whose category is already an integer (restored from trivia.psql,
+or created by the app with the current models).
+'''
+from alembic import op
+import sqlalchemy as sa
+
+from models import db
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+POSTGRES_SYNC = [
+  '''
+  CREATE FUNCTION questions_category_id_sync() RETURNS trigger AS $$
+  BEGIN
+    NEW.category_id := (SELECT id FROM categories WHERE id::text = NEW.category);
+    RETURN NEW;
+  END
+  $$ LANGUAGE plpgsql
+  ''',
+  '''
+  CREATE TRIGGER questions_category_id_sync BEFORE INSERT OR UPDATE OF category ON questions
+  FOR EACH ROW EXECUTE PROCEDURE questions_category_id_sync()
+  ''',
+]
+SQLITE_SYNC = [
+  f'''
+  CREATE TRIGGER questions_category_id_{event} AFTER {event.upper()}{columns} ON questions
+  BEGIN
+    UPDATE questions SET category_id = (SELECT id FROM categories WHERE CAST(id AS TEXT) = NEW.category)
+    WHERE id = NEW.id;
+  END
+  '''
+  for event, columns in (('insert', ''), ('update', ' OF category'))
+]
+
+
+def question_columns():
+  return {column['name']: column for column in sa.inspect(op.get_bind()).get_columns('questions')}
+
+
+def upgrade():
+  bind = op.get_bind()
+  if not bind.dialect.has_table(bind, 'questions'):
+    # a new database gets the current schema right away, step 2 has nothing left to do
+    db.metadata.create_all(bind)
+    return
+
+  columns = question_columns()
+  if isinstance(columns['category']['type'], sa.Integer) or 'category_id' in columns:
+    return
+
+  if bind.dialect.name == 'postgresql':
+    op.execute('ALTER TABLE questions ADD COLUMN category_id integer')
+    op.execute('ALTER TABLE questions ADD CONSTRAINT fk_questions_category FOREIGN KEY (category_id) '
+               'REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL NOT VALID')
+    for statement in POSTGRES_SYNC:
+      op.execute(statement)
+  else:
+    op.execute('ALTER TABLE questions ADD COLUMN category_id INTEGER CONSTRAINT fk_questions_category '
+               'REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL')
+    for statement in SQLITE_SYNC:
+      op.execute(statement)
+
+
+def downgrade():
+  if 'category_id' not in question_columns():
+    return
+  if op.get_bind().dialect.name == 'postgresql':
+    op.execute('DROP TRIGGER questions_category_id_sync ON questions')
+    op.execute('DROP FUNCTION questions_category_id_sync()')
+    op.execute('ALTER TABLE questions DROP COLUMN category_id')
+  else:
+    op.execute('DROP TRIGGER questions_category_id_insert')
+    op.execute('DROP TRIGGER questions_category_id_update')
+    with op.batch_alter_table('questions', recreate='always') as batch:
+      batch.drop_column('category_id')
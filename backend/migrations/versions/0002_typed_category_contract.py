@@ -0,0 +1,120 @@
+'''
+typed category, step 2 of 2: contract
+
+run it once flask backfill-question-categories has filled the category_id of the existing questions:
+- category_id replaces category (the questions of a category which doesn't exist are left without a category)
+- the foreign key is validated
+- the indexes on (category, id) and on difficulty are created
+- question_counts is keyed by the integer id of the category too
+
+on postgres the indexes are built CONCURRENTLY and the foreign key is validated outside of the swap,
+so the table stays writable: only the swap itself locks it, for the time of a DROP and a RENAME, and it
+gives up after LOCK_TIMEOUT instead of queuing the traffic behind a long transaction.
+a concurrent build that fails leaves an invalid index behind, drop it before running the step again.
+'''
+from alembic import op
+import sqlalchemy as sa
+
+from backfill import PENDING_SQL
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+LOCK_TIMEOUT = '5s'
+# name -> columns, the same indexes as the Question model
+INDEXES = {
+  'ix_questions_category_and_id': ('category', 'id'),
+  'ix_questions_difficulty': ('difficulty',),
+}
+
+
+def question_columns():
+  return {column['name']: column for column in sa.inspect(op.get_bind()).get_columns('questions')}
+
+
+def create_indexes(category_column):
+  existing = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('questions')}
+  for name, columns in INDEXES.items():
+    if name in existing:
+      continue
+    columns = [category_column if column == 'category' else column for column in columns]
+    if op.get_bind().dialect.name == 'postgresql':
+      with op.get_context().autocommit_block():
+        op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON questions ({', '.join(columns)})")
+    else:
+      op.create_index(name, 'questions', columns)
+
+
+def category_foreign_keys():
+  """the foreign keys on questions.category, whatever their name: fk_questions_category when these migrations made the
+  column, category in a database loaded from trivia.psql, none (None on sqlite) when the constraint has no name"""
+  return [foreign_key for foreign_key in sa.inspect(op.get_bind()).get_foreign_keys('questions')
+          if foreign_key['constrained_columns'] == ['category']]
+
+
+def rebuild_question_counts(category_type):
+  """question_counts keyed by category_type, the counts are computed again from the questions"""
+  if 'question_counts' in sa.inspect(op.get_bind()).get_table_names():
+    op.drop_table('question_counts')
+  op.create_table(
+    'question_counts',
+    sa.Column('category', category_type, primary_key=True),
+    sa.Column('count', sa.Integer, nullable=False),
+  )
+  op.execute('INSERT INTO question_counts (category, count) '
+             'SELECT category, count(*) FROM questions WHERE category IS NOT NULL GROUP BY category')
+
+
+def upgrade():
+  bind = op.get_bind()
+  if 'category_id' in question_columns():
+    pending = bind.execute(sa.text(PENDING_SQL)).scalar()
+    if pending:
+      raise RuntimeError(f'{pending} questions have no category_id yet, run flask backfill-question-categories first')
+
+    if bind.dialect.name == 'postgresql':
+      # built before the swap so the table isn't locked meanwhile, the index follows the rename of the column
+      create_indexes('category_id')
+      op.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+      op.execute('DROP TRIGGER questions_category_id_sync ON questions')
+      op.execute('DROP FUNCTION questions_category_id_sync()')
+      op.execute('ALTER TABLE questions DROP COLUMN category')
+      op.execute('ALTER TABLE questions RENAME COLUMN category_id TO category')
+      with op.get_context().autocommit_block():
+        op.execute('ALTER TABLE questions VALIDATE CONSTRAINT fk_questions_category')
+    else:
+      # sqlite copies the whole table anyway, the indexes are created on the copy
+      op.execute('DROP TRIGGER questions_category_id_insert')
+      op.execute('DROP TRIGGER questions_category_id_update')
+      with op.batch_alter_table('questions', recreate='always') as batch:
+        batch.drop_column('category')
+        batch.alter_column('category_id', new_column_name='category')
+  create_indexes('category')
+
+  inspector = sa.inspect(bind)
+  counts_columns = {column['name']: column for column in inspector.get_columns('question_counts')} \
+    if 'question_counts' in inspector.get_table_names() else {}
+  if 'category' not in counts_columns or not isinstance(counts_columns['category']['type'], sa.Integer):
+    rebuild_question_counts(sa.Integer)
+
+
+def downgrade():
+  # not online: the column is converted in place, under a lock for the whole table
+  for name in INDEXES:
+    op.drop_index(name, 'questions')
+  # a string can't reference the id of a category
+  foreign_keys = category_foreign_keys()
+  if op.get_bind().dialect.name == 'postgresql':
+    for foreign_key in foreign_keys:
+      op.drop_constraint(foreign_key['name'], 'questions', type_='foreignkey')
+    op.execute('ALTER TABLE questions ALTER COLUMN category TYPE varchar USING category::varchar')
+  else:
+    # the convention names the unnamed constraint of the copied table, so it can be left out of the copy too
+    with op.batch_alter_table('questions', recreate='always',
+                              naming_convention={'fk': 'fk_%(table_name)s_%(column_0_name)s'}) as batch:
+      for foreign_key in foreign_keys:
+        batch.drop_constraint(foreign_key['name'] or 'fk_questions_category', type_='foreignkey')
+      batch.alter_column('category', type_=sa.String)
+  rebuild_question_counts(sa.String)
@@ -0,0 +1,28 @@
+'''
+table versions
+
+adds table_versions, the version of the questions table behind the ETag of the lists of questions.
+the table starts empty, the first write on the questions creates the row (version 0 until then)
+'''
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  # created by step 1 already on a new database
+  if 'table_versions' in sa.inspect(op.get_bind()).get_table_names():
+    return
+  op.create_table(
+    'table_versions',
+    sa.Column('name', sa.String, primary_key=True),
+    sa.Column('version', sa.Integer, nullable=False),
+  )
+
+
+def downgrade():
+  op.drop_table('table_versions')
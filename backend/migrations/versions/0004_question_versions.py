@@ -0,0 +1,30 @@
+'''
+question versions
+
+adds questions.version, the version of every question for the optimistic locking of PATCH /questions/<id>.
+the existing questions start at version 1. The default is a constant, so postgres (11 and later) adds the column
+without rewriting the table
+'''
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def question_columns():
+  return {column['name'] for column in sa.inspect(op.get_bind()).get_columns('questions')}
+
+
+def upgrade():
+  # created by step 1 already on a new database
+  if 'version' in question_columns():
+    return
+  op.add_column('questions', sa.Column('version', sa.Integer, nullable=False, server_default='1'))
+
+
+def downgrade():
+  with op.batch_alter_table('questions') as batch:
+    batch.drop_column('version')
@@ -0,0 +1,33 @@
+'''
+question changes
+
+adds question_changes, the log of the writes on the questions read by GET /changes.
+the table starts empty, the writes made before the upgrade aren't in it: a reader starts from the lists of questions
+'''
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  # created by step 1 already on a new database
+  if 'question_changes' in sa.inspect(op.get_bind()).get_table_names():
+    return
+  op.create_table(
+    'question_changes',
+    sa.Column('seq', sa.Integer, primary_key=True),
+    sa.Column('action', sa.String, nullable=False),
+    sa.Column('question_id', sa.Integer),
+    sa.Column('category', sa.Integer),
+    sa.Column('previous_category', sa.Integer),
+    sa.Column('changed_at', sa.DateTime, nullable=False, server_default=sa.func.now()),
+    sqlite_autoincrement=True,
+  )
+
+
+def downgrade():
+  op.drop_table('question_changes')
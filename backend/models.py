@@ -1,6 +1,11 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Index, create_engine, func, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+from flask import current_app
+from replicas import RoutingSQLAlchemy, configure_replicas
+from tenants import configure_tenants, use_tenant
 import json
 
 # VERY IMPORTANT:
@@ -8,7 +13,7 @@ import json
 
 ## 2) PLEASE MAKE SURE TO RESET THE DATABASE SO ALL THE TESTS WILL FUNCTION psql trivia < trivia.psql
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 DB_HOST = os.getenv('DB_HOST', '127.0.0.1:5432')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
@@ -18,26 +23,167 @@ DB_PATH = 'postgresql://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NA
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the settings come from the app config (see config.py), the ones it doesn't have take the defaults of Config
+    database_path overrides SQLALCHEMY_DATABASE_URI, the DB_REPLICA_URIS are the read replicas (see replicas.py)
+    and the TENANT_DATABASE_URIS the question banks of the tenants (see tenants.py)
 '''
-def setup_db(app, database_path=DB_PATH):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
-    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+def setup_db(app, database_path=None):
+    from config import Config
+    for key in dir(Config):
+        if key.isupper():
+            app.config.setdefault(key, getattr(Config, key))
+    if database_path is not None:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    configure_replicas(app)
+    configure_tenants(app)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    # a hot start of a worker on an existing schema skips the create_all queries (DB_CREATE_ALL=false)
+    if app.config["DB_CREATE_ALL"]:
+        for tenant in [None, *app.config["TENANT_DATABASE_URIS"]]:
+            with use_tenant(tenant):
+                create_schema()
+    # an embedded database (see embedded.py) starts with the questions of the dump
+    if app.config["EMBEDDED_SEED"]:
+        from embedded import seed_database
+        seed_database(app.config["EMBEDDED_SEED"])
+
+def create_schema():
+    # the tables of the database of the current tenant, on the primary only, the replicas get them from the replication
+    db.metadata.create_all(bind=db.session.get_bind())
+    # the counts of a database created before the question_counts table have to be computed once
+    if QuestionCount.query.first() is None:
+        QuestionCount.rebuild()
 
 '''
-Question
+engine_options(config, uri)
+    arguments of the SQLAlchemy engine of a database uri for the pool and the timeouts of the config, computed for
+    every engine (see RoutingSQLAlchemy.apply_driver_hacks) since a replica or a tenant may be a sqlite file
+    next to a postgres primary
+    - sqlite: a file gets a QueuePool of DB_POOL_SIZE connections like postgres, without it every checkout opens the
+      file and runs the pragmas of embedded.py again (NullPool). The memory database keeps its single connection
+    - DB_PGBOUNCER: no pool, every checkout is a new connection to PgBouncer which does the pooling,
+      and no startup parameter since PgBouncer refuses the ones it doesn't know
+    - postgres: a QueuePool of DB_POOL_SIZE connections plus DB_MAX_OVERFLOW, statement_timeout set when connecting
+'''
+def engine_options(config, uri):
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    if uri.startswith("sqlite"):
+        if make_url(uri).database not in (None, "", ":memory:"):
+            options.update({
+                "poolclass": QueuePool,
+                "pool_size": config["DB_POOL_SIZE"],
+                "max_overflow": config["DB_MAX_OVERFLOW"],
+                "pool_timeout": config["DB_POOL_TIMEOUT"],
+                # a connection of the pool is used by one thread at a time, not always the one which opened it
+                "connect_args": {"check_same_thread": False},
+            })
+        return options
+    if config["DB_PGBOUNCER"]:
+        options["poolclass"] = NullPool
+        return options
+    options.update({
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+    })
+    if config["DB_STATEMENT_TIMEOUT"]:
+        options["connect_args"] = {"options": "-c statement_timeout={}".format(config["DB_STATEMENT_TIMEOUT"])}
+    return options
+
+# the log of the changes is trimmed by one write out of this many, see QuestionChange
+CHANGES_TRIM_EVERY = 1000
+
+# the values an INTEGER column of postgres can hold
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+'''
+integer_value(value)
+    the int of a number or of a numeric string sent by a client ("3"), raises ValueError for the other values:
+    the booleans, the numbers with a fraction ("2.5", 2.5), the strings that aren't integers ("1e3") and the
+    numbers an INTEGER column can't hold
+'''
+def integer_value(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f'{value!r} is not an integer')
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(f'{value!r} is not an integer')
+        value = int(value)
+    value = int(value)
+    if not INTEGER_MIN <= value <= INTEGER_MAX:
+        raise ValueError(f'{value} is out of range')
+    return value
+
+'''
+increment(table, key_column, key, column, delta)
+    adds delta to a counter column of the row of key in the current transaction, the row is created with delta
+    when it doesn't exist yet
+    - postgres: one INSERT .. ON CONFLICT DO UPDATE, two transactions creating the same row don't both insert it
+      (an UPDATE of no row then an INSERT lets the second one fail on the primary key under READ COMMITTED)
+    - sqlite: the UPDATE takes the write lock of the database, so the INSERT that follows can't race
+'''
+def increment(table, key_column, key, column, delta):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        statement = pg_insert(table).values({key_column.name: key, column.name: delta})
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[key_column], set_={column.name: column + statement.excluded[column.name]}))
+        return
+    result = db.session.execute(table.update().where(key_column == key).values({column.name: column + delta}))
+    if result.rowcount == 0:
+        db.session.execute(table.insert().values({key_column.name: key, column.name: delta}))
+
+'''
+question listeners
+    callables registered with add_question_listener(app, listener) are called with (action, question)
+    after every committed write on a question, so in memory indexes can follow the table without reloading it
+    after a bulk write the action is 'reload' and the question is None, the indexes have to load the table again
+'''
+def add_question_listener(app, listener):
+    app.extensions.setdefault('question_listeners', []).append(listener)
+
+def notify_question_listeners(action, question):
+    for listener in current_app.extensions.get('question_listeners', []):
+        listener(action, question)
 
 '''
+category listeners
+    same as the question listeners for the writes on a category, registered with add_category_listener(app, listener)
+'''
+def add_category_listener(app, listener):
+    app.extensions.setdefault('category_listeners', []).append(listener)
+
+def notify_category_listeners(action, category):
+    for listener in current_app.extensions.get('category_listeners', []):
+        listener(action, category)
+
+'''
+Question
+    the category is the id of a Category, set to NULL when the category is deleted
+    the questions of a category are read ordered by id (pages, quizzes) so they share an index on (category, id)
+    version goes up with every update, which only applies to the version it was read at (optimistic locking):
+    an editor who read an older version gets StaleDataError instead of overwriting the changes of another one,
+    without any row lock held between the read and the write
+    the schema of an existing database is changed by the migrations of the migrations folder (see the README)
+'''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  __table_args__ = (
+    Index('ix_questions_category_and_id', 'category', 'id'),
+    Index('ix_questions_difficulty', 'difficulty'),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', name='fk_questions_category',
+                                        onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
+  version = Column(Integer, nullable=False, server_default='1')
+
+  __mapper_args__ = {'version_id_col': version}
 
   def __init__(self, question, answer, category, difficulty):
     self.question = question
@@ -46,15 +192,36 @@ class Question(db.Model):
     self.difficulty = difficulty
 
   def insert(self):
+    # first, see TableVersion
+    TableVersion.bump('questions')
     db.session.add(self)
+    QuestionCount.add(self.category, 1)
+    QuestionChange.record('insert', self)
     db.session.commit()
+    notify_question_listeners('insert', self)
   
   def update(self):
+    # read before the bump, whose query flushes the changes of the question
+    history = inspect(self).attrs.category.history
+    TableVersion.bump('questions')
+    # the question moves from one count to the other when its category changes
+    if history.has_changes():
+      for old_category in history.deleted:
+        QuestionCount.add(old_category, -1)
+      QuestionCount.add(self.category, 1)
+    # for the listeners, which only drop what they keep of the categories the question was and is in
+    self.previous_category = history.deleted[0] if history.deleted else self.category
+    QuestionChange.record('update', self)
     db.session.commit()
+    notify_question_listeners('update', self)
 
   def delete(self):
+    TableVersion.bump('questions')
     db.session.delete(self)
+    QuestionCount.add(self.category, -1)
+    QuestionChange.record('delete', self)
     db.session.commit()
+    notify_question_listeners('delete', self)
 
   def format(self):
     return {
@@ -62,9 +229,146 @@ class Question(db.Model):
       'question': self.question,
       'answer': self.answer,
       'category': self.category,
-      'difficulty': self.difficulty
+      'difficulty': self.difficulty,
+      'version': self.version
     }
 
+'''
+QuestionCount
+    number of questions of every category, changed in the same transaction as the questions themselves
+    so every worker process reads the same counts without counting the questions table
+    the writes that don't go through Question.insert/update/delete (psql, bulk deletes) are
+    caught by check() and fixed by rebuild(), see the check-question-counts command
+    the questions without a category (their category was deleted) aren't counted
+'''
+class QuestionCount(db.Model):
+  __tablename__ = 'question_counts'
+
+  category = Column(Integer, primary_key=True)
+  count = Column(Integer, nullable=False, default=0)
+
+  @staticmethod
+  def add(category, delta):
+    """adds delta to the count of a category in the current transaction, the caller commits"""
+    if category is None:
+      return
+    table = QuestionCount.__table__
+    increment(table, table.c.category, int(category), table.c.count, delta)
+
+  @staticmethod
+  def of_category(category):
+    count = db.session.query(QuestionCount.count).filter(QuestionCount.category == int(category)).scalar()
+    return count or 0
+
+  @staticmethod
+  def total():
+    return db.session.query(func.coalesce(func.sum(QuestionCount.count), 0)).scalar()
+
+  @staticmethod
+  def actual_counts():
+    rows = db.session.query(Question.category, func.count(Question.id)).group_by(Question.category).all()
+    return {category: count for category, count in rows if category is not None}
+
+  @staticmethod
+  def check():
+    """{category: (stored count, real count)} of every category whose stored count is wrong"""
+    stored = {row.category: row.count for row in QuestionCount.query.all()}
+    actual = QuestionCount.actual_counts()
+    return {category: (stored.get(category, 0), actual.get(category, 0))
+            for category in set(stored) | set(actual)
+            if stored.get(category, 0) != actual.get(category, 0)}
+
+  @staticmethod
+  def rebuild():
+    # the totals of the lists of questions change, bumped first like every write on the counts
+    TableVersion.bump('questions')
+    QuestionCount.query.delete()
+    for category, count in QuestionCount.actual_counts().items():
+      db.session.add(QuestionCount(category=category, count=count))
+    db.session.commit()
+
+'''
+TableVersion
+    a number per table that goes up with every write on the table, in the same transaction as the write
+    the lists of questions are sent with a weak ETag made of it, so a client that already has a page
+    is answered 304 without reading the page again (see http_cache.py)
+    like the question counts, the writes made outside of the app (psql) don't change it
+    every write on the questions bumps it before it changes the question_counts: the row of the version is locked
+    until the commit, so the writers queue on that single row first and never lock two categories of the counts in
+    opposite orders (a deadlock on postgres, an update moves a question from one category to another)
+'''
+class TableVersion(db.Model):
+  __tablename__ = 'table_versions'
+
+  name = Column(String, primary_key=True)
+  version = Column(Integer, nullable=False, default=0)
+
+  @staticmethod
+  def bump(name):
+    """increments the version of a table in the current transaction, the caller commits"""
+    table = TableVersion.__table__
+    increment(table, table.c.name, name, table.c.version, 1)
+    # read back in the transaction, so it is the version of this write, kept for the listeners notified after the commit
+    db.session.info.setdefault('bumped_versions', {})[name] = TableVersion.of(name)
+
+  @staticmethod
+  def forget_bumps():
+    """forgets the versions bumped by the session, after a rollback"""
+    db.session.info.pop('bumped_versions', None)
+
+  @staticmethod
+  def bumped(name):
+    """the version of a table after the last bump of the session, None when the session didn't bump it"""
+    return db.session.info.get('bumped_versions', {}).get(name)
+
+  @staticmethod
+  def of(name):
+    version = db.session.query(TableVersion.version).filter(TableVersion.name == name).scalar()
+    return version or 0
+
+'''
+QuestionChange
+    append only log of the writes on the questions, read by GET /changes (see changes.py) so the caches and the
+    processes outside of the app follow the questions without fetching the lists again
+    a change is added in the transaction of its write, after TableVersion.bump: the row of the version stays locked
+    until the commit, so the seqs are handed out in the order of the commits and a reader which got up to a seq
+    never misses a change committed after it with a smaller one
+    the question_id of a bulk import ('reload') is None, the readers fetch the questions again
+    the log keeps the last CHANGES_MAX_ROWS seqs: the write whose seq is a multiple of CHANGES_TRIM_EVERY (or of
+    CHANGES_MAX_ROWS when it is smaller) deletes the older ones in its transaction, and a reader which was further behind is sent a 'reload' (see changes.py)
+'''
+class QuestionChange(db.Model):
+  __tablename__ = 'question_changes'
+  # sqlite would hand out the seq of the last row again once it is deleted
+  __table_args__ = {'sqlite_autoincrement': True}
+
+  seq = Column(Integer, primary_key=True)
+  action = Column(String, nullable=False)
+  question_id = Column(Integer)
+  category = Column(Integer)
+  # the category before an update, the same as category for the other actions
+  previous_category = Column(Integer)
+  changed_at = Column(DateTime, nullable=False, server_default=func.now())
+
+  @staticmethod
+  def record(action, question=None):
+    """logs a change of a question (a Question or a QuestionRow) in the current transaction, the caller commits"""
+    if question is None:
+      change = QuestionChange(action=action)
+    else:
+      # the id of a new question
+      db.session.flush()
+      change = QuestionChange(action=action, question_id=question.id, category=question.category,
+                              previous_category=getattr(question, 'previous_category', question.category))
+    db.session.add(change)
+    keep = db.get_app().config['CHANGES_MAX_ROWS']
+    if keep:
+      # the seq of the change
+      db.session.flush()
+      # the log never goes beyond twice the rows it keeps
+      if change.seq % min(keep, CHANGES_TRIM_EVERY) == 0:
+        QuestionChange.query.filter(QuestionChange.seq <= change.seq - keep).delete(synchronize_session=False)
+
 '''
 Category
 
@@ -78,6 +382,20 @@ class Category(db.Model):
   def __init__(self, type):
     self.type = type
 
+  def insert(self):
+    db.session.add(self)
+    db.session.commit()
+    notify_category_listeners('insert', self)
+
+  def update(self):
+    db.session.commit()
+    notify_category_listeners('update', self)
+
+  def delete(self):
+    db.session.delete(self)
+    db.session.commit()
+    notify_category_listeners('delete', self)
+
   def format(self):
     return {
       'id': self.id,
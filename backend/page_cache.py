@@ -0,0 +1,199 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+from models import TableVersion
+from pagination import QUESTIONS_PER_PAGE
+from serialization import dumps
+from tenants import current_tenant
+
+# bookkeeping of a page besides its JSON (key, entry, index), so many tiny pages can't go over the cap
+PAGE_OVERHEAD_BYTES = 200
+
+'''
+PageEntry
+    a page snapshot: the JSON of the response up to "total_questions": (see page_head), the etag of the categories
+    it contains, first, the id of its first question (None for an empty page) and boundary, the id of the first
+    question after the page (None on the last page)
+'''
+PageEntry = namedtuple('PageEntry', ('categories_etag', 'head', 'first', 'boundary', 'size'))
+
+
+def page_head(payload):
+  """the JSON of a list response without the value of total_questions, the last key, nor the closing brace"""
+  body = dumps({**payload, 'total_questions': 0})
+  return body[:-len(b'0}')]
+
+
+def page_body(head, total):
+  return head + str(total).encode('ascii') + b'}'
+
+
+def page_bounds(rows, per_page=QUESTIONS_PER_PAGE):
+  """(first, boundary) of a page, from the rows of fetch_window()"""
+  first = rows[0].id if rows else None
+  return first, rows[per_page].id if len(rows) > per_page else None
+
+
+class TenantPages:
+  """the pages of one question bank, with their own budget of max_bytes"""
+
+  def __init__(self):
+    # the version of the questions table whose changes are all applied to the pages, None until the first read
+    self.synced = None
+    # category (None for all the questions) -> total_questions of the list
+    self.totals = {}
+    # (category, page) -> PageEntry, least recently used first
+    self.entries = OrderedDict()
+    # category -> pages of the list in the cache
+    self.pages = {}
+    self.size = 0
+
+  def discard(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.size -= entry.size
+      category, page = key
+      self.pages[category].discard(page)
+
+  def drop_all(self):
+    self.entries.clear()
+    self.pages.clear()
+    self.totals.clear()
+    self.size = 0
+
+  def drop_after(self, category, question_id):
+    """drops the pages of a list which end after a question, the ones that hold it or follow it"""
+    for page in list(self.pages.get(category, ())):
+      entry = self.entries[(category, page)]
+      if entry.boundary is None or question_id <= entry.boundary:
+        self.discard((category, page))
+
+  def drop_holding(self, category, question_id):
+    """drops the page of a list which holds a question, the pages around it keep the same questions"""
+    for page in list(self.pages.get(category, ())):
+      entry = self.entries[(category, page)]
+      if entry.first is not None and entry.first <= question_id and \
+          (entry.boundary is None or question_id < entry.boundary):
+        self.discard((category, page))
+
+
+'''
+PageCache(max_bytes)
+    serialized ?page=<n> pages of GET /questions and GET /categories/<id>/questions, built by the first request of
+    a page and served as bytes afterwards, without querying nor serializing the questions again
+    - a write on a question only drops the pages it moves: the pages of its lists (all the questions and its
+      category) which end after it, the pages before it keep the same questions. An edit that leaves the
+      question in its category only drops the pages holding it
+    - the versions of the questions table (TableVersion) tell the writes of this worker from the others: a version
+      that went further than the writes seen here drops all the pages of the question bank
+    - a page read on a replica behind the versions already seen is neither served nor kept
+    - the categories and the totals are checked on every hit, they change more often than the pages
+    - every tenant has max_bytes for its pages, the least recently used pages of the tenant are dropped beyond it,
+      so a tenant paging through a big question bank can't push out the pages of the others
+    - hits and misses are counted for /metrics
+'''
+class PageCache:
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    # tenant -> TenantPages
+    self.tenants = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = threading.Lock()
+
+  def tenant_pages(self, tenant):
+    pages = self.tenants.get(tenant)
+    if pages is None:
+      pages = self.tenants[tenant] = TenantPages()
+    return pages
+
+  def sync(self, version):
+    """the pages of the current tenant, up to date with this version, None when the version is behind them"""
+    pages = self.tenant_pages(current_tenant())
+    if pages.synced is not None and version < pages.synced:
+      return None
+    if pages.synced is None or version > pages.synced:
+      # written by another worker, or by a bulk import, since the pages were built
+      pages.drop_all()
+      pages.synced = version
+    return pages
+
+  def get(self, category, page, version, categories_etag):
+    """the head of a page, None when it isn't cached"""
+    if not self.max_bytes:
+      return None
+    with self.lock:
+      # synced first, it may drop the page
+      pages = self.sync(version)
+      entry = None if pages is None else pages.entries.get((category, page))
+      if entry is None or entry.categories_etag != categories_etag:
+        self.misses += 1
+        return None
+      pages.entries.move_to_end((category, page))
+      self.hits += 1
+      return entry.head
+
+  def put(self, category, page, version, categories_etag, head, bounds):
+    """keeps a page, bounds are the (first, boundary) of page_bounds()"""
+    if not self.max_bytes:
+      return
+    entry = PageEntry(categories_etag, head, *bounds, len(head) + PAGE_OVERHEAD_BYTES)
+    with self.lock:
+      pages = self.sync(version)
+      # a write was applied while the page was built, the page may be older than it
+      if pages is None or pages.synced != version:
+        return
+      pages.discard((category, page))
+      pages.entries[(category, page)] = entry
+      pages.pages.setdefault(category, set()).add(page)
+      pages.size += entry.size
+      while pages.size > self.max_bytes:
+        self.evictions += 1
+        pages.discard(next(iter(pages.entries)))
+
+  def get_total(self, category, version):
+    with self.lock:
+      pages = self.sync(version)
+      return None if pages is None else pages.totals.get(category)
+
+  def put_total(self, category, version, total):
+    with self.lock:
+      pages = self.sync(version)
+      if pages is not None and pages.synced == version:
+        pages.totals[category] = total
+
+  def on_question_change(self, action, question):
+    # the version committed with the change, None when the writer didn't bump it in this session
+    version = TableVersion.bumped('questions')
+    with self.lock:
+      pages = self.tenant_pages(current_tenant())
+      if action == 'reload' or version is None or pages.synced is None or version > pages.synced + 1:
+        # other writes were committed in between, which this worker wasn't told about
+        pages.drop_all()
+        pages.synced = version
+        return
+      previous_category = getattr(question, 'previous_category', question.category)
+      if action == 'update' and previous_category == question.category:
+        # same place in the same lists, only the text, the difficulty... of the question changed
+        pages.drop_holding(None, question.id)
+        pages.drop_holding(question.category, question.id)
+      elif action == 'update':
+        # the question left a list and joined another one, the list of all the questions keeps its pages
+        pages.drop_holding(None, question.id)
+        # None is the list of all the questions here, not a category: a question without category is in no other list
+        for category in {previous_category, question.category} - {None}:
+          pages.drop_after(category, question.id)
+          pages.totals.pop(category, None)
+      else:
+        pages.drop_after(None, question.id)
+        pages.drop_after(question.category, question.id)
+        pages.totals.clear()
+      pages.synced = max(pages.synced, version)
+
+  def stats(self):
+    with self.lock:
+      return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+              'entries': sum(len(pages.entries) for pages in self.tenants.values()),
+              'bytes': sum(pages.size for pages in self.tenants.values())}
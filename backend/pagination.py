@@ -0,0 +1,79 @@
+import base64
+import binascii
+
+from flask import abort
+
+QUESTIONS_PER_PAGE = 10
+
+'''
+encode_cursor(last_id) / decode_cursor(cursor)
+    opaque keyset cursors: the client only ever sees a url safe token, the server
+    reads it back as "the last id of the previous page"
+'''
+def encode_cursor(last_id):
+  return base64.urlsafe_b64encode(str(last_id).encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+  padded = cursor + '=' * (-len(cursor) % 4)
+  try:
+    return int(base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii'))
+  except (ValueError, binascii.Error, UnicodeError):
+    # a cursor that we didn't produce ourselves is a badly formatted request
+    abort(400)
+
+
+'''
+page_window(args)
+    reads ?after=<cursor> or ?page=<n> from the query string arguments of a request
+    returns (after_id, offset): rows with an id above after_id (when it isn't None) starting at offset,
+    None when the requested page can't have any row (page 0 or negative pages)
+'''
+def page_window(args, per_page=QUESTIONS_PER_PAGE):
+  cursor = args.get('after', None, type=str)
+  if cursor is not None:
+    return decode_cursor(cursor), 0
+  page = args.get('page', 1, type=int)
+  if page < 1:
+    return None
+  return None, (page - 1) * per_page
+
+
+'''
+cut_page(rows)
+    the rows of a page were fetched with one extra row, which tells if there is a next page without a second query
+    returns (rows, next_cursor), next_cursor is None on the last page
+'''
+def cut_page(rows, per_page=QUESTIONS_PER_PAGE):
+  if len(rows) <= per_page:
+    return rows, None
+  rows = rows[:per_page]
+  return rows, encode_cursor(rows[-1].id)
+
+
+'''
+fetch_window(request, query, key)
+    runs the pagination in SQL instead of slicing a fully loaded list
+    - ?page=<n> keeps the old page semantics with LIMIT/OFFSET
+    - ?after=<cursor> seeks past the last row of the previous page (keyset pagination),
+      which stays fast no matter how deep the client goes
+    returns the rows of the page and the first row of the next page, if any, cut_page() tells them apart
+'''
+def fetch_window(request, query, key, per_page=QUESTIONS_PER_PAGE):
+  window = page_window(request.args, per_page)
+  if window is None:
+    return []
+  after_id, offset = window
+
+  if after_id is not None:
+    query = query.filter(key > after_id)
+  query = query.order_by(key).offset(offset)
+  return query.limit(per_page + 1).all()
+
+
+def page_number(args):
+  """the ?page=<n> of a request, None for the cursor pages (?after=) and the pages that can't exist"""
+  if 'after' in args:
+    return None
+  page = args.get('page', 1, type=int)
+  return page if page >= 1 else None
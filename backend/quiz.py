@@ -0,0 +1,413 @@
+import random
+import threading
+import time
+from bisect import bisect_left, insort
+from contextlib import contextmanager, ExitStack
+
+from replicas import on_primary
+from models import db, Question
+
+# after this many seconds the index is reloaded from the database, so questions added
+# by other worker processes end up in the quizzes too
+QUIZ_INDEX_TTL = 300
+
+ALL_CATEGORIES = '0'
+
+# how a quiz question is drawn: 'uniform' gives every question the same chance,
+# 'weighted' favours the questions that were served the least
+STRATEGIES = ('uniform', 'weighted')
+
+# most questions of a round of POST /quizzes/round
+QUIZ_ROUND_MAX_QUESTIONS = 50
+
+# weight of a question that was never served, it is divided by 1 + the number of times it was served
+# the weights are integers so the sums kept by the trees stay exact
+WEIGHT_SCALE = 1 << 16
+
+
+def question_weight(served):
+  return max(1, WEIGHT_SCALE // (1 + served))
+
+
+'''
+quiz_options(request_body)
+    (difficulty, strategy) of the optional fields of a quiz request, raises ValueError when they aren't valid
+    - difficulty: a number, or [lowest, highest] for a band of difficulties, None when it isn't given
+      it is returned as a (lowest, highest) band
+    - strategy: one of STRATEGIES, 'uniform' when it isn't given
+'''
+def quiz_options(request_body):
+  difficulty = request_body.get('difficulty', None)
+  # bool is an int too, true isn't a difficulty
+  if difficulty is None:
+    band = None
+  elif isinstance(difficulty, int) and not isinstance(difficulty, bool):
+    band = (difficulty, difficulty)
+  elif isinstance(difficulty, list) and len(difficulty) == 2 and \
+      all(isinstance(value, int) and not isinstance(value, bool) for value in difficulty) and \
+      difficulty[0] <= difficulty[1]:
+    band = tuple(difficulty)
+  else:
+    raise ValueError('difficulty is a number or a [lowest, highest] band')
+
+  strategy = request_body.get('strategy', 'uniform')
+  if strategy not in STRATEGIES:
+    raise ValueError(f"strategy is one of {', '.join(STRATEGIES)}")
+  return band, strategy
+
+
+'''
+round_options(request_body)
+    (count, previous_questions, seed) of a round request, raises ValueError when they aren't valid
+    - count: the number of questions of the round, 1 to QUIZ_ROUND_MAX_QUESTIONS
+    - previous_questions: the ids left out of the round, [] when it isn't given
+    - seed: a number or a string which makes the round reproducible, None when it isn't given
+'''
+def round_options(request_body):
+  count = request_body.get('count', None)
+  if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= QUIZ_ROUND_MAX_QUESTIONS:
+    raise ValueError(f'count is a number from 1 to {QUIZ_ROUND_MAX_QUESTIONS}')
+
+  previous_questions = request_body.get('previous_questions', [])
+  if not isinstance(previous_questions, list) or \
+      not all(isinstance(question_id, int) for question_id in previous_questions):
+    raise ValueError('previous_questions is a list of question ids')
+
+  seed = request_body.get('seed', None)
+  if isinstance(seed, bool) or not (seed is None or isinstance(seed, (int, str))):
+    raise ValueError('seed is a number or a string')
+  return count, previous_questions, seed
+
+
+'''
+WeightedPool
+    ids with a weight each, drawn with a chance proportional to their weight
+    the weights are summed in a Fenwick tree (binary indexed tree) over the slots of the ids, so adding an id,
+    changing its weight and drawing one all cost O(log n). A new id takes a new slot at the end, a removed id
+    leaves an empty slot of weight 0 behind and the slots are compacted once half of them are empty
+'''
+class WeightedPool:
+
+  def __init__(self, weights):
+    self.build(weights)
+
+  def build(self, weights):
+    """weights is an iterable of (id, weight), the tree is built in O(n)"""
+    self.ids = []
+    self.weights = []
+    self.slots = {}
+    self.tree = [0]
+    for question_id, weight in weights:
+      self.slots[question_id] = len(self.ids)
+      self.ids.append(question_id)
+      self.weights.append(weight)
+      self.tree.append(weight)
+    for index in range(1, len(self.tree)):
+      parent = index + (index & -index)
+      if parent < len(self.tree):
+        self.tree[parent] += self.tree[index]
+
+  def __len__(self):
+    return len(self.slots)
+
+  def __contains__(self, question_id):
+    return question_id in self.slots
+
+  def prefix(self, index):
+    """sum of the weights of the first index slots"""
+    total = 0
+    while index > 0:
+      total += self.tree[index]
+      index -= index & -index
+    return total
+
+  def total(self):
+    return self.prefix(len(self.ids))
+
+  def update(self, slot, delta):
+    index = slot + 1
+    while index < len(self.tree):
+      self.tree[index] += delta
+      index += index & -index
+
+  def add(self, question_id, weight):
+    if question_id in self.slots:
+      self.set_weight(question_id, weight)
+      return
+    self.slots[question_id] = len(self.ids)
+    self.ids.append(question_id)
+    self.weights.append(weight)
+    # the new node covers the slots (index - lowbit(index), index]
+    index = len(self.tree)
+    self.tree.append(weight + self.prefix(index - 1) - self.prefix(index - (index & -index)))
+
+  def remove(self, question_id):
+    slot = self.slots.pop(question_id, None)
+    if slot is None:
+      return
+    self.update(slot, -self.weights[slot])
+    self.weights[slot] = 0
+    if len(self.slots) * 2 < len(self.ids):
+      self.build([(self.ids[slot], self.weights[slot]) for slot in sorted(self.slots.values())])
+
+  def set_weight(self, question_id, weight):
+    slot = self.slots.get(question_id)
+    if slot is not None and weight != self.weights[slot]:
+      self.update(slot, weight - self.weights[slot])
+      self.weights[slot] = weight
+
+  @contextmanager
+  def without(self, question_ids):
+    """the ids get a weight of 0 for the time of the block, yields how many of them are in the pool"""
+    saved = []
+    for question_id in question_ids:
+      slot = self.slots.get(question_id)
+      if slot is not None and self.weights[slot]:
+        saved.append((slot, self.weights[slot]))
+        self.update(slot, -self.weights[slot])
+        self.weights[slot] = 0
+    try:
+      yield len(saved)
+    finally:
+      for slot, weight in saved:
+        self.update(slot, weight)
+        self.weights[slot] = weight
+
+  def find(self, value):
+    """id of the slot where the running sum of the weights goes past value, 0 <= value < total()"""
+    position = 0
+    step = 1 << (len(self.tree).bit_length() - 1)
+    while step:
+      index = position + step
+      if index < len(self.tree) and self.tree[index] <= value:
+        position = index
+        value -= self.tree[index]
+      step >>= 1
+    return self.ids[position]
+
+
+'''
+QuizIndex
+    keeps the ids of the questions in memory, as one sorted list per category and per (category, difficulty),
+    plus the same for all the categories
+    a uniform quiz question is drawn without ever loading the questions of the category:
+    - the previous questions are located in the sorted lists with a binary search
+    - a random rank is chosen among the ids that are left in the lists of the difficulty band
+    - the rank is shifted past the previous questions that come before it
+    so a draw costs O(k log n) for k previous questions, whatever the size of the bank or the progress of the quiz
+    a round of m questions draws m distinct ranks at once (random.sample of a range, nothing is copied), so it
+    costs O((k + m) log n) and its questions are fetched with a single query
+    a weighted draw goes through a WeightedPool of the same ids, built the first time it's needed: the previous
+    questions are left out of the tree for the time of the draw, so it is O(k log n) as well.
+    every draw counts as a serve of the question and lowers its weight. The counts are kept by the process,
+    each worker weights the questions by what it served itself
+'''
+class QuizIndex:
+
+  def __init__(self, ttl=QUIZ_INDEX_TTL):
+    self.ttl = ttl
+    self.pools = None
+    self.weighted = {}
+    self.served = {}
+    self.loaded_at = 0
+    self.lock = threading.RLock()
+
+  def load(self):
+    # (category, None) holds every difficulty of the category
+    pools = {(ALL_CATEGORIES, None): []}
+    # loaded from the primary, a lagging replica would be kept in memory until the next reload
+    with on_primary():
+      rows = db.session.query(Question.id, Question.category, Question.difficulty).order_by(Question.id).all()
+    for question_id, category, difficulty in rows:
+      for key in self.keys(category, difficulty):
+        pools.setdefault(key, []).append(question_id)
+    with self.lock:
+      self.pools = pools
+      self.weighted = {}
+      # the counts of the questions deleted meanwhile are dropped
+      loaded = set(pools[(ALL_CATEGORIES, None)])
+      self.served = {question_id: served for question_id, served in self.served.items() if question_id in loaded}
+      self.loaded_at = time.monotonic()
+
+  def keys(self, category, difficulty):
+    """keys of the pools a question belongs to"""
+    keys = [(ALL_CATEGORIES, None), (str(category), None)]
+    if difficulty is not None:
+      keys += [(ALL_CATEGORIES, difficulty), (str(category), difficulty)]
+    return keys
+
+  def invalidate(self):
+    with self.lock:
+      self.pools = None
+      self.weighted = {}
+
+  def needs_load(self):
+    return self.pools is None or time.monotonic() - self.loaded_at > self.ttl
+
+  def pool_keys(self, category, difficulty=None):
+    """keys of the pools of a category and a (lowest, highest) difficulty band, '0' being all the categories"""
+    if self.needs_load():
+      self.load()
+    if difficulty is None:
+      return [(str(category), None)]
+    lowest, highest = difficulty
+    return sorted(key for key in self.pools
+                  if key[0] == str(category) and key[1] is not None and lowest <= key[1] <= highest)
+
+  def pool(self, category, difficulty=None):
+    """sorted ids of the questions of a category in a difficulty band"""
+    keys = self.pool_keys(category, difficulty)
+    if len(keys) == 1:
+      return self.pools.get(keys[0], [])
+    return sorted(question_id for key in keys for question_id in self.pools[key])
+
+  def size(self, category, difficulty=None):
+    with self.lock:
+      return sum(len(self.pools.get(key, [])) for key in self.pool_keys(category, difficulty))
+
+  def sample(self, category, previous_questions, difficulty=None, strategy='uniform'):
+    """returns (question_id, remaining), question_id is None when no question is left"""
+    with self.lock:
+      keys = self.pool_keys(category, difficulty)
+      if strategy == 'weighted':
+        question_id, remaining = self.sample_weighted(keys, previous_questions)
+      else:
+        question_id, remaining = self.sample_uniform(keys, previous_questions)
+      if question_id is not None:
+        self.serve(question_id)
+      return question_id, remaining
+
+  def sample_round(self, category, count, previous_questions, difficulty=None, strategy='uniform', seed=None):
+    """returns (question_ids, remaining), up to count distinct ids in the order of the draw and the number of ids
+    that were left to draw from. With a seed the uniform rounds are the same as long as the pool doesn't change
+    (the weighted ones also depend on what the worker served)"""
+    rng = random if seed is None else random.Random(seed)
+    with self.lock:
+      keys = self.pool_keys(category, difficulty)
+      if strategy == 'weighted':
+        question_ids, remaining = self.sample_weighted_round(keys, count, previous_questions, rng)
+      else:
+        pools, remaining = self.uniform_pools(keys, previous_questions)
+        question_ids = [self.uniform_id(pools, rank) for rank in rng.sample(range(remaining), min(count, remaining))]
+      for question_id in question_ids:
+        self.serve(question_id)
+      return question_ids, remaining
+
+  def uniform_pools(self, keys, previous_questions):
+    """([(ids, sorted positions of the previous questions in ids)], number of ids left) of the pools of keys"""
+    pools = []
+    for key in keys:
+      ids = self.pools.get(key, [])
+      # only the previous questions that really are in this pool count, ids from other categories are ignored
+      excluded = set()
+      for previous_id in previous_questions:
+        position = bisect_left(ids, previous_id)
+        if position < len(ids) and ids[position] == previous_id:
+          excluded.add(position)
+      pools.append((ids, sorted(excluded)))
+    return pools, sum(len(ids) - len(excluded) for ids, excluded in pools)
+
+  def sample_uniform(self, keys, previous_questions):
+    pools, remaining = self.uniform_pools(keys, previous_questions)
+    if remaining == 0:
+      return None, 0
+    return self.uniform_id(pools, random.randrange(remaining)), remaining
+
+  def uniform_id(self, pools, rank):
+    """the id of the rank-th id left in the pools of uniform_pools(), 0 <= rank < remaining"""
+    for ids, excluded in pools:
+      if rank >= len(ids) - len(excluded):
+        rank -= len(ids) - len(excluded)
+        continue
+      for position in excluded:
+        if position > rank:
+          break
+        rank += 1
+      return ids[rank]
+
+  def sample_weighted(self, keys, previous_questions, rng=random):
+    pools = [self.weighted_pool(key) for key in keys]
+    with ExitStack() as stack:
+      remaining = 0
+      for pool in pools:
+        remaining += len(pool) - stack.enter_context(pool.without(set(previous_questions)))
+      if remaining == 0:
+        return None, 0
+
+      value = rng.randrange(sum(pool.total() for pool in pools))
+      for pool in pools:
+        total = pool.total()
+        if value < total:
+          return pool.find(value), remaining
+        value -= total
+
+  def sample_weighted_round(self, keys, count, previous_questions, rng):
+    # one draw after the other, the questions already drawn are left out of the next ones
+    excluded = set(previous_questions)
+    question_ids = []
+    remaining = None
+    while len(question_ids) < count:
+      question_id, left = self.sample_weighted(keys, excluded, rng)
+      remaining = left if remaining is None else remaining
+      if question_id is None:
+        break
+      question_ids.append(question_id)
+      excluded.add(question_id)
+    return question_ids, remaining
+
+  def weighted_pool(self, key):
+    pool = self.weighted.get(key)
+    if pool is None:
+      pool = WeightedPool((question_id, question_weight(self.served.get(question_id, 0)))
+                          for question_id in self.pools.get(key, []))
+      self.weighted[key] = pool
+    return pool
+
+  def serve(self, question_id):
+    served = self.served.get(question_id, 0) + 1
+    self.served[question_id] = served
+    weight = question_weight(served)
+    for pool in self.weighted.values():
+      pool.set_weight(question_id, weight)
+
+  def draw(self, category, count):
+    """up to count distinct ids of the category in a random order, without copying the whole pool"""
+    with self.lock:
+      ids = self.pool(category)
+      return random.sample(ids, min(len(ids), count))
+
+  def add(self, question_id, category, difficulty):
+    with self.lock:
+      if self.pools is None:
+        return
+      weight = question_weight(self.served.get(question_id, 0))
+      for key in self.keys(category, difficulty):
+        ids = self.pools.setdefault(key, [])
+        position = bisect_left(ids, question_id)
+        if position == len(ids) or ids[position] != question_id:
+          insort(ids, question_id)
+        if key in self.weighted:
+          self.weighted[key].add(question_id, weight)
+
+  def discard(self, question_id):
+    with self.lock:
+      if self.pools is None:
+        return
+      for ids in self.pools.values():
+        position = bisect_left(ids, question_id)
+        if position < len(ids) and ids[position] == question_id:
+          del ids[position]
+      for pool in self.weighted.values():
+        pool.remove(question_id)
+
+  def on_question_change(self, action, question):
+    if action == 'insert':
+      self.add(question.id, question.category, question.difficulty)
+    elif action == 'delete':
+      self.discard(question.id)
+      self.served.pop(question.id, None)
+    elif action == 'update':
+      self.discard(question.id)
+      self.add(question.id, question.category, question.difficulty)
+    elif action == 'reload':
+      self.invalidate()
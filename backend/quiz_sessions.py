@@ -0,0 +1,103 @@
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# no quiz goes that far, so a session never holds more ids than this whatever the size of the category
+QUIZ_SESSION_MAX_QUESTIONS = 1000
+
+'''
+MemorySessionStore
+    quiz sessions kept in the worker process, each one is a compact array of the question ids left to ask
+    the ids are already shuffled so the next question is popped from the end in O(1)
+    a session expires after ttl seconds without a question, beyond max_sessions the least recently used go first
+'''
+class MemorySessionStore:
+
+  def __init__(self, ttl, max_sessions):
+    self.ttl = ttl
+    self.max_sessions = max_sessions
+    # session_id -> [expires_at, ids], ordered from the least to the most recently used
+    self.sessions = OrderedDict()
+    self.lock = threading.Lock()
+
+  def evict(self, now):
+    # the sessions are ordered by last use, so the expired ones are all at the front
+    while self.sessions:
+      session_id, (expires_at, ids) = next(iter(self.sessions.items()))
+      if expires_at > now and len(self.sessions) <= self.max_sessions:
+        break
+      del self.sessions[session_id]
+
+  def create(self, question_ids):
+    session_id = secrets.token_urlsafe(16)
+    now = time.monotonic()
+    with self.lock:
+      self.sessions[session_id] = [now + self.ttl, array('l', question_ids)]
+      self.evict(now)
+    return session_id
+
+  def pop(self, session_id):
+    """returns the next question id, None when the session is over, raises KeyError for unknown sessions"""
+    now = time.monotonic()
+    with self.lock:
+      session = self.sessions[session_id]
+      if session[0] <= now:
+        del self.sessions[session_id]
+        raise KeyError(session_id)
+      session[0] = now + self.ttl
+      self.sessions.move_to_end(session_id)
+      ids = session[1]
+      return ids.pop() if ids else None
+
+  def delete(self, session_id):
+    with self.lock:
+      self.sessions.pop(session_id, None)
+
+
+'''
+RedisSessionStore
+    same sessions kept in redis lists so every worker process shares them,
+    redis takes care of the TTL eviction and of the memory footprint (maxmemory)
+'''
+class RedisSessionStore:
+
+  def __init__(self, url, ttl):
+    # optional dependency, only needed when QUIZ_SESSION_STORE is a redis url
+    import redis
+    self.client = redis.Redis.from_url(url)
+    self.ttl = ttl
+
+  def create(self, question_ids):
+    session_id = secrets.token_urlsafe(16)
+    pipeline = self.client.pipeline()
+    # an empty list doesn't exist in redis, the alive key tells a finished session from an unknown one
+    pipeline.set(f'quiz_session:{session_id}:alive', 1, ex=self.ttl)
+    if question_ids:
+      pipeline.rpush(f'quiz_session:{session_id}', *question_ids)
+      pipeline.expire(f'quiz_session:{session_id}', self.ttl)
+    pipeline.execute()
+    return session_id
+
+  def pop(self, session_id):
+    pipeline = self.client.pipeline()
+    pipeline.rpop(f'quiz_session:{session_id}')
+    pipeline.expire(f'quiz_session:{session_id}:alive', self.ttl)
+    pipeline.expire(f'quiz_session:{session_id}', self.ttl)
+    question_id, alive, _ = pipeline.execute()
+    if not alive:
+      raise KeyError(session_id)
+    return None if question_id is None else int(question_id)
+
+  def delete(self, session_id):
+    self.client.delete(f'quiz_session:{session_id}', f'quiz_session:{session_id}:alive')
+
+
+def create_session_store(config):
+  """the store of the QUIZ_SESSION_* settings of an app config"""
+  store = config['QUIZ_SESSION_STORE']
+  if store.startswith('redis://') or store.startswith('rediss://') or store.startswith('unix://'):
+    return RedisSessionStore(store, config['QUIZ_SESSION_TTL'])
+  return MemorySessionStore(config['QUIZ_SESSION_TTL'], config['QUIZ_SESSION_MAX_SESSIONS'])
+
@@ -0,0 +1,167 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import exc, orm
+
+from tenants import current_tenant, tenant_bind
+
+# cookie sent back after a write, until its time the reads of the client stay on the primary
+PRIMARY_COOKIE = 'db_primary_until'
+
+
+'''
+ReplicaRouter
+    picks the read replica of the next read-only request, in turn, skipping the replicas which failed
+    during the last retry_seconds. pick() gives None, the primary, when there is no replica left
+    the keys are the flask-sqlalchemy binds of the replicas (replica_0, replica_1...)
+'''
+class ReplicaRouter:
+
+  def __init__(self, keys, sticky_seconds, retry_seconds):
+    self.keys = list(keys)
+    self.sticky_seconds = sticky_seconds
+    self.retry_seconds = retry_seconds
+    self.down_until = {}
+    self.turns = itertools.count()
+    self.lock = threading.Lock()
+
+  def pick(self):
+    now = time.time()
+    with self.lock:
+      for _ in self.keys:
+        key = self.keys[next(self.turns) % len(self.keys)]
+        if self.down_until.get(key, 0) <= now:
+          return key
+    return None
+
+  def mark_down(self, key):
+    with self.lock:
+      self.down_until[key] = time.time() + self.retry_seconds
+
+  def is_down(self, key):
+    return self.down_until.get(key, 0) > time.time()
+
+  def is_sticky(self, cookies):
+    """True while the client who sent these cookies has to read its own writes"""
+    try:
+      return float(cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+      return False
+
+  def stick(self, response):
+    response.set_cookie(PRIMARY_COOKIE, str(time.time() + self.sticky_seconds), max_age=self.sticky_seconds)
+
+
+def configure_replicas(app):
+  """adds a bind for every uri of DB_REPLICA_URIS and the router of the app"""
+  binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+  keys = []
+  for index, uri in enumerate(app.config['DB_REPLICA_URIS']):
+    keys.append(f'replica_{index}')
+    binds[keys[-1]] = uri
+  app.config['SQLALCHEMY_BINDS'] = binds
+  app.extensions['replica_router'] = ReplicaRouter(keys, app.config['DB_REPLICA_STICKY_SECONDS'],
+                                                   app.config['DB_REPLICA_RETRY_SECONDS'])
+
+
+'''
+read_replica(view)
+    decorator of the read-only views: their queries go to a replica, unless the client wrote during the last
+    DB_REPLICA_STICKY_SECONDS. When the replica can't be reached the view runs again on the next one,
+    then on the primary
+'''
+def read_replica(view):
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    router = current_app.extensions.get('replica_router')
+    # the replicas are the ones of the default database, the tenants only have their primary
+    if router is None or not router.keys or current_tenant() is not None or router.is_sticky(request.cookies):
+      return view(*args, **kwargs)
+
+    g.db_replica = router.pick()
+    while True:
+      try:
+        return view(*args, **kwargs)
+      except exc.OperationalError:
+        if g.db_replica is None:
+          raise
+        current_app.extensions['sqlalchemy'].db.session.rollback()
+        router.mark_down(g.db_replica)
+        g.db_replica = router.pick()
+  return wrapper
+
+
+@contextmanager
+def on_primary():
+  """runs the queries of the block on the primary, for the in memory caches which outlive the request"""
+  replica = g.pop('db_replica', None) if has_request_context() else None
+  try:
+    yield
+  finally:
+    if replica is not None:
+      g.db_replica = replica
+
+
+def on_replica():
+  """True when the queries of the current request go to a replica"""
+  return has_request_context() and g.get('db_replica') is not None
+
+
+def remember_write(response):
+  """after_request of the app: the client who just wrote reads from the primary for a while"""
+  router = current_app.extensions.get('replica_router')
+  if g.get('db_wrote') and router is not None and router.keys:
+    router.stick(response)
+  return response
+
+
+'''
+RoutingSession
+    session of the app which sends the queries of the read_replica views to the replica picked for the request
+    the flushes always go to the primary, and a commit marks the request as a write for remember_write
+    the queries of a request of a tenant all go to the database of the tenant
+'''
+class RoutingSession(SignallingSession):
+
+  def __init__(self, db, **options):
+    self.db = db
+    super().__init__(db, **options)
+
+  def get_bind(self, mapper=None, clause=None):
+    tenant = current_tenant()
+    if tenant is not None:
+      return self.db.get_engine(self.app, bind=tenant_bind(tenant))
+    replica = g.get('db_replica') if has_request_context() else None
+    if replica is not None and not self._flushing:
+      return self.db.get_engine(self.app, bind=replica)
+    return super().get_bind(mapper, clause)
+
+  def commit(self):
+    super().commit()
+    if has_request_context():
+      g.db_wrote = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+  def apply_driver_hacks(self, app, sa_url, options):
+    # the options of the database of this engine, the primary, a replica or a tenant
+    from models import engine_options
+    options.update(engine_options(app.config, str(sa_url)))
+    return super().apply_driver_hacks(app, sa_url, options)
+
+  def create_engine(self, sa_url, engine_opts):
+    engine = super().create_engine(sa_url, engine_opts)
+    # the pragmas of the embedded backend on every SQLite database, see embedded.py
+    if engine.dialect.name == 'sqlite':
+      from embedded import tune_sqlite
+      tune_sqlite(engine, self.get_app().config)
+    return engine
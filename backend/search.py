@@ -0,0 +1,192 @@
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+
+from sqlalchemy import text
+
+from models import db, Question
+
+# after this many seconds the in memory index is rebuilt, so questions written by other worker processes are found too
+SEARCH_INDEX_TTL = 300
+
+# same expression in the GIN index and in the queries, otherwise postgres can't use the index
+SEARCH_DOCUMENT = "to_tsvector('simple', coalesce(question, '') || ' ' || coalesce(answer, ''))"
+SEARCH_INDEX_DDL = f"CREATE INDEX IF NOT EXISTS ix_questions_search ON questions USING GIN ({SEARCH_DOCUMENT})"
+
+# words of the question count more than the words of the answer in the ranking
+QUESTION_WEIGHT = 2
+ANSWER_WEIGHT = 1
+
+
+def tokenize(sentence):
+  return re.findall(r'\w+', (sentence or '').lower())
+
+
+'''
+PostgresSearch
+    full text search on a GIN index of the question and the answer, every word of the search term
+    is a prefix so "wor" still finds "World". Ranking, counting and pagination all happen in SQL
+'''
+class PostgresSearch:
+
+  def create_index(self):
+    db.session.execute(text(SEARCH_INDEX_DDL))
+    db.session.commit()
+
+  def search(self, search_term, page, per_page):
+    """returns (ids of the page ordered by rank, number of matching questions)"""
+    terms = tokenize(search_term)
+    if not terms:
+      query = db.session.query(Question.id).order_by(Question.id)
+      return [row.id for row in query.offset((page - 1) * per_page).limit(per_page)], query.order_by(None).count()
+
+    ts_query = ' & '.join(term + ':*' for term in terms)
+    matches = f"{SEARCH_DOCUMENT} @@ to_tsquery('simple', :ts_query)"
+    rows = db.session.execute(text(
+      f"SELECT id FROM questions WHERE {matches} "
+      f"ORDER BY ts_rank({SEARCH_DOCUMENT}, to_tsquery('simple', :ts_query)) DESC, id "
+      "LIMIT :limit OFFSET :offset"
+    ), {'ts_query': ts_query, 'limit': per_page, 'offset': (page - 1) * per_page}).fetchall()
+    total = db.session.execute(text(f"SELECT count(*) FROM questions WHERE {matches}"), {'ts_query': ts_query}).scalar()
+    return [row[0] for row in rows], total
+
+  def on_question_change(self, action, question):
+    # the GIN index is maintained by postgres itself
+    pass
+
+
+'''
+InvertedIndex
+    in process search index for the databases without full text search (sqlite)
+    word -> {question id: weight}, the words are also kept sorted so a prefix is found with a binary search
+'''
+class InvertedIndex:
+
+  def __init__(self, ttl=SEARCH_INDEX_TTL):
+    self.ttl = ttl
+    self.postings = None
+    self.words = []
+    self.documents = {}
+    self.loaded_at = 0
+    self.loading = False
+    self.lock = threading.RLock()
+
+  def create_index(self):
+    with self.lock:
+      self.postings = {}
+      self.words = []
+      self.documents = {}
+      # while loading, the words are sorted once at the end instead of one insertion at a time
+      self.loading = True
+      rows = db.session.query(Question.id, Question.question, Question.answer).all()
+      for question_id, question, answer in rows:
+        self.add(question_id, question, answer)
+      self.words.sort()
+      self.loading = False
+      self.loaded_at = time.monotonic()
+
+  def invalidate(self):
+    with self.lock:
+      self.postings = None
+
+  def ensure_loaded(self):
+    if self.postings is None or time.monotonic() - self.loaded_at > self.ttl:
+      self.create_index()
+
+  def add(self, question_id, question, answer):
+    weights = {}
+    for word in tokenize(question):
+      weights[word] = weights.get(word, 0) + QUESTION_WEIGHT
+    for word in tokenize(answer):
+      weights[word] = weights.get(word, 0) + ANSWER_WEIGHT
+    self.documents[question_id] = weights
+    for word, weight in weights.items():
+      if word not in self.postings:
+        self.postings[word] = {}
+        if self.loading:
+          self.words.append(word)
+        else:
+          insort(self.words, word)
+      self.postings[word][question_id] = weight
+
+  def discard(self, question_id):
+    for word in self.documents.pop(question_id, {}):
+      posting = self.postings.get(word)
+      if posting is None:
+        continue
+      posting.pop(question_id, None)
+      if not posting:
+        del self.postings[word]
+        position = bisect_left(self.words, word)
+        if position < len(self.words) and self.words[position] == word:
+          del self.words[position]
+
+  def prefix_scores(self, prefix):
+    scores = {}
+    position = bisect_left(self.words, prefix)
+    while position < len(self.words) and self.words[position].startswith(prefix):
+      for question_id, weight in self.postings[self.words[position]].items():
+        scores[question_id] = scores.get(question_id, 0) + weight
+      position += 1
+    return scores
+
+  def search(self, search_term, page, per_page):
+    """returns (ids of the page ordered by rank, number of matching questions)"""
+    with self.lock:
+      self.ensure_loaded()
+      terms = tokenize(search_term)
+      if not terms:
+        ranked = sorted(self.documents)
+      else:
+        # every word of the search term has to match, the scores of the words add up
+        scores = self.prefix_scores(terms[0])
+        for term in terms[1:]:
+          term_scores = self.prefix_scores(term)
+          scores = {question_id: score + term_scores[question_id]
+                    for question_id, score in scores.items() if question_id in term_scores}
+        ranked = sorted(scores, key=lambda question_id: (-scores[question_id], question_id))
+    start = (page - 1) * per_page
+    return ranked[start:start + per_page], len(ranked)
+
+  def on_question_change(self, action, question):
+    if action == 'reload':
+      self.invalidate()
+      return
+    with self.lock:
+      if self.postings is None:
+        return
+      if action in ('delete', 'update'):
+        self.discard(question.id)
+      if action in ('insert', 'update'):
+        self.add(question.id, question.question, question.answer)
+
+
+'''
+QuestionSearch
+    picks the search backend of the database the app is bound to the first time it is used
+'''
+class QuestionSearch:
+
+  def __init__(self):
+    self.backend = None
+
+  def get_backend(self):
+    if self.backend is None:
+      if db.session.get_bind().dialect.name == 'postgresql':
+        self.backend = PostgresSearch()
+      else:
+        self.backend = InvertedIndex()
+    return self.backend
+
+  def create_index(self):
+    self.get_backend().create_index()
+
+  def search(self, search_term, page, per_page):
+    if page < 1:
+      return [], 0
+    return self.get_backend().search(search_term, page, per_page)
+
+  def on_question_change(self, action, question):
+    if self.backend is not None:
+      self.backend.on_question_change(action, question)
@@ -0,0 +1,71 @@
+import json
+from collections import namedtuple
+
+from flask import current_app
+
+from models import db, Question
+
+try:
+  # optional dependency, several times faster than the json module when it is installed
+  import orjson
+except ImportError:
+  orjson = None
+
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty', 'version')
+
+'''
+QuestionRow
+    read only question as returned by question_rows(), a plain tuple without the ORM state of a Question
+'''
+QuestionRow = namedtuple('QuestionRow', QUESTION_FIELDS)
+
+
+'''
+question_rows()
+    query of the question columns only: SQLAlchemy returns tuples, so no Question object is built
+    and nothing is added to the identity map. Use it with .filter(), fetch_window()... like Question.query
+'''
+def question_rows():
+  return db.session.query(*[getattr(Question, field) for field in QUESTION_FIELDS])
+
+
+def get_question_row(question_id):
+  """the QuestionRow of a question, None if it doesn't exist"""
+  row = question_rows().filter(Question.id == question_id).first()
+  return None if row is None else QuestionRow(*row)
+
+
+def get_question_rows(question_ids):
+  """{id: QuestionRow} of the questions of question_ids in one query, the ids which don't exist are left out"""
+  if not question_ids:
+    return {}
+  return {row[0]: QuestionRow(*row) for row in question_rows().filter(Question.id.in_(question_ids))}
+
+
+def format_row(row):
+  """same dict as Question.format() for a row of question_rows() or a QuestionRow"""
+  return dict(zip(QUESTION_FIELDS, row))
+
+
+def format_rows(rows):
+  return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
+'''
+dumps(payload)
+    the JSON bytes of a payload, with orjson when it is installed and the json module otherwise
+    the keys of the dicts can be numbers like with jsonify (the ids of the categories)
+'''
+if orjson is not None:
+  def dumps(payload):
+    return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+else:
+  _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+  def dumps(payload):
+    return _encoder.encode(payload).encode('utf-8')
+
+
+def json_response(payload, status=200):
+  """drop in replacement of jsonify for the hot endpoints, without the indentation and the key sorting"""
+  return current_app.response_class(dumps(payload), status=status, mimetype='application/json')
@@ -0,0 +1,140 @@
+import contextvars
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+import click
+from flask import current_app
+
+# tenant of the request handled by the current thread or task, None for the default question bank
+# a context variable and not flask.g, so the coroutines of the async mode see it too
+request_tenant = contextvars.ContextVar('request_tenant', default=None)
+
+
+class UnknownTenant(Exception):
+  """the request names a tenant which isn't in TENANT_DATABASE_URIS"""
+
+
+def tenant_bind(tenant):
+  """the flask-sqlalchemy bind of the database of a tenant"""
+  return f'tenant_{tenant}'
+
+
+def configure_tenants(app):
+  """adds a bind for the database of every tenant of TENANT_DATABASE_URIS"""
+  binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+  for tenant, uri in app.config['TENANT_DATABASE_URIS'].items():
+    binds[tenant_bind(tenant)] = uri
+  app.config['SQLALCHEMY_BINDS'] = binds
+
+
+'''
+tenant_of(headers, host, config)
+    the tenant named by a request: the subdomain of TENANT_DOMAIN, else the TENANT_HEADER header
+    (acme.trivia.example.com is the tenant acme for TENANT_DOMAIN=trivia.example.com)
+    the host wins over the header, a header naming another tenant than the subdomain is refused, so a client of
+    one subdomain can't reach the question bank of another tenant with it
+    returns None for the requests which don't name one, they use the default question bank
+    raises UnknownTenant for a tenant which isn't configured, or which the header and the subdomain disagree on
+'''
+def tenant_of(headers, host, config):
+  tenant = headers.get(config['TENANT_HEADER'])
+  domain = config['TENANT_DOMAIN'].lower()
+  host = (host or '').split(':')[0].lower()
+  if domain and host.endswith('.' + domain):
+    host_tenant = host[:-len(domain) - 1]
+    if tenant and tenant != host_tenant:
+      raise UnknownTenant(tenant)
+    tenant = host_tenant
+  if not tenant:
+    return None
+  if tenant not in config['TENANT_DATABASE_URIS']:
+    raise UnknownTenant(tenant)
+  return tenant
+
+
+def current_tenant():
+  return request_tenant.get()
+
+
+@contextmanager
+def use_tenant(tenant):
+  """runs the block on the question bank of a tenant, outside of a request (commands, tests)"""
+  token = request_tenant.set(tenant)
+  try:
+    yield
+  finally:
+    request_tenant.reset(token)
+
+
+def tenant_option(command):
+  """--tenant option of a flask command, the command runs on the question bank of that tenant"""
+  @click.option('--tenant', default=None, help='tenant of TENANT_DATABASE_URIS, the default database otherwise')
+  @wraps(command)
+  def wrapper(*args, tenant=None, **kwargs):
+    if tenant is not None and tenant not in current_app.config['TENANT_DATABASE_URIS']:
+      raise click.BadParameter(f'{tenant} is not in TENANT_DATABASE_URIS', param_hint='--tenant')
+    with use_tenant(tenant):
+      return command(*args, **kwargs)
+  return wrapper
+
+
+def scoped_session_id(session_id):
+  """the id of a quiz session given to the client, it names the tenant the session belongs to"""
+  tenant = current_tenant()
+  return session_id if tenant is None else f'{tenant}.{session_id}'
+
+
+def unscoped_session_id(scoped_id):
+  """the id of a quiz session in the store, raises KeyError for the sessions of another tenant"""
+  # the ids of the stores are url safe base64, without any dot
+  tenant, _, session_id = scoped_id.rpartition('.')
+  if (tenant or None) != current_tenant():
+    raise KeyError(scoped_id)
+  return session_id
+
+
+'''
+TenantCaches(factory, max_tenants)
+    one in memory cache (CategoryCache, QuizIndex...) per tenant, created by factory on the first request of the tenant
+    the attributes are the ones of the cache of the current tenant, so the views use it like a single cache
+    at most max_tenants caches are kept, the least recently used tenant loses its cache first and loads it again
+    on its next request. A big tenant only ever fills its own cache, it can't push out the data of the others
+'''
+class TenantCaches:
+
+  def __init__(self, factory, max_tenants):
+    self.tenant_factory = factory
+    self.max_tenants = max(1, max_tenants)
+    self.tenant_caches = OrderedDict()
+    self.tenant_lock = threading.Lock()
+
+  def get(self, tenant):
+    with self.tenant_lock:
+      cache = self.tenant_caches.get(tenant)
+      if cache is None:
+        cache = self.tenant_caches[tenant] = self.tenant_factory()
+        while len(self.tenant_caches) > self.max_tenants:
+          self.tenant_caches.popitem(last=False)
+      else:
+        self.tenant_caches.move_to_end(tenant)
+      return cache
+
+  def current(self):
+    return self.get(current_tenant())
+
+  def __getattr__(self, name):
+    # only called for the attributes TenantCaches doesn't have itself
+    if name.startswith('tenant_'):
+      raise AttributeError(name)
+    return getattr(self.current(), name)
+
+  def listener(self, method):
+    """a question or category listener which calls method on the cache of the current tenant, if it has one"""
+    def listener(action, value):
+      with self.tenant_lock:
+        cache = self.tenant_caches.get(current_tenant())
+      if cache is not None:
+        getattr(cache, method)(action, value)
+    return listener
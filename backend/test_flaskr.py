@@ -1,50 +1,378 @@
+import asyncio
+import gzip
 import os
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
 import json
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Integer, create_engine, event, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import NullPool
+from werkzeug.datastructures import Headers
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import create_app, warm_up
+from models import db, add_question_listener, engine_options, Question, QuestionChange, QuestionCount, Category, \
+    TableVersion
+from bulk import import_questions
+from backfill import backfill_categories
+from tenants import TenantCaches, use_tenant
+from page_cache import PageCache
+from limits import LoadShedder, MemoryBucketStore
+from embedded import copy_value, read_copy_blocks
+from serialization import dumps
 
 # VERY IMPORTANT:
 ## 1) PLEASE MAKE SURE TO ADJUST THE DATABASE URI BECAUSE I HAD TO CHANGE IT TO MAKE IT WORK ON MY PC
 
 ## 2) PLEASE MAKE SURE TO RESET THE DATABASE SO ALL THE TESTS WILL FUNCTION psql trivia_test < trivia.psql
+##    (an empty database gets the data of trivia.psql when the tests start, and TEST_DATABASE_URI=sqlite:////tmp/trivia_test.db
+##    runs them on a SQLite file without postgres)
 
 
 DB_HOST = os.getenv('DB_HOST', '127.0.0.1:5432')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
 DB_NAME = os.getenv('DB_NAME', 'trivia_test')
-DB_PATH = 'postgresql://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
+DB_PATH = os.getenv('TEST_DATABASE_URI', 'postgresql://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME))
+TRIVIA_PSQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trivia.psql')
+# APP_MODE=asgi runs the same tests against the async serving mode of asgi.py
+APP_MODE = os.getenv('APP_MODE', 'wsgi')
+
+
+class AsgiResponse:
+    """the response of AsgiClient, with the status_code, headers, data and mimetype of a Flask test response"""
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+        self.mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+
+    def get_data(self):
+        return self.data
+
+
+class AsgiClient:
+    """the ASGI counterpart of the Flask test client, enough for these tests to run against the async mode:
+    get/post/patch/delete(path, json=..., data=..., content_type=..., headers=...) return an AsgiResponse,
+    the event loop of the client is kept between the requests"""
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = asyncio.new_event_loop()
+
+    def open(self, path, method='GET', json=None, data=None, content_type=None, headers=None):
+        path, _, query_string = path.partition('?')
+        request_headers = Headers(headers or {})
+        if json is not None:
+            data = dumps(json)
+            content_type = 'application/json'
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data = data or b''
+        if content_type is not None:
+            request_headers['Content-Type'] = content_type
+        request_headers['Content-Length'] = str(len(data))
+
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode('utf-8'),
+            'query_string': query_string.encode('utf-8'),
+            'root_path': '',
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in request_headers],
+            'server': ('localhost', 80),
+            'client': ('127.0.0.1', 0),
+        }
+        messages = [{'type': 'http.request', 'body': data, 'more_body': False}]
+        response = {'body': b''}
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            # nothing else to read, wait like a client that keeps the connection open
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                                               for name, value in message['headers']])
+            else:
+                response['body'] += message.get('body', b'')
+
+        self.loop.run_until_complete(self.app(scope, receive, send))
+        return AsgiResponse(response['status'], response['headers'], response['body'])
+
+    def close(self):
+        """shuts the app down like a server does, so its pools close their connections, then closes the event loop"""
+        messages = [{'type': 'lifespan.shutdown'}]
+
+        async def receive():
+            return messages.pop()
+
+        async def send(message):
+            pass
+
+        self.loop.run_until_complete(self.app({'type': 'lifespan'}, receive, send))
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+
+    def get(self, path, **kwargs):
+        return self.open(path, method='GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, method='POST', **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.open(path, method='PATCH', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, method='DELETE', **kwargs)
+
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """create the missing tables once, with the init-db command, then load trivia.psql into an empty database"""
+        app = create_app({'SQLALCHEMY_DATABASE_URI': DB_PATH, 'DB_CREATE_ALL': False})
+        app.test_cli_runner().invoke(args=['init-db'])
+        create_app({'SQLALCHEMY_DATABASE_URI': DB_PATH, 'DB_CREATE_ALL': False, 'EMBEDDED_SEED': TRIVIA_PSQL})
+
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
+        self.app, self.client = self.create_client()
         self.database_name = DB_NAME
         self.database_path = DB_PATH
-        setup_db(self.app, self.database_path)
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
+    def create_client(self, test_config=None):
+        """the Flask app and the test client of the APP_MODE, on the test database whose tables already exist"""
+        test_config = {'SQLALCHEMY_DATABASE_URI': DB_PATH, 'DB_CREATE_ALL': False, **(test_config or {})}
+        if APP_MODE == 'asgi':
+            from asgi import create_asgi_app
+            asgi_app = create_asgi_app(test_config)
+            asgi_client = AsgiClient(asgi_app)
+            # closes the async pools of the app, their connection threads would keep the tests from exiting
+            self.addCleanup(asgi_client.close)
+            return asgi_app.flask_app, lambda: asgi_client
+        app = create_app(test_config)
+        return app, app.test_client
+
+    def unreachable_replica(self):
+        """a database of the same kind as the primary which can't be reached"""
+        url = make_url(self.app.config['SQLALCHEMY_DATABASE_URI'])
+        if url.get_backend_name() == 'sqlite':
+            url.database = '/nonexistent/replica.db'
+        else:
+            url.port = 1
+        return str(url)
+
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        # the queries of the tests made outside of an app context leave a session bound to this app
+        db.session.remove()
 
     """
     DONE
     Write at least one test for each test for successful operation and for expected errors.
     """
 
+    # ================================================================================
+    # tests for the metrics
+    # ================================================================================
+    def test_get_metrics(self):
+        """test if the /metrics endpoint reports the latency and the SQL statements of the endpoints"""
+        self.client().get('/questions')
+        res = self.client().get('/metrics')
+        metrics = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_request_duration_seconds_count{endpoint="/questions",method="GET"} 1', metrics)
+        self.assertIn('trivia_responses_total{endpoint="/questions",method="GET",status="200"} 1', metrics)
+        self.assertIn('trivia_sql_statements_total{endpoint="/questions",method="GET"}', metrics)
+        self.assertIn('trivia_db_pool_checkouts_total', metrics)
+        self.assertIn('trivia_db_pool_checked_out_peak', metrics)
+
+    def test_profile_file_name(self):
+        """test if a profiled request gets back the file name of its profile, not its path on the server"""
+        profile_dir = tempfile.mkdtemp()
+        _, client = self.create_client({'PROFILING_ENABLED': True, 'PROFILE_DIR': profile_dir})
+        res = client().get('/questions/export?format=csv', headers={'X-Profile': 'cprofile'})
+        name = res.headers['X-Profile-File']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(os.path.basename(name), name)
+        self.assertTrue(os.path.isfile(os.path.join(profile_dir, name)))
+
+    def test_engine_options(self):
+        """test if the pool settings of the config are given to the engine, and left out in PgBouncer mode"""
+        config = dict(self.app.config, DB_POOL_SIZE=20, DB_STATEMENT_TIMEOUT=5000, DB_PGBOUNCER=False)
+        options = engine_options(config, 'postgresql://trivia@localhost/trivia')
+
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+
+        options = engine_options(dict(config, DB_PGBOUNCER=True), 'postgresql://trivia@localhost/trivia')
+
+        self.assertEqual(options['poolclass'], NullPool)
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('connect_args', options)
+
+    def test_engine_options_of_every_bind(self):
+        """test if a sqlite tenant next to a postgres primary gets the options of sqlite"""
+        sqlite_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'acme.db')
+        app, _ = self.create_client({'DB_POOL_SIZE': 20, 'DB_STATEMENT_TIMEOUT': 5000,
+                                     'TENANT_DATABASE_URIS': {'acme': sqlite_uri}})
+        with app.app_context():
+            engine = db.get_engine(app, bind='tenant_acme')
+            with engine.connect() as connection:
+                self.assertEqual(connection.execute('select 1').scalar(), 1)
+
+        options = engine_options(app.config, sqlite_uri)
+        # the pool of the config, without the statement_timeout of postgres
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['connect_args'], {'check_same_thread': False})
+        self.assertEqual(engine_options(app.config, 'sqlite://'), {'pool_pre_ping': app.config['DB_POOL_PRE_PING']})
+
+    def test_pool_watched_by_first_request(self):
+        """test if the engine is created by the first request and not by create_app, with its pool in the metrics"""
+        instrumentation = self.app.extensions['instrumentation']
+        pool_before = instrumentation.pool
+        metrics = self.client().get('/metrics').data.decode('utf-8')
+
+        self.assertIsNone(pool_before)
+        with self.app.app_context():
+            self.assertIs(instrumentation.pool, db.get_engine(self.app).pool)
+        self.assertIn('trivia_db_pool_checkouts_total', metrics)
+
+    def test_warm_up(self):
+        """test if warm_up loads the categories and leaves no connection open for the forked workers"""
+        events = []
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        # a connection given back after the dispose would stay open in the pool of the master
+        event.listen(engine.pool, 'checkin', lambda *args: events.append('checkin'))
+        event.listen(engine, 'engine_disposed', lambda *args: events.append('dispose'))
+        warm_up(self.app)
+        res = self.client().get('/categories')
+
+        self.assertFalse(self.app.extensions['category_cache'].get(None).needs_load())
+        self.assertEqual(events[-2:], ['checkin', 'dispose'])
+        self.assertEqual(res.status_code, 200)
+
+    # ================================================================================
+    # tests for the read replicas
+    # ================================================================================
+    def test_read_replica_failover(self):
+        """test if the read-only endpoints are answered by the primary when the replica can't be reached"""
+        app, client = self.create_client({'DB_REPLICA_URIS': [self.unreachable_replica()]})
+        res = client().get('/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['questions'])
+        self.assertTrue(app.extensions['replica_router'].is_down('replica_0'))
+
+    def test_read_your_writes_on_primary(self):
+        """test if a client reads from the primary right after a write, without going to the replica"""
+        app, client = self.create_client({'DB_REPLICA_URIS': [self.unreachable_replica()]})
+        # the same client for every request, the Flask one keeps the cookies itself
+        client = client()
+        res = client.post('/questions', json={
+            "question": "which planet is the closest to the sun?",
+            "answer": "Mercury",
+            "difficulty": 1,
+            "category": "1"
+        })
+        cookie = res.headers['Set-Cookie'].split(';')[0]
+        read = client.get('/categories/1/questions', headers={'Cookie': cookie})
+        router_down = app.extensions['replica_router'].is_down('replica_0')
+        id_to_delete = Question.query.filter(Question.answer == "Mercury").first().id
+        client.delete(f'/questions/{id_to_delete}')
+
+        self.assertTrue(cookie.startswith('db_primary_until='))
+        self.assertEqual(read.status_code, 200)
+        self.assertFalse(router_down)
+
+    def test_play_game_question_not_on_replica_yet(self):
+        """test if a quiz question missing from a lagging replica is read from the primary and not dropped"""
+        replica_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db')
+        # a replica which didn't receive any question yet
+        db.metadata.create_all(bind=create_engine(replica_uri))
+        app, client = self.create_client({'DB_REPLICA_URIS': [replica_uri]})
+        res = client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 0}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('question', data)
+        self.assertFalse(app.extensions['replica_router'].is_down('replica_0'))
+
+    # ================================================================================
+    # tests for the tenants
+    # ================================================================================
+    def create_tenant_client(self):
+        """the app and the client of a deployment with the tenant acme, whose question bank has a single category"""
+        database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'acme.db')
+        app, client = self.create_client({'TENANT_DATABASE_URIS': {'acme': database}, 'TENANT_DOMAIN': 'trivia.test'})
+        app.test_cli_runner().invoke(args=['init-db', '--tenant', 'acme'])
+        with app.app_context(), use_tenant('acme'):
+            Category('Astronomy').insert()
+        return app, client
+
+    def test_tenant_question_banks(self):
+        """test if the requests of a tenant, named by the header or by the subdomain, only use its question bank"""
+        app, client = self.create_tenant_client()
+        categories = json.loads(client().get('/categories', headers={'X-Tenant': 'acme'}).data)['categories']
+        add_res = client().post('/questions', headers={'X-Tenant': 'acme'}, json={
+            "question": "which is the biggest planet?",
+            "answer": "Jupiter",
+            "difficulty": 1,
+            "category": "1"
+        })
+        res = client().get('/questions', headers={'Host': 'acme.trivia.test'})
+        data = json.loads(res.data)
+        default_data = json.loads(client().get('/questions').data)
+
+        self.assertEqual(list(categories.values()), ['Astronomy'])
+        self.assertEqual(add_res.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual([question['answer'] for question in data['questions']], ['Jupiter'])
+        self.assertIn('X-Tenant', res.headers['Vary'])
+        self.assertEqual(default_data['total_questions'], Question.query.count())
+        self.assertNotIn('Jupiter', [question['answer'] for question in default_data['questions']])
+
+    def test_tenant_isolation(self):
+        """test if an unknown tenant gets 404, and if a quiz session can only be played by its own tenant"""
+        app, client = self.create_tenant_client()
+        unknown_res = client().get('/categories', headers={'X-Tenant': 'globex'})
+        # the subdomain names the tenant, the header can't take the request to the question bank of another one
+        conflict_res = client().get('/categories', headers={'Host': 'globex.trivia.test', 'X-Tenant': 'acme'})
+        session_id = json.loads(client().post('/quizzes/sessions', json={'quiz_category': {'id': 0}}).data)['session_id']
+        other_res = client().post(f'/quizzes/sessions/{session_id}/next', headers={'X-Tenant': 'acme'})
+        own_res = client().post(f'/quizzes/sessions/{session_id}/next')
+
+        self.assertEqual(unknown_res.status_code, 404)
+        self.assertEqual(conflict_res.status_code, 404)
+        self.assertEqual(other_res.status_code, 404)
+        self.assertEqual(own_res.status_code, 200)
+
+    def test_tenant_caches_lru(self):
+        """test if the caches of the least recently used tenant are the ones dropped"""
+        caches = TenantCaches(dict, 2)
+        for tenant in ('acme', 'globex', 'acme', 'initech'):
+            caches.get(tenant)
+
+        self.assertEqual(list(caches.tenant_caches), ['acme', 'initech'])
+
     # ================================================================================
     # tests for getting all the categories
     # ================================================================================
@@ -58,6 +386,17 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['categories'])
 
+    def test_get_categories_not_modified(self):
+        """test if the /categories endpoint answers 304 when the client already has the categories"""
+        first_res = self.client().get('/categories')
+        res = self.client().get('/categories', headers={'If-None-Match': first_res.headers['ETag']})
+
+        self.assertEqual(first_res.status_code, 200)
+        self.assertIn('max-age', first_res.headers['Cache-Control'])
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], first_res.headers['ETag'])
+        self.assertEqual(res.data, b'')
+
     # ================================================================================
     # tests for getting all the questions
     # ================================================================================
@@ -70,6 +409,13 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['questions'])
 
+    def test_get_all_questions_same_as_format(self):
+        """test if the questions of the /questions endpoint are the same as Question.format()"""
+        data = json.loads(self.client().get('/questions').data)
+        questions = Question.query.order_by(Question.id).limit(len(data['questions'])).all()
+
+        self.assertEqual(data['questions'], [question.format() for question in questions])
+
     def test_error_404_if_no_questions_found_in_page(self):
         """test if the 404 error functions correctly with the GET method in /questions endpoint
          if the page number is too big"""
@@ -80,6 +426,155 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "resource not found")
 
+    def test_get_questions_after_cursor(self):
+        """test if the /questions endpoint continues after the last question of the previous page with ?after="""
+        first_page = json.loads(self.client().get('/questions').data)
+        res = self.client().get(f"/questions?after={first_page['next_cursor']}")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], first_page['total_questions'])
+        self.assertTrue(data['questions'][0]['id'] > first_page['questions'][-1]['id'])
+
+    def test_error_400_bad_cursor(self):
+        """test if the 400 error functions correctly with the GET method in /questions endpoint
+         if the cursor wasn't produced by the server"""
+        res = self.client().get('/questions?after=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "bad request")
+
+    def test_page_cache_follows_writes(self):
+        """test if the cached pages are served again and only the pages after a new question are rebuilt"""
+        page_cache = self.app.extensions['page_cache']
+        first_page = json.loads(self.client().get('/questions').data)
+        hits = page_cache.stats()['hits']
+        cached_page = json.loads(self.client().get('/questions').data)
+        self.client().get('/categories/3/questions')
+
+        add_data = json.loads(self.client().post('/questions', json={
+            "question": "what is the capital of Morocco?",
+            "answer": "Rabat",
+            "difficulty": 1,
+            "category": "3"
+        }).data)
+        # the new question comes after the first page, which is kept with the new total
+        after_add = json.loads(self.client().get('/questions').data)
+        hits_after_add = page_cache.stats()['hits']
+        category_after_add = json.loads(self.client().get('/categories/3/questions').data)
+        self.client().delete(f"/questions/{add_data['question_id']}")
+        category_after_delete = json.loads(self.client().get('/categories/3/questions').data)
+
+        self.assertEqual(cached_page, first_page)
+        self.assertEqual(hits_after_add, hits + 2)
+        self.assertEqual(after_add['questions'], first_page['questions'])
+        self.assertEqual(after_add['total_questions'], first_page['total_questions'] + 1)
+        self.assertIn(add_data['question_id'], [question['id'] for question in category_after_add['questions']])
+        self.assertNotIn(add_data['question_id'], [question['id'] for question in category_after_delete['questions']])
+
+    def test_page_cache_writes_of_other_workers(self):
+        """test if a cached page is rebuilt after a write this worker wasn't notified of"""
+        before = json.loads(self.client().get('/categories/3/questions').data)
+        question = before['questions'][0]
+        with self.app.app_context():
+            # as another worker process would, the listeners of this app aren't called
+            table = Question.__table__
+            db.session.execute(table.update().where(table.c.id == question['id']).values(answer='Another answer'))
+            TableVersion.bump('questions')
+            db.session.commit()
+        after = json.loads(self.client().get('/categories/3/questions').data)
+        with self.app.app_context():
+            db.session.execute(table.update().where(table.c.id == question['id']).values(answer=question['answer']))
+            TableVersion.bump('questions')
+            db.session.commit()
+
+        self.assertEqual(after['questions'][0]['answer'], 'Another answer')
+
+    def test_page_cache_lru(self):
+        """test if the least recently used pages are dropped beyond the memory cap of the page cache"""
+        head = b'{"questions":[],"total_questions":'
+        page_cache = PageCache(max_bytes=2 * (len(head) + 200))
+        for page in (1, 2):
+            page_cache.put(None, page, 1, 'etag', head, (None, None))
+        page_cache.get(None, 1, 1, 'etag')
+        page_cache.put(None, 3, 1, 'etag', head, (None, None))
+
+        self.assertEqual(page_cache.get(None, 1, 1, 'etag'), head)
+        self.assertIsNone(page_cache.get(None, 2, 1, 'etag'))
+        self.assertEqual(page_cache.stats()['evictions'], 1)
+        self.assertEqual(page_cache.stats()['entries'], 2)
+
+    def test_page_cache_budget_of_every_tenant(self):
+        """test if the pages of a tenant are kept when another tenant fills its own budget"""
+        head = b'{"questions":[],"total_questions":'
+        page_cache = PageCache(max_bytes=2 * (len(head) + 200))
+        with use_tenant('acme'):
+            page_cache.put(None, 1, 1, 'etag', head, (None, None))
+        for page in (1, 2, 3):
+            page_cache.put(None, page, 1, 'etag', head, (None, None))
+        with use_tenant('acme'):
+            acme_head = page_cache.get(None, 1, 1, 'etag')
+
+        self.assertEqual(acme_head, head)
+        self.assertEqual(page_cache.stats()['evictions'], 1)
+        self.assertEqual(page_cache.stats()['entries'], 3)
+
+    def test_get_questions_not_modified(self):
+        """test if the lists of questions answer 304 until a question is written"""
+        for path in ('/questions', '/categories/3/questions'):
+            first_res = self.client().get(path)
+            etag = first_res.headers['ETag']
+            res = self.client().get(path, headers={'If-None-Match': etag})
+
+            self.assertTrue(etag.startswith('W/'))
+            self.assertIn('max-age', first_res.headers['Cache-Control'])
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.headers['ETag'], etag)
+            self.assertEqual(res.data, b'')
+
+            self.client().post('/questions', json={
+                "question": "what is the capital of Morocco?",
+                "answer": "Rabat",
+                "difficulty": 1,
+                "category": "3"
+            })
+            id_to_delete = Question.query.filter(Question.answer == "Rabat").first().id
+            res = self.client().get(path, headers={'If-None-Match': etag})
+            self.client().delete(f'/questions/{id_to_delete}')
+
+            self.assertEqual(res.status_code, 200)
+            self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_questions_compressed(self):
+        """test if the lists of questions are compressed for the clients that accept gzip, with the CORS headers"""
+        plain_res = self.client().get('/questions')
+        res = self.client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(res.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(int(res.headers['Content-Length']), len(res.data))
+        self.assertEqual(json.loads(gzip.decompress(res.data)), json.loads(plain_res.data))
+        self.assertNotIn('Content-Encoding', plain_res.headers)
+
+    def test_http_cache_settings_of_the_config(self):
+        """test if the compression threshold and the max-age of the lists and of the categories are read from the app config"""
+        app, client = self.create_client({'COMPRESS_MIN_SIZE': 10 ** 9, 'QUESTIONS_MAX_AGE': 60, 'CATEGORIES_MAX_AGE': 5,
+                                          'CATEGORY_CACHE_TTL': 0})
+        res = client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+        categories_res = client().get('/categories')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(categories_res.headers['Cache-Control'], 'public, max-age=5')
+        with app.app_context():
+            self.assertEqual(app.extensions['category_cache'].current().ttl, 0)
+
     # ================================================================================
     # tests for getting the questions by category
     # ================================================================================
@@ -154,6 +649,98 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "resource not found")
 
+    # ================================================================================
+    # tests for editing the questions
+    # ================================================================================
+    def test_update_question(self):
+        """test the method PATCH for the endpoint /questions/<id> to edit a question and move it to another category"""
+        question_id = json.loads(self.client().post('/questions', json={
+            "question": "what is the capital of Marocco?",
+            "answer": "Rabat",
+            "difficulty": 1,
+            "category": "3"
+        }).data)['question_id']
+        counts_before = [json.loads(self.client().get(f'/categories/{category}/questions').data)['total_questions']
+                         for category in (3, 4)]
+        res = self.client().patch(f'/questions/{question_id}', json={
+            "question": "what is the capital of Morocco?",
+            "version": 1
+        })
+        data = json.loads(res.data)
+        moved = json.loads(self.client().patch(f'/questions/{question_id}', json={"category": 4, "version": 2}).data)
+        counts_after = [json.loads(self.client().get(f'/categories/{category}/questions').data)['total_questions']
+                        for category in (3, 4)]
+        self.client().delete(f'/questions/{question_id}')
+        # the browsers send the edits once the preflight allows PATCH, on the routes of both serving modes
+        allowed_methods = [self.client().get(path).headers['Access-Control-Allow-Methods']
+                           for path in ('/categories', '/questions/export')]
+
+        self.assertEqual(res.status_code, 200)
+        allowed_methods.append(res.headers['Access-Control-Allow-Methods'])
+        self.assertTrue(all('PATCH' in methods.split(',') for methods in allowed_methods))
+        self.assertEqual(data['question']['question'], "what is the capital of Morocco?")
+        self.assertEqual(data['question']['answer'], "Rabat")
+        self.assertEqual(data['question']['version'], 2)
+        self.assertEqual(moved['question']['category'], 4)
+        self.assertEqual(counts_after, [counts_before[0] - 1, counts_before[1] + 1])
+
+    def test_update_question_keeps_other_pages(self):
+        """test if an edit only drops the cached pages holding the question"""
+        page_cache = self.app.extensions['page_cache']
+        question = json.loads(self.client().get('/categories/3/questions').data)['questions'][0]
+        self.client().get('/categories/2/questions')
+        hits = page_cache.stats()['hits']
+        updated = json.loads(self.client().patch(f"/questions/{question['id']}", json={
+            "answer": question['answer'] + " (edited)",
+            "version": question['version']
+        }).data)['question']
+        other_category = self.client().get('/categories/2/questions')
+        hits_after = page_cache.stats()['hits']
+        category_after = json.loads(self.client().get('/categories/3/questions').data)['questions'][0]
+        self.client().patch(f"/questions/{question['id']}", json={
+            "answer": question['answer'],
+            "version": updated['version']
+        })
+
+        self.assertEqual(other_category.status_code, 200)
+        self.assertEqual(hits_after, hits + 1)
+        self.assertEqual(category_after['answer'], question['answer'] + " (edited)")
+
+    def test_error_409_update_question_stale_version(self):
+        """test the error 409 for the method PATCH for the endpoint /questions/<id> if the question changed since"""
+        question = json.loads(self.client().get('/questions').data)['questions'][0]
+        res = self.client().patch(f"/questions/{question['id']}", json={
+            "answer": "an answer from an old read",
+            "version": question['version'] - 1
+        })
+        data = json.loads(res.data)
+        with self.app.app_context():
+            # the question was read, then committed by another editor before this one writes
+            stale = Question.query.get(question['id'])
+            table = Question.__table__
+            db.session.execute(table.update().where(table.c.id == question['id']).values(version=table.c.version + 1))
+            stale.answer = "an answer from an old read"
+            with self.assertRaises(StaleDataError):
+                stale.update()
+            db.session.rollback()
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "conflict")
+
+    def test_error_400_422_update_question(self):
+        """test the errors of the method PATCH for the endpoint /questions/<id> for bad bodies and unknown ids"""
+        without_version = self.client().patch('/questions/1', json={"answer": "an answer"})
+        unknown_id = self.client().patch('/questions/100000', json={"answer": "an answer", "version": 1})
+        unknown_category = self.client().patch('/questions/1', json={"category": 1000, "version": 1})
+        not_integers = [self.client().patch('/questions/1', json={field: value, "version": 1}).status_code
+                        for field in ('category', 'difficulty') for value in (True, 2.9, '2.9')]
+
+        self.assertEqual(without_version.status_code, 400)
+        self.assertEqual(not_integers, [400] * 6)
+        self.assertEqual(unknown_id.status_code, 422)
+        self.assertEqual(unknown_category.status_code, 422)
+
     # ================================================================================
     # tests for searching the questions
     # ================================================================================
@@ -168,6 +755,18 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['questions'])
 
+    def test_search_questions_by_answer_prefix(self):
+        """test the method POST for the endpoint /questions to search the beginning of a word of an answer"""
+        res = self.client().post('/questions', json={
+            "searchTerm": "scara"
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_results'], len(data['questions']))
+        self.assertIn("Scarab", [question['answer'] for question in data['questions']])
+
     def test_error_404_search_term_not_exist(self):
         """test the error 404 for the method POST for the endpoint /questions if the search word doesn't exist"""
         res = self.client().post('/questions', json={
@@ -188,6 +787,15 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "bad request")
 
+    def test_error_400_search_term_not_string(self):
+        """test the error 400 for the method POST for the endpoint /questions if the search term isn't a string"""
+        res = self.client().post('/questions', json={'searchTerm': 42})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "bad request")
+
     # ================================================================================
     # tests for adding the questions
     # ================================================================================
@@ -203,10 +811,124 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
+        self.assertTrue(data['question_id'])
 
         # to avoid adding more questions to the database multiple times if the test runs multiple times
-        Question.query.filter(Question.answer == "Germany").delete()
+        # deleted through the endpoint, so the question counts and the caches follow
+        self.client().delete(f"/questions/{data['question_id']}")
+
+    def test_add_question_write_batching(self):
+        """test the method POST for the endpoint /questions when the new questions are committed by batches"""
+        app, client = self.create_client({'DB_WRITE_BATCHING': True})
+        answers = [f'Batched answer {number}' for number in range(6)]
+
+        def add(answer):
+            return json.loads(client().post('/questions', json={
+                "question": "which answer is batched?",
+                "answer": answer,
+                "difficulty": 1,
+                "category": "3"
+            }).data)
+
+        # the async test client runs on its own event loop, one request at a time
+        if APP_MODE == 'asgi':
+            added = [add(answer) for answer in answers[:-1]]
+        else:
+            with ThreadPoolExecutor(len(answers) - 1) as executor:
+                added = list(executor.map(add, answers[:-1]))
+        # the questions queued are written before the writer stops, the next ones are committed right away
+        app.extensions['write_batcher'].stop()
+        added.append(add(answers[-1]))
+        stored = {question.id: question.answer for question in Question.query.filter(Question.answer.in_(answers))}
+        counts = app.test_cli_runner().invoke(args=['check-question-counts']).output
+        for question_id in stored:
+            client().delete(f'/questions/{question_id}')
+
+        self.assertTrue(all(data['success'] for data in added))
+        self.assertEqual(sorted(stored), sorted(data['question_id'] for data in added))
+        self.assertEqual(sorted(stored.values()), answers)
+        self.assertIn('consistent', counts)
+
+    def test_add_question_write_batching_difficulty_string(self):
+        """test if a question added by a batch with the difficulty of the form ("3") is asked by the quizzes of that difficulty"""
+        app, client = self.create_client({'DB_WRITE_BATCHING': True})
+        data = json.loads(client().post('/questions', json={
+            "question": "which difficulty is batched?",
+            "answer": "Batched difficulty",
+            "difficulty": "3",
+            "category": "2"
+        }).data)
+        res = client().post('/quizzes', json={
+            "quiz_category": {'id': 2},
+            "previous_questions": [],
+            "difficulty": [3, 3]
+        })
+        invalid_res = client().post('/questions', json={
+            "question": "which difficulty is batched?",
+            "answer": "Batched difficulty",
+            "difficulty": "2.5",
+            "category": True
+        })
+        client().delete(f"/questions/{data['question_id']}")
 
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['question']['difficulty'], 3)
+        self.assertEqual(invalid_res.status_code, 400)
+
+    def test_write_batch_in_one_transaction(self):
+        """test if the questions of a batch are committed by a single transaction, without falling back one by one"""
+        app, client = self.create_client({'DB_WRITE_BATCHING': True})
+        write_batcher = app.extensions['write_batcher']
+        write_batcher.stop()
+        writes = [({'question': 'which answer is batched?', 'answer': f'Batched answer {number}', 'category': 3,
+                    'difficulty': 1}, Future()) for number in range(3)]
+        with app.app_context():
+            version_before = TableVersion.of('questions')
+            write_batcher.write(writes)
+            version_after = TableVersion.of('questions')
+        question_ids = [future.result() for fields, future in writes]
+        for question_id in question_ids:
+            client().delete(f'/questions/{question_id}')
+
+        self.assertEqual(version_after, version_before + 1)
+        self.assertEqual(len(set(question_ids)), 3)
+
+    def test_question_counts_follow_writes(self):
+        """test if the number of questions reported after adding and deleting a question follows the writes"""
+        total_before = json.loads(self.client().get('/questions').data)['total_questions']
+        category_before = json.loads(self.client().get('/categories/3/questions').data)['total_questions']
+
+        add_data = json.loads(self.client().post('/questions', json={
+            "question": "what is the capital of Morocco?",
+            "answer": "Rabat",
+            "difficulty": 1,
+            "category": "3"
+        }).data)
+        category_after = json.loads(self.client().get('/categories/3/questions').data)['total_questions']
+        id_to_delete = Question.query.filter(Question.answer == "Rabat").first().id
+        delete_data = json.loads(self.client().delete(f'/questions/{id_to_delete}').data)
+
+        self.assertEqual(add_data['number_of_questions'], total_before + 1)
+        self.assertEqual(category_after, category_before + 1)
+        self.assertEqual(delete_data['number_of_questions'], total_before)
+
+    def test_table_version_created_by_first_bump(self):
+        """test if the first bump of a table creates its version and the next ones increment it"""
+        with self.app.app_context():
+            TableVersion.bump('test_table')
+            TableVersion.bump('test_table')
+            version = TableVersion.of('test_table')
+            TableVersion.query.filter(TableVersion.name == 'test_table').delete()
+            db.session.commit()
+
+        self.assertEqual(version, 2)
+
+    def test_check_question_counts_command(self):
+        """test if the check-question-counts command finds the maintained counts consistent"""
+        result = self.app.test_cli_runner().invoke(args=['check-question-counts'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('consistent', result.output)
 
     def test_error_400_bad_request(self):
         """test the error 404 for the method POST for the endpoint /questions if one of the question informations
@@ -222,8 +944,347 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "bad request")
 
+    def test_error_422_add_question_category_not_exist(self):
+        """test the error 422 for the method POST for the endpoint /questions if the category doesn't exist"""
+        res = self.client().post('/questions', json={
+            "question": "who's won the world cup 2014?",
+            "answer": "Germany",
+            "difficulty": 1,
+            "category": 1000
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     # ================================================================================
-    # tests for adding the questions
+    # tests for the migrations of the schema
+    # ================================================================================
+    def test_typed_category_migration(self):
+        """test if the migrations turn the string category of an old database into an indexed integer"""
+        from alembic import command
+        from alembic.config import Config as AlembicConfig
+        from benchmarks.queries import seed
+
+        database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'legacy.db')
+        engine = create_engine(database)
+        seed(engine, 100, 3, 0)
+        config = AlembicConfig(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alembic.ini'))
+        config.set_main_option('script_location', os.path.join(os.path.dirname(config.config_file_name), 'migrations'))
+        config.set_main_option('sqlalchemy.url', database)
+        command.upgrade(config, '0001')
+        updated, orphans = backfill_categories(engine, batch_size=30)
+        command.upgrade(config, 'head')
+
+        inspector = inspect(engine)
+        columns = {column['name']: column for column in inspector.get_columns('questions')}
+        indexes = {index['name']: index['column_names'] for index in inspector.get_indexes('questions')}
+        counts = engine.execute('SELECT sum(count) FROM question_counts').scalar()
+        self.assertEqual((updated, orphans), (100, 0))
+        self.assertIsInstance(columns['category']['type'], Integer)
+        self.assertNotIn('category_id', columns)
+        self.assertEqual(indexes['ix_questions_category_and_id'], ['category', 'id'])
+        self.assertEqual(counts, 100)
+
+    def test_typed_category_downgrade_of_psql_schema(self):
+        """test if the downgrade drops the foreign key of a database loaded from trivia.psql, named category"""
+        from alembic import command
+        from alembic.config import Config as AlembicConfig
+
+        database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'psql.db')
+        engine = create_engine(database)
+        engine.execute('CREATE TABLE categories (id INTEGER PRIMARY KEY, type VARCHAR)')
+        engine.execute('CREATE TABLE questions (id INTEGER PRIMARY KEY, question VARCHAR, answer VARCHAR, '
+                       'difficulty INTEGER, category INTEGER, '
+                       'CONSTRAINT category FOREIGN KEY (category) REFERENCES categories (id))')
+        engine.execute('CREATE INDEX ix_questions_category_and_id ON questions (category, id)')
+        engine.execute('CREATE INDEX ix_questions_difficulty ON questions (difficulty)')
+        engine.execute("INSERT INTO categories (id, type) VALUES (1, 'Science')")
+        engine.execute("INSERT INTO questions (question, answer, difficulty, category) VALUES ('q', 'a', 1, 1)")
+        config = AlembicConfig(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alembic.ini'))
+        config.set_main_option('script_location', os.path.join(os.path.dirname(config.config_file_name), 'migrations'))
+        config.set_main_option('sqlalchemy.url', database)
+        command.stamp(config, '0002')
+        command.downgrade(config, '0001')
+
+        inspector = inspect(engine)
+        columns = {column['name']: column for column in inspector.get_columns('questions')}
+        self.assertNotIsInstance(columns['category']['type'], Integer)
+        self.assertEqual(inspector.get_foreign_keys('questions'), [])
+        self.assertEqual(engine.execute('SELECT category FROM questions').scalar(), '1')
+
+    # ================================================================================
+    # tests for the embedded SQLite backend
+    # ================================================================================
+    def test_embedded_sqlite_seeded_from_psql(self):
+        """test if a new SQLite database gets the questions of trivia.psql at startup and the tuned pragmas"""
+        path = os.path.join(tempfile.mkdtemp(), 'edge.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'EMBEDDED_SEED': TRIVIA_PSQL})
+        with app.app_context():
+            questions = Question.query.count()
+            categories = Category.query.count()
+            wrong_counts = QuestionCount.check()
+            pragmas = [db.session.execute(f'PRAGMA {pragma}').scalar()
+                       for pragma in ('journal_mode', 'synchronous', 'foreign_keys')]
+            db.session.remove()
+        res = app.test_client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 0}})
+        # started again on the same file, nothing is loaded twice
+        create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'EMBEDDED_SEED': TRIVIA_PSQL})
+        with app.app_context():
+            questions_after_restart = Question.query.count()
+            db.session.remove()
+
+        self.assertEqual((categories, questions), (6, 19))
+        self.assertEqual(wrong_counts, {})
+        # synchronous NORMAL is 1
+        self.assertEqual(pragmas, ['wal', 1, 1])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(questions_after_restart, 19)
+
+    def test_embedded_seed_without_create_all(self):
+        """test if the seed leaves a database without tables alone when DB_CREATE_ALL is false"""
+        uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'edge.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': uri, 'DB_CREATE_ALL': False, 'EMBEDDED_SEED': TRIVIA_PSQL})
+        with app.app_context():
+            tables = inspect(db.get_engine(app)).get_table_names()
+        app.test_cli_runner().invoke(args=['init-db'])
+        # the next start finds the tables of init-db empty and loads the dump
+        app = create_app({'SQLALCHEMY_DATABASE_URI': uri, 'DB_CREATE_ALL': False, 'EMBEDDED_SEED': TRIVIA_PSQL})
+        with app.app_context():
+            questions = Question.query.count()
+            db.session.remove()
+
+        self.assertEqual(tables, [])
+        self.assertEqual(questions, 19)
+
+    def test_load_psql_copy_format(self):
+        """test if the escapes and NULLs of the COPY blocks are read, and if load-psql refuses a database with questions"""
+        dump = [
+            'SET client_encoding = \'UTF8\';\n',
+            'COPY public.questions (id, question, answer, difficulty, category) FROM stdin;\n',
+            '7\tA question with a\\ttab and a\\\\backslash?\tYes\t2\t\\N\n',
+            '8\tCaf\\303\\251 or caf\\xc3\\xa9, \\x41\\101\\x?\tOui\t1\t3\n',
+            '\\.\n',
+        ]
+        blocks = list(read_copy_blocks(dump))
+        table, columns, rows = blocks[0]
+        row = [copy_value(value, Question.__table__.c[column]) for column, value in zip(columns, rows[0])]
+        output = self.app.test_cli_runner().invoke(args=['load-psql', TRIVIA_PSQL]).output
+
+        self.assertEqual((table, columns), ('questions', ['id', 'question', 'answer', 'difficulty', 'category']))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(row, [7, 'A question with a\ttab and a\\backslash?', 'Yes', 2, None])
+        self.assertEqual(copy_value(rows[1][1], Question.__table__.c.question), 'Café or café, AAx?')
+        self.assertIn('already has questions', output)
+
+    # ================================================================================
+    # tests for the bulk import and export of the questions
+    # ================================================================================
+    def test_bulk_import_questions(self):
+        """test the method POST for the endpoint /questions/bulk to import NDJSON questions"""
+        body = '\n'.join([
+            json.dumps({"question": "what is the capital of Peru?", "answer": "Lima", "category": "3", "difficulty": 2}),
+            json.dumps({"question": "a question without answer", "category": "3", "difficulty": 2}),
+        ])
+        res = self.client().post('/questions/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['errors'][0]['line'], 2)
+
+        for question in Question.query.filter(Question.answer == "Lima").all():
+            self.client().delete(f'/questions/{question.id}')
+
+    def test_bulk_import_chunk_failure(self):
+        """test if a chunk that fails is rolled back and reported, and the other chunks are committed"""
+        actions = []
+        add_question_listener(self.app, lambda action, question: actions.append(action))
+        lines = [
+            json.dumps({"question": "what is the capital of Peru?", "answer": "Lima", "category": "3", "difficulty": 2}),
+            # a category the caller believes in but the database doesn't have, the foreign key fails the chunk
+            json.dumps({"question": "what is the capital of Chile?", "answer": "Santiago", "category": "1000",
+                        "difficulty": 2}),
+            json.dumps({"question": "what is the capital of Bolivia?", "answer": "Sucre", "category": "3",
+                        "difficulty": 2}),
+        ]
+        with self.app.app_context():
+            inserted, rejected, errors = import_questions(lines, 'ndjson', {3, 1000}, 1)
+            # the session can still be used after the failed chunk
+            imported = [question.id for question in Question.query.filter(Question.answer.in_(
+                ("Lima", "Santiago", "Sucre")))]
+            db.session.remove()
+        for question_id in imported:
+            self.client().delete(f'/questions/{question_id}')
+
+        self.assertEqual((inserted, rejected), (2, 1))
+        self.assertEqual(errors[0]['line'], 2)
+        self.assertEqual(len(imported), 2)
+        self.assertEqual(actions[0], 'reload')
+
+    def test_bulk_import_not_integers(self):
+        """test if the rows whose difficulty or category isn't an integer are rejected one by one"""
+        body = '\n'.join([
+            json.dumps({"question": "q1", "answer": "a", "category": 3, "difficulty": True}),
+            json.dumps({"question": "q2", "answer": "a", "category": 3, "difficulty": "1e3"}),
+            json.dumps({"question": "q3", "answer": "a", "category": 3, "difficulty": 2.9}),
+            json.dumps({"question": "q4", "answer": "a", "category": 3, "difficulty": 10 ** 20}),
+            json.dumps({"question": "q5", "answer": "a", "category": 3.5, "difficulty": 2}),
+        ])
+        res = self.client().post('/questions/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 0)
+        self.assertEqual(data['rejected'], 5)
+        self.assertEqual([error['line'] for error in data['errors']], [1, 2, 3, 4, 5])
+
+    def test_error_400_bulk_import_bad_format(self):
+        """test the error 400 for the method POST for the endpoint /questions/bulk if the body is not NDJSON or CSV"""
+        res = self.client().post('/questions/bulk', json={"question": "a question"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "bad request")
+
+    def test_export_questions_csv(self):
+        """test the method GET for the endpoint /questions/export to export all the questions as CSV"""
+        res = self.client().get('/questions/export?format=csv')
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertEqual(len(lines) - 1, Question.query.count())
+
+    # ================================================================================
+    # tests for the feed of the changes of the questions
+    # ================================================================================
+    def last_seq(self):
+        """the seq of the last change of the log, 0 when it is empty"""
+        with self.app.app_context():
+            return db.session.query(db.func.max(QuestionChange.seq)).scalar() or 0
+
+    def test_get_changes(self):
+        """test the method GET for the endpoint /changes after adding, editing and deleting a question"""
+        since = self.last_seq()
+        question_id = json.loads(self.client().post('/questions', json={
+            "question": "what is the capital of Kenya?",
+            "answer": "Nairobi",
+            "difficulty": 1,
+            "category": "3"
+        }).data)['question_id']
+        self.client().patch(f'/questions/{question_id}', json={"version": 1, "category": 4})
+        res = self.client().get(f'/changes?since={since}&wait=0')
+        data = json.loads(res.data)
+        self.client().delete(f'/questions/{question_id}')
+        deleted = json.loads(self.client().get(f"/changes?since={data['last_seq']}&wait=0").data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Cache-Control'], 'no-store')
+        self.assertEqual(data['success'], True)
+        self.assertEqual([change['action'] for change in data['changes']], ['insert', 'update'])
+        self.assertEqual(data['last_seq'], data['changes'][-1]['seq'])
+        self.assertLess(since, data['changes'][0]['seq'])
+        self.assertLess(data['changes'][0]['seq'], data['changes'][1]['seq'])
+        self.assertEqual(data['changes'][1]['question_id'], question_id)
+        self.assertEqual(data['changes'][1]['previous_category'], 3)
+        self.assertEqual(data['changes'][1]['category'], 4)
+        # the question as it is now, for both changes
+        self.assertEqual(data['changes'][0]['question']['version'], 2)
+        self.assertEqual(data['changes'][1]['question']['answer'], 'Nairobi')
+        self.assertEqual([change['action'] for change in deleted['changes']], ['delete'])
+        self.assertIsNone(deleted['changes'][0]['question'])
+
+    def test_get_changes_without_change(self):
+        """test if the endpoint /changes answers an empty list after waiting when nothing is written"""
+        since = self.last_seq()
+        res = self.client().get(f'/changes?since={since}&wait=0.2')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['last_seq'], since)
+
+    def test_get_changes_after_trim(self):
+        """test if the log keeps its last CHANGES_MAX_ROWS changes and sends a reload to a reader that was further behind"""
+        app, client = self.create_client({'CHANGES_MAX_ROWS': 2})
+        since = self.last_seq()
+        question_ids = [json.loads(client().post('/questions', json={
+            "question": "what is the capital of Peru?",
+            "answer": "Lima",
+            "difficulty": 1,
+            "category": "3"
+        }).data)['question_id'] for _ in range(4)]
+        data = json.loads(client().get(f'/changes?since={since}&wait=0').data)
+        with app.app_context():
+            kept = QuestionChange.query.filter(QuestionChange.seq > since).count()
+        for question_id in question_ids:
+            client().delete(f'/questions/{question_id}')
+
+        self.assertLessEqual(kept, 3)
+        self.assertEqual(data['changes'][0]['action'], 'reload')
+        self.assertIsNone(data['changes'][0]['question'])
+        self.assertEqual([change['question_id'] for change in data['changes'][1:]], question_ids[-len(data['changes']) + 1:])
+        self.assertEqual(data['last_seq'], data['changes'][-1]['seq'])
+
+    def test_get_changes_max_waiters(self):
+        """test if the requests of /changes beyond CHANGES_MAX_WAITERS are answered without waiting by the Flask app"""
+        app, client = self.create_client({'CHANGES_MAX_WAITERS': 1, 'CHANGES_POLL_SECONDS': 30})
+        since = self.last_seq()
+        with ThreadPoolExecutor(1) as executor:
+            waiting = executor.submit(app.test_client().get, f'/changes?since={since}&wait=1')
+            time.sleep(0.3)
+            started_at = time.monotonic()
+            res = app.test_client().get(f'/changes?since={since}&wait=5')
+            elapsed = time.monotonic() - started_at
+            waiting_res = waiting.result()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['changes'], [])
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(waiting_res.status_code, 200)
+
+    def test_get_changes_long_polling(self):
+        """test if a request waiting on /changes is answered as soon as a question is added by the process"""
+        app, client = self.create_client({'CHANGES_POLL_SECONDS': 30})
+        since = self.last_seq()
+
+        def add():
+            time.sleep(0.3)
+            return json.loads(app.test_client().post('/questions', json={
+                "question": "what is the capital of Ghana?",
+                "answer": "Accra",
+                "difficulty": 1,
+                "category": "3"
+            }).data)['question_id']
+
+        with ThreadPoolExecutor(1) as executor:
+            added = executor.submit(add)
+            started_at = time.monotonic()
+            data = json.loads(client().get(f'/changes?since={since}&wait=20').data)
+            elapsed = time.monotonic() - started_at
+            question_id = added.result()
+        client().delete(f'/questions/{question_id}')
+
+        self.assertLess(elapsed, 10)
+        self.assertEqual([change['question_id'] for change in data['changes']], [question_id])
+
+    def test_error_400_get_changes(self):
+        """test the error 400 for the method GET for the endpoint /changes if since is not a seq"""
+        for query in ('since=first', 'since=-1', 'since=0&wait=soon'):
+            res = self.client().get(f'/changes?{query}')
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], "bad request")
+
+    # ================================================================================
+    # tests for playing the quizzes
     # ================================================================================
     def test_play_game(self):
         """test the method POST for the endpoint /quizzes to play"""
@@ -238,9 +1299,10 @@ class TriviaTestCase(unittest.TestCase):
 
     def test_play_game_less_than_5_questions(self):
         """test the method POST for the endpoint /quizzes if all the questions are less than 5 and are already asked """
+        category_questions = Question.query.filter(Question.category == 1).all()
         res = self.client().post('/quizzes', json={
             "quiz_category": {'id': 1},
-            "previous_questions": [1,2,3]
+            "previous_questions": [question.id for question in category_questions]
         })
         data = json.loads(res.data)
 
@@ -248,6 +1310,169 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['state'], "end_of_game")
 
+    def test_play_game_previous_questions_from_other_category(self):
+        """test the method POST for the endpoint /quizzes if the previous questions belong to another category"""
+        other_questions = Question.query.filter(Question.category != 1).all()
+        res = self.client().post('/quizzes', json={
+            "quiz_category": {'id': 1},
+            "previous_questions": [question.id for question in other_questions]
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['category'], 1)
+
+    def test_play_game_by_difficulty(self):
+        """test the method POST for the endpoint /quizzes with a difficulty, only the questions of that difficulty are asked"""
+        questions = Question.query.filter(Question.difficulty == 4).all()
+        previous_questions = []
+        for _ in questions:
+            res = self.client().post('/quizzes', json={
+                "quiz_category": {'id': 0},
+                "previous_questions": previous_questions,
+                "difficulty": 4
+            })
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['question']['difficulty'], 4)
+            previous_questions.append(data['question']['id'])
+
+        self.assertEqual(sorted(previous_questions), sorted(question.id for question in questions))
+        res = self.client().post('/quizzes', json={
+            "quiz_category": {'id': 0},
+            "previous_questions": previous_questions,
+            "difficulty": 4
+        })
+        self.assertEqual(json.loads(res.data)['state'], "end_of_game")
+
+    def test_play_game_weighted_difficulty_band(self):
+        """test the method POST for the endpoint /quizzes with the weighted strategy on a band of difficulties"""
+        questions = Question.query.filter(Question.difficulty.between(2, 3)).all()
+        previous_questions = []
+        for _ in questions:
+            res = self.client().post('/quizzes', json={
+                "quiz_category": {'id': 0},
+                "previous_questions": previous_questions,
+                "difficulty": [2, 3],
+                "strategy": "weighted"
+            })
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn(data['question']['difficulty'], (2, 3))
+            self.assertNotIn(data['question']['id'], previous_questions)
+            previous_questions.append(data['question']['id'])
+
+        self.assertEqual(sorted(previous_questions), sorted(question.id for question in questions))
+
+    def test_error_400_play_game_invalid_options(self):
+        """test the method POST for the endpoint /quizzes with a difficulty or a strategy that isn't valid"""
+        for options in ({'difficulty': 'hard'}, {'difficulty': [4, 2]}, {'strategy': 'hardest'}):
+            res = self.client().post('/quizzes', json=dict({
+                "quiz_category": {'id': 1},
+                "previous_questions": []
+            }, **options))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+    def test_error_404_play_game_difficulty_without_questions(self):
+        """test the method POST for the endpoint /quizzes with a difficulty that no question of the category has"""
+        res = self.client().post('/quizzes', json={
+            "quiz_category": {'id': 1},
+            "previous_questions": [],
+            "difficulty": 1
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_play_round(self):
+        """test the method POST for the endpoint /quizzes/round, distinct questions of the category left out of the previous ones"""
+        category_ids = [question.id for question in Question.query.filter(Question.category == 6).all()]
+        res = self.client().post('/quizzes/round', json={
+            "quiz_category": {'id': 6},
+            "previous_questions": category_ids[:1],
+            "count": 5
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        round_ids = [question['id'] for question in data['questions']]
+        # fewer questions than asked when the category doesn't have enough of them
+        self.assertEqual(len(round_ids), min(5, len(category_ids) - 1))
+        self.assertEqual(len(set(round_ids)), len(round_ids))
+        self.assertTrue(set(round_ids) <= set(category_ids[1:]))
+        self.assertEqual(data['remaining_questions'], len(category_ids) - 1 - len(round_ids))
+
+        res = self.client().post('/quizzes/round', json={
+            "quiz_category": {'id': 6},
+            "previous_questions": category_ids,
+            "count": 5
+        })
+        self.assertEqual(json.loads(res.data)['state'], "end_of_game")
+
+    def test_play_round_with_seed(self):
+        """test the method POST for the endpoint /quizzes/round with a seed, the same seed gives the same round"""
+        def play(seed):
+            res = self.client().post('/quizzes/round', json={"quiz_category": {'id': 0}, "count": 8, "seed": seed})
+            self.assertEqual(res.status_code, 200)
+            return [question['id'] for question in json.loads(res.data)['questions']]
+
+        first_round = play(42)
+        self.assertEqual(len(set(first_round)), 8)
+        self.assertEqual(play(42), first_round)
+        self.assertEqual(play('42'), play('42'))
+        self.assertNotEqual(play(43), first_round)
+
+    def test_error_400_play_round_invalid_options(self):
+        """test the error 400 for the method POST for the endpoint /quizzes/round with a count, previous questions or a seed that isn't valid"""
+        for options in ({}, {'count': 0}, {'count': 51}, {'count': '5'}, {'count': 5, 'previous_questions': 'all'},
+                        {'count': 5, 'seed': 4.2}, {'count': 5, 'difficulty': 'hard'}):
+            res = self.client().post('/quizzes/round', json=dict({"quiz_category": {'id': 1}}, **options))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+    def test_play_game_with_session(self):
+        """test the endpoints /quizzes/sessions to play a whole quiz without sending the previous questions"""
+        res = self.client().post('/quizzes/sessions', json={"quiz_category": {'id': 1}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+        asked = set()
+        for _ in range(data['total_questions']):
+            next_data = json.loads(self.client().post(f"/quizzes/sessions/{data['session_id']}/next").data)
+            self.assertEqual(next_data['question']['category'], 1)
+            asked.add(next_data['question']['id'])
+        self.assertEqual(len(asked), data['total_questions'])
+
+        res = self.client().post(f"/quizzes/sessions/{data['session_id']}/next")
+        self.assertEqual(json.loads(res.data)['state'], "end_of_game")
+
+    def test_quiz_session_settings_of_the_config(self):
+        """test if the quiz sessions expire after the QUIZ_SESSION_TTL of the app config"""
+        app, client = self.create_client({'QUIZ_SESSION_TTL': 0})
+        session_id = json.loads(client().post('/quizzes/sessions', json={"quiz_category": {'id': 1}}).data)['session_id']
+        res = client().post(f'/quizzes/sessions/{session_id}/next')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(app.extensions['quiz_sessions'].ttl, 0)
+
+    def test_error_404_quiz_session_not_exist(self):
+        """test the error 404 for the method POST for the endpoint /quizzes/sessions/<id>/next if the session
+        doesn't exist"""
+        res = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "resource not found")
+
     def test_error_400_bad_request_play_game(self):
         """test the error 404 for the method POST for the endpoint /quizzes if one of the informations
         is not entered """
@@ -258,6 +1483,136 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "bad request")
 
+    def test_error_400_quiz_category_not_object(self):
+        """test the error 400 for the endpoints /quizzes and /quizzes/sessions if quiz_category isn't an object"""
+        game_res = self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': 1})
+        session_res = self.client().post('/quizzes/sessions', json={'quiz_category': 'Science'})
+
+        self.assertEqual(game_res.status_code, 400)
+        self.assertEqual(json.loads(game_res.data)['message'], "bad request")
+        self.assertEqual(session_res.status_code, 400)
+        self.assertEqual(json.loads(session_res.data)['message'], "bad request")
+
+    # ================================================================================
+    # tests for the rate limiting and the load shedding
+    # ================================================================================
+    def test_error_429_rate_limit_play_game(self):
+        """test the error 429 for the method POST for the endpoint /quizzes once a client used up its budget"""
+        app, client = self.create_client({'RATE_LIMIT_QUIZZES_PER_SECOND': 0.001, 'RATE_LIMIT_QUIZZES_BURST': 2,
+                                          'RATE_LIMIT_CLIENT_HEADER': 'X-Forwarded-For'})
+        quiz = {'previous_questions': [], 'quiz_category': {'id': 0}}
+        statuses = [client().post('/quizzes', json=quiz, headers={'X-Forwarded-For': '10.0.0.1'}).status_code
+                    for _ in range(2)]
+        res = client().post('/quizzes', json=quiz, headers={'X-Forwarded-For': '10.0.0.1'})
+        data = json.loads(res.data)
+        # the address added by the proxy, the one written by the client before it doesn't count
+        other_res = client().post('/quizzes', json=quiz, headers={'X-Forwarded-For': '10.0.0.1, 10.0.0.2'})
+
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "too many requests")
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+        self.assertEqual(other_res.status_code, 200)
+
+    def test_error_429_rate_limit_search(self):
+        """test the error 429 for the searches of the endpoint POST /questions, the new questions aren't limited"""
+        app, client = self.create_client({'RATE_LIMIT_SEARCH_PER_SECOND': 0.001, 'RATE_LIMIT_SEARCH_BURST': 1})
+        first_res = client().post('/questions', json={'searchTerm': 'world'})
+        res = client().post('/questions', json={'searchTerm': 'world'})
+        add_res = client().post('/questions', json={
+            "question": "what is the capital of Mali?",
+            "answer": "Bamako",
+            "difficulty": 1,
+            "category": "3"
+        })
+        client().delete(f"/questions/{json.loads(add_res.data)['question_id']}")
+
+        self.assertEqual(first_res.status_code, 200)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(json.loads(res.data)['message'], "too many requests")
+        self.assertEqual(add_res.status_code, 200)
+
+    def test_error_503_load_shedding(self):
+        """test the error 503 for the method POST for the endpoint /quizzes while the worker runs too many of them"""
+        app, client = self.create_client({'LOAD_SHED_MAX_IN_FLIGHT': 1, 'LOAD_SHED_RETRY_AFTER': 2})
+        load_shedder = app.extensions['load_shedder']
+        quiz = {'previous_questions': [], 'quiz_category': {'id': 0}}
+        # a quiz still running in the worker
+        load_shedder.admit()
+        res = client().post('/quizzes', json=quiz)
+        data = json.loads(res.data)
+        load_shedder.release(0)
+        next_res = client().post('/quizzes', json=quiz)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "service unavailable")
+        self.assertEqual(res.headers['Retry-After'], '2')
+        self.assertEqual(next_res.status_code, 200)
+        self.assertEqual(load_shedder.in_flight, 0)
+
+    def test_token_bucket_and_load_shedder(self):
+        """test if a bucket gives its tokens back over time, and if a slow database stops the shedding once it fades"""
+        store = MemoryBucketStore()
+        waits = [store.take('quizzes:10.0.0.1', 1, 2, now=0) for _ in range(3)]
+        half_wait = store.take('quizzes:10.0.0.1', 1, 2, now=0.5)
+        refilled_wait = store.take('quizzes:10.0.0.1', 1, 2, now=1.0)
+
+        load_shedder = LoadShedder(0, 0.1, 1)
+        load_shedder.admit()
+        load_shedder.release(1.0)
+        shed = load_shedder.admit()
+        # two seconds later without any request finishing
+        load_shedder.updated_at -= 2
+        admitted = load_shedder.admit()
+
+        self.assertEqual(waits, [0, 0, 1.0])
+        self.assertEqual(half_wait, 0.5)
+        self.assertEqual(refilled_wait, 0)
+        self.assertEqual(shed, 1)
+        self.assertEqual(admitted, 0)
+
+    # ================================================================================
+    # tests for the async serving mode
+    # ================================================================================
+    def test_async_stream_stops_when_client_disconnects(self):
+        """test if the async mode stops a streamed response of the Flask app whose client went away"""
+        from asgi import create_asgi_app
+        asgi_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': DB_PATH, 'DB_CREATE_ALL': False})
+        closed = threading.Event()
+
+        @asgi_app.flask_app.route('/test/stream')
+        def stream():
+            def generate():
+                try:
+                    # more chunks than the queue between the thread and the event loop holds
+                    for _ in range(100):
+                        yield b'x' * 1024
+                finally:
+                    closed.set()
+            return asgi_app.flask_app.response_class(generate(), mimetype='application/octet-stream')
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                 'scheme': 'http', 'path': '/test/stream', 'raw_path': b'/test/stream', 'query_string': b'',
+                 'root_path': '', 'headers': [], 'server': ('localhost', 80), 'client': ('127.0.0.1', 0)}
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                raise ConnectionResetError('the client went away')
+
+        loop = asyncio.new_event_loop()
+        try:
+            with self.assertRaises(ConnectionResetError):
+                loop.run_until_complete(asgi_app(scope, receive, send))
+            # the thread of the response isn't left blocked on the queue
+            self.assertTrue(closed.wait(5))
+        finally:
+            loop.close()
+
 
 
 # Make the tests conveniently executable
@@ -0,0 +1,145 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from models import db, notify_question_listeners, Question, QuestionChange, QuestionCount, TableVersion
+from serialization import QuestionRow, QUESTION_FIELDS
+from tenants import current_tenant, use_tenant
+
+logger = logging.getLogger(__name__)
+
+'''
+WriteBatcher
+    write-behind of POST /questions (DB_WRITE_BATCHING): the request hands its question to a writer thread and
+    waits, the thread inserts the questions that arrive within max_delay seconds (up to max_size) in a single
+    transaction, so a burst of submissions shares one commit, and one fsync, instead of paying one each.
+    - a request only gets its id back once its transaction is committed, nothing is acknowledged before it is durable
+    - when the queue is full or the writer is stopped, the question is committed right away by Question.insert()
+    - a batch that fails is written again question by question, so one bad question only fails its own request
+    - stop() (also called at exit) writes the questions already queued before the thread ends
+'''
+class WriteBatcher:
+
+  def __init__(self, app, max_delay, max_size, queue_size):
+    self.app = app
+    self.max_delay = max_delay
+    self.max_size = max(1, max_size)
+    self.queue = queue.Queue(queue_size)
+    self.thread = None
+    self.stopping = False
+    self.lock = threading.Lock()
+
+  def insert(self, question, answer, category, difficulty):
+    """commits a new question and returns its id, in a batch when the writer can take it"""
+    fields = {'question': question, 'answer': answer, 'category': category, 'difficulty': difficulty}
+    future = Future()
+    with self.lock:
+      queued = False
+      if not self.stopping:
+        self.start()
+        try:
+          # the tenant of the request, the writer thread doesn't have it
+          self.queue.put_nowait((current_tenant(), fields, future))
+          queued = True
+        except queue.Full:
+          pass
+    if queued:
+      return future.result()
+
+    new_question = Question(**fields)
+    new_question.insert()
+    return new_question.id
+
+  def start(self):
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.run, name='question-writer', daemon=True)
+      self.thread.start()
+      atexit.register(self.stop)
+
+  def stop(self, timeout=10):
+    """writes the queued questions and ends the writer thread, the next inserts commit one by one"""
+    with self.lock:
+      if self.stopping:
+        return
+      self.stopping = True
+      thread = self.thread
+      if thread is not None:
+        # after every question queued so far, the lock keeps the requests from queueing behind it
+        self.queue.put(None)
+    if thread is not None:
+      thread.join(timeout)
+
+  def run(self):
+    stopped = False
+    while not stopped:
+      item = self.queue.get()
+      if item is None:
+        break
+      batch = [item]
+      deadline = time.monotonic() + self.max_delay
+      while len(batch) < self.max_size:
+        try:
+          # whatever is already queued is taken right away, then the next ones until the deadline
+          item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+          break
+        if item is None:
+          stopped = True
+          break
+        batch.append(item)
+
+      tenants = {}
+      for tenant, fields, future in batch:
+        tenants.setdefault(tenant, []).append((fields, future))
+      for tenant, writes in tenants.items():
+        try:
+          with self.app.app_context(), use_tenant(tenant):
+            self.write(writes)
+        except Exception as error:
+          # the requests must never wait for an answer that won't come
+          logger.exception('the questions writer failed')
+          for fields, future in writes:
+            if not future.done():
+              future.set_exception(error)
+
+  def write(self, writes):
+    """one transaction for all the questions, or one per question when it fails"""
+    questions = [Question(**fields) for fields, future in writes]
+    try:
+      # first, so the writers queue on the version before they lock the counts (see TableVersion)
+      TableVersion.bump('questions')
+      db.session.add_all(questions)
+      db.session.flush()
+      # read before the commit expires them
+      rows = [QuestionRow(*[getattr(question, field) for field in QUESTION_FIELDS]) for question in questions]
+      counts = {}
+      for row in rows:
+        counts[row.category] = counts.get(row.category, 0) + 1
+      # in the order of the categories, like any other transaction changing several counts
+      for category, count in sorted(counts.items()):
+        QuestionCount.add(category, count)
+      for row in rows:
+        QuestionChange.record('insert', row)
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      TableVersion.forget_bumps()
+      self.write_one_by_one(writes)
+      return
+
+    for row, (fields, future) in zip(rows, writes):
+      notify_question_listeners('insert', row)
+      future.set_result(row.id)
+
+  def write_one_by_one(self, writes):
+    for fields, future in writes:
+      try:
+        question = Question(**fields)
+        question.insert()
+        future.set_result(question.id)
+      except Exception as error:
+        db.session.rollback()
+        future.set_exception(error)